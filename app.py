@@ -1,12 +1,30 @@
 import os
-from flask import Flask, request, jsonify, render_template
+import json
+import hmac
+import uuid
+import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Flask, Response, g, request, jsonify, render_template, send_file, stream_with_context
 from werkzeug.utils import secure_filename
-from services.ibm_services import add_document_to_discovery, query_discovery, get_nlu_client, calculate_relevance
-# from services.openai_service import generate_answer  # Original OpenAI implementation
-from services.watsonxai_service import generate_answer  # New watsonx.ai implementation
+from services.ibm_services import query_discovery
+from services.ingestion import ingestion_queue
+from services.uploads import chunked_uploads, save_hashed, UploadOffsetMismatch
+from services.query_pipeline import find_relevant_documents, iter_relevant_documents, query_flight_key
+from services.context_packer import pack_context, context_stats
+# Answers come from the backend named by ANSWER_BACKEND (watsonx or openai), imported on first use
+from services.answer_backends import generate_answer, stream_answer, clean_answer
 from utils.validators import allowed_file, validate_thresholds, validate_dates
 from utils.logger import logger
-from config import UPLOAD_FOLDER, APP_PASSPHRASE_HASH
+from utils.history import build_history_store
+from utils.metrics import metrics, start_request, current_request, stage, mark_degraded, degraded_modes
+from utils.resilience import ServiceUnavailable
+from utils.singleflight import SingleFlight
+from utils.compression import choose_encoding, should_compress, compress
+from utils.profiling import RequestProfile, profile_store, should_sample, for_request, PROFILE_FORMATS, PROFILE_ID
+from config import (UPLOAD_FOLDER, APP_PASSPHRASE_HASH, HISTORY_DB_PATH, HISTORY_CAPACITY,
+                    HISTORY_MAX_SESSIONS, HISTORY_RESPONSE_LIMIT, BATCH_MAX_QUERIES, BATCH_CONCURRENCY,
+                    PROFILE_TOKEN, PROFILE_SAMPLE_RATE, QUERY_DOCUMENTS_PAGE_SIZE, QUERY_DOCUMENTS_MAX_PAGE_SIZE)
 from functools import wraps
 
 app = Flask(__name__, template_folder='templates', static_folder='static')
@@ -14,7 +32,94 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-search_history = []
+history_store = build_history_store(HISTORY_DB_PATH, HISTORY_CAPACITY, HISTORY_MAX_SESSIONS)
+query_flight = SingleFlight('query')
+
+metrics.describe('crag_batch_queries_total', 'Queries run through /query/batch by outcome')
+
+# Endpoints never profiled: static files, scrapes and the profile endpoints themselves
+UNPROFILED_ENDPOINTS = {'static', 'metrics_endpoint', 'list_profiles', 'download_profile'}
+
+def get_session_id() -> str:
+    """Identify the browser session from the X-Session-Id header."""
+    session_id = request.headers.get('X-Session-Id', '').strip()
+    return session_id[:64] or 'default'
+
+def record_history(session_id: str, query: str, answer: str, add: bool = True) -> list:
+    """
+    Store a query in the session history and return the newest entries for the
+    response. Requests for later pages of a result pass add=False so paging does
+    not record the query again.
+    """
+    if add:
+        history_store.add(session_id, query, answer)
+    entries, _ = history_store.page(session_id, 0, HISTORY_RESPONSE_LIMIT)
+    return entries
+
+@app.before_request
+def begin_request_timing():
+    start_request()
+
+def profile_trigger():
+    """Why this request should be profiled ('header' or 'sample'), or None."""
+    if request.endpoint is None or request.endpoint in UNPROFILED_ENDPOINTS:
+        return None
+    token = request.headers.get('X-Profile-Token', '')
+    if (token and PROFILE_TOKEN and hmac.compare_digest(token, PROFILE_TOKEN)
+            and request.headers.get('X-App-Passphrase') == APP_PASSPHRASE_HASH):
+        return 'header'
+    if should_sample(PROFILE_SAMPLE_RATE):
+        return 'sample'
+    return None
+
+@app.before_request
+def begin_profile():
+    trigger = profile_trigger()
+    if trigger is not None:
+        g.profile = RequestProfile(request.url_rule.rule, request.method, trigger)
+        g.profile.start()
+
+@app.after_request
+def finish_profile(response):
+    """Stop the request's profile once the response (including a streamed body) is closed."""
+    profile = g.pop('profile', None)
+    if profile is not None:
+        status = response.status_code
+
+        def save():
+            try:
+                profile_store.save(profile, profile.finish(status))
+            except Exception as e:
+                logger.error(f"Failed to save profile {profile.id}: {str(e)}")
+
+        response.headers['X-Profile-Id'] = profile.id
+        response.call_on_close(save)
+    return response
+
+@app.after_request
+def add_timing_headers(response):
+    """Expose per-stage timings as Server-Timing and record the request duration histogram."""
+    timings = current_request()
+    if timings is not None:
+        response.headers['Server-Timing'] = timings.server_timing()
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe('crag_request_duration_seconds', time.perf_counter() - timings.started,
+                        {'endpoint': endpoint, 'method': request.method, 'status': str(response.status_code)})
+    return response
+
+@app.after_request
+def compress_response(response):
+    """Compress large JSON and text responses with brotli or gzip when the client accepts it."""
+    if response.direct_passthrough or response.is_streamed:
+        return response
+    if not should_compress(response.mimetype, response.content_length or 0, response.headers.get('Content-Encoding')):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+    if encoding is not None:
+        response.set_data(compress(response.get_data(), encoding))
+        response.headers['Content-Encoding'] = encoding
+    return response
 
 def requires_passphrase(f):
     @wraps(f)
@@ -33,26 +138,202 @@ def home():
 @app.route('/upload', methods=['POST'])
 @requires_passphrase
 def upload_file():
-    """Upload and add a document to IBM Discovery."""
+    """
+    Accept one or more documents and queue them for ingestion into IBM Discovery.
+    Returns a job ID immediately; progress is reported by /upload/status/<job_id>.
+    Files are hashed while they are saved, and content that was ingested before
+    is not sent to Discovery again. Large files can use /upload/chunked instead.
+    """
     if 'file' not in request.files:
         return jsonify({'error': 'No file part'}), 400
 
-    file = request.files['file']
-    if file.filename == '':
+    files = [f for f in request.files.getlist('file') if f.filename != '']
+    if not files:
         return jsonify({'error': 'No selected file'}), 400
 
-    if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        try:
-            response = add_document_to_discovery(filepath, filename)
-            return jsonify({'message': 'File uploaded successfully', 'response': response}), 200
-        except Exception as e:
-            logger.error(f"Failed to add document: {str(e)}")
-            return jsonify({'error': f"Failed to add document: {str(e)}"}), 500
+    rejected = [f.filename for f in files if not allowed_file(f.filename)]
+    accepted = [f for f in files if allowed_file(f.filename)]
+    if not accepted:
+        return jsonify({'error': 'File type not allowed'}), 400
+
+    queued = []
+    try:
+        for file in accepted:
+            filename = secure_filename(file.filename)
+            # Unique temporary name so concurrent uploads of the same file never collide
+            filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"{uuid.uuid4().hex}-{filename}")
+            digest = save_hashed(file.stream, filepath)
+            queued.append((filepath, filename, digest))
+        job_id = ingestion_queue.submit(queued)
+    except Exception as e:
+        logger.error(f"Failed to queue documents: {str(e)}")
+        for filepath, _, _ in queued:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+        return jsonify({'error': f"Failed to queue documents: {str(e)}"}), 500
+
+    return jsonify({
+        'message': f"{len(queued)} file(s) queued for ingestion",
+        'job_id': job_id,
+        'status_url': f"/upload/status/{job_id}",
+        'files': [filename for _, filename, _ in queued],
+        'rejected': rejected
+    }), 202
+
+@app.route('/upload/chunked', methods=['POST'])
+@requires_passphrase
+def start_chunked_upload():
+    """
+    Begin a resumable upload of one large file: {"filename": ..., "size": <bytes>}.
+
+    Send the file in order as PUT requests to `upload_url`, each with an
+    `Upload-Offset` header giving the chunk's position and at most
+    `chunk_size` bytes of body. GET `upload_url` reports how many bytes
+    arrived, so an interrupted upload resumes from there. POST
+    `upload_url`/complete queues the file for ingestion like /upload.
+    """
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(str(data.get('filename', '')))
+    if not filename or not allowed_file(filename):
+        return jsonify({'error': 'File type not allowed'}), 400
+    try:
+        size = int(data.get('size'))
+    except (TypeError, ValueError):
+        size = 0
+    if size <= 0:
+        return jsonify({'error': 'Upload size must be a positive number of bytes'}), 400
+
+    upload = chunked_uploads.start(filename, size)
+    upload['upload_url'] = f"/upload/chunked/{upload['upload_id']}"
+    return jsonify(upload), 201
+
+@app.route('/upload/chunked/<upload_id>', methods=['GET'])
+@requires_passphrase
+def chunked_upload_status(upload_id):
+    """Report how many bytes of a chunked upload have been received."""
+    status = chunked_uploads.status(upload_id)
+    if status is None:
+        return jsonify({'error': 'Unknown upload'}), 404
+    return jsonify(status), 200
+
+@app.route('/upload/chunked/<upload_id>', methods=['PUT'])
+@requires_passphrase
+def upload_chunk(upload_id):
+    """Append one chunk, streamed to disk as it arrives; a chunk at the wrong offset is a 409."""
+    length = request.content_length
+    if length is None:
+        return jsonify({'error': 'Content-Length is required'}), 411
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+    except ValueError:
+        return jsonify({'error': 'Upload-Offset header is missing'}), 400
+
+    try:
+        offset = chunked_uploads.append(upload_id, offset, request.stream, length)
+    except (KeyError, FileNotFoundError):
+        return jsonify({'error': 'Unknown upload'}), 404
+    except UploadOffsetMismatch as e:
+        return jsonify({'error': str(e), 'offset': e.offset}), 409
+    except ValueError as ve:
+        return jsonify({'error': str(ve)}), 413
+    return jsonify({'upload_id': upload_id, 'offset': offset}), 200
+
+@app.route('/upload/chunked/<upload_id>/complete', methods=['POST'])
+@requires_passphrase
+def complete_chunked_upload(upload_id):
+    """Queue a fully received chunked upload for ingestion."""
+    try:
+        filepath, filename, digest = chunked_uploads.complete(upload_id)
+    except (KeyError, FileNotFoundError):
+        return jsonify({'error': 'Unknown upload'}), 404
+    except UploadOffsetMismatch as e:
+        return jsonify({'error': str(e), 'offset': e.offset}), 409
+
+    try:
+        job_id = ingestion_queue.submit([(filepath, filename, digest)])
+    except Exception as e:
+        logger.error(f"Failed to queue documents: {str(e)}")
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        return jsonify({'error': f"Failed to queue documents: {str(e)}"}), 500
+
+    return jsonify({
+        'message': "1 file(s) queued for ingestion",
+        'job_id': job_id,
+        'status_url': f"/upload/status/{job_id}",
+        'files': [filename],
+        'rejected': []
+    }), 202
+
+@app.route('/upload/status/<job_id>', methods=['GET'])
+@requires_passphrase
+def upload_status(job_id):
+    """Report per-file ingestion progress and timings for an upload job."""
+    status = ingestion_queue.status(job_id)
+    if status is None:
+        return jsonify({'error': 'Unknown upload job'}), 404
+    return jsonify(status), 200
+
+def parse_query_request(data: dict) -> dict:
+    """Extract and validate the query parameters shared by the query endpoints."""
+    params = {
+        'query': data['query'],
+        'start_date': data.get('start_date'),
+        'end_date': data.get('end_date'),
+        'confidence_threshold': float(data.get('confidence_threshold', 0)),
+        'relevance_threshold': float(data.get('relevance_threshold', 0))
+    }
+
+    # Validate input
+    validate_thresholds(params['confidence_threshold'], params['relevance_threshold'])
+    validate_dates(params['start_date'], params['end_date'])
+    return params
+
+def parse_documents_page(data: dict) -> tuple:
+    """Read the optional documents_offset / documents_limit of a query request; a limit of None means all."""
+    try:
+        offset = max(0, int(data.get('documents_offset', 0)))
+        limit = int(data.get('documents_limit', QUERY_DOCUMENTS_PAGE_SIZE) or 0)
+    except (TypeError, ValueError):
+        raise ValueError('documents_offset and documents_limit must be integers')
+    return offset, (min(QUERY_DOCUMENTS_MAX_PAGE_SIZE, limit) if limit > 0 else None)
+
+def page_documents(documents: list, offset: int, limit: int) -> tuple:
+    """Return one page of documents and its position, in the shape /history uses."""
+    page = documents[offset:] if limit is None else documents[offset:offset + limit]
+    return page, {
+        "offset": offset,
+        "limit": limit,
+        "total": len(documents),
+        "has_more": offset + len(page) < len(documents)
+    }
+
+def answer_query(params: dict, use_cache: bool = True) -> dict:
+    """
+    Retrieve and filter documents, pack the context and generate the answer.
+    If watsonx.ai is unavailable the documents are returned without an answer.
+    """
+    unscored = []
+    formatted_results = find_relevant_documents(**params, unscored=unscored)
 
-    return jsonify({'error': 'File type not allowed'}), 400
+    answer = ""
+    with stage('context_packing'):
+        packed_context = pack_context(formatted_results)
+    if formatted_results:
+        # Generate answer using watsonx.ai foundation model
+        with stage('generate_answer'):
+            try:
+                answer = generate_answer(params['query'], formatted_results, packed_context, use_cache)
+            except ServiceUnavailable as e:
+                logger.warning(f"Answering without a generated summary: {e}")
+                mark_degraded('answer')
+    return {
+        "answer": answer,
+        "relevant_documents": formatted_results,
+        "unscored_documents": unscored,
+        "context": packed_context,
+        "degraded": degraded_modes()
+    }
 
 @app.route('/query', methods=['POST'])
 @requires_passphrase
@@ -64,97 +345,280 @@ def query_endpoint():
 
     The process:
     1. Query IBM Discovery for relevant documents
-    2. Use NLU to calculate relevance scores
-    3. Filter results based on confidence and relevance thresholds
+    2. Filter results by confidence, then use NLU to score all remaining passages concurrently
+    3. Filter results based on relevance thresholds
     4. Generate comprehensive answer using watsonx.ai foundation model
     5. Return query results and generated answer
+
+    Identical queries (same normalized text, dates and thresholds) arriving while
+    one is in flight wait for it and share its result instead of repeating the work.
+    Generated answers are cached; send "bypass_cache": true to regenerate.
+
+    `relevant_documents` can be paged with "documents_offset" and "documents_limit";
+    `documents_page` gives the position and total. The answer always draws on
+    every relevant document, and later pages are served from the caches.
+
+    When NLU is unavailable documents are filtered on confidence alone, and when
+    watsonx.ai is unavailable they are returned without an answer; `degraded`
+    lists which of these applied. Discovery being unavailable is a 503.
     """
     try:
         data = request.get_json()
         if not data or 'query' not in data:
             return jsonify({'error': 'Query parameter is missing'}), 400
 
-        query = data['query']
-        start_date = data.get('start_date')
-        end_date = data.get('end_date')
-        confidence_threshold = float(data.get('confidence_threshold', 0))
-        relevance_threshold = float(data.get('relevance_threshold', 0))
-
-        # Validate input
-        validate_thresholds(confidence_threshold, relevance_threshold)
-        validate_dates(start_date, end_date)
+        params = parse_query_request(data)
+        offset, limit = parse_documents_page(data)
+        query = params['query']
 
         logger.info(f"Received query: {query}")
 
-        discovery_response = query_discovery(query, start_date, end_date)
-        results = discovery_response.get("results", [])
-
-        nlu_client = get_nlu_client()
-        formatted_results = []
-        for result in results:
-            metadata = result.get("extracted_metadata", {})
-            passages = result.get("document_passages", [])
-            confidence_value = result.get('result_metadata', {}).get('confidence', 0) * 100
-
-            if confidence_value < confidence_threshold:
-                continue
-
-            # Calculate relevance for each passage
-            scores = [
-                {
-                    "passage": p.get("passage_text", "No Passage Available"),
-                    "relevance_score": calculate_relevance(nlu_client, query, p.get("passage_text", ""))
-                }
-                for p in passages
-            ]
-
-            # If a relevance threshold is set, skip documents that don't meet it
-            if relevance_threshold > 0 and not any(s['relevance_score'] >= relevance_threshold for s in scores):
-                continue
-
-            # Include all passages that meet or exceed relevance threshold
-            relevant_passages = [s['passage'] for s in scores if s['relevance_score'] >= relevance_threshold]
-
-            # If no relevant passages after filtering, skip the doc
-            if not relevant_passages:
-                continue
-
-            # Document passes the filters, so add it
-            top_relevance = max(s['relevance_score'] for s in scores if s['relevance_score'] >= relevance_threshold)
-            formatted_results.append({
-                "document_id": result.get("document_id"),
-                "author": metadata.get("author", "Unknown"),
-                "title": metadata.get("title", metadata.get("filename", "No Title")),
-                "confidence": f"{confidence_value:.2f}%",
-                "relevance": f"{top_relevance:.2f}",
-                "passages": relevant_passages
-            })
-
-        answer = ""
-        if formatted_results:
-            # Generate answer using watsonx.ai foundation model
-            answer = generate_answer(query, formatted_results)
+        use_cache = not data.get('bypass_cache', False)
+        flight_key = query_flight_key(params) + ('' if use_cache else ':bypass')
+        result = query_flight.do(flight_key, answer_query, params, use_cache)
+        documents, documents_page = page_documents(result["relevant_documents"], offset, limit)
 
-        # Log the query and answer
-        search_history.append({
-            "query": query,
-            "answer": answer
-        })
+        # Log the query and answer once, not again for every page of its documents
+        recent_history = record_history(get_session_id(), query, result["answer"], add=offset == 0)
 
         return jsonify({
             "query": query,
-            "answer": answer,
-            "relevant_documents": formatted_results,
-            "search_history": search_history
+            "answer": result["answer"],
+            "relevant_documents": documents,
+            "documents_page": documents_page,
+            "unscored_documents": result["unscored_documents"],
+            "context": context_stats(result["context"]),
+            "degraded": result["degraded"],
+            "search_history": recent_history
         }), 200
 
     except ValueError as ve:
         logger.error(str(ve))
         return jsonify({'error': str(ve)}), 422
+    except ServiceUnavailable as su:
+        logger.error(str(su))
+        return jsonify({'error': str(su)}), 503
     except Exception as e:
         logger.error(f"Exception occurred: {str(e)}")
         return jsonify({'error': f"An error occurred: {str(e)}"}), 500
 
+def sse_event(event: str, data) -> str:
+    """Format one Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/query/stream', methods=['POST'])
+@requires_passphrase
+def query_stream_endpoint():
+    """
+    Streaming variant of /query using Server-Sent Events.
+
+    Events are sent as they happen:
+    - `document`: each document as soon as it passes the confidence and relevance filters
+    - `token`: each chunk of the generated answer as the model produces it
+    - `summary`: the cleaned final answer, document count, documents left unscored,
+      context packing stats, degraded modes and recent search history
+    - `error`: sent instead of the remaining events if the pipeline fails
+    """
+    data = request.get_json()
+    if not data or 'query' not in data:
+        return jsonify({'error': 'Query parameter is missing'}), 400
+
+    try:
+        params = parse_query_request(data)
+    except ValueError as ve:
+        logger.error(str(ve))
+        return jsonify({'error': str(ve)}), 422
+
+    query = params['query']
+    use_cache = not data.get('bypass_cache', False)
+    session_id = get_session_id()
+    logger.info(f"Received streaming query: {query}")
+
+    def generate():
+        try:
+            with stage('discovery'):
+                discovery_response = query_discovery(query, params['start_date'], params['end_date'])
+            results = discovery_response.get("results", [])
+
+            formatted_results = []
+            unscored = []
+            for document in iter_relevant_documents(query, results, params['confidence_threshold'],
+                                                    params['relevance_threshold'], unscored):
+                formatted_results.append(document)
+                yield sse_event('document', document)
+
+            answer = ""
+            with stage('context_packing'):
+                packed_context = pack_context(formatted_results)
+            if formatted_results:
+                chunks = []
+                started = time.perf_counter()
+                try:
+                    for chunk in stream_answer(query, formatted_results, packed_context, use_cache):
+                        chunks.append(chunk)
+                        yield sse_event('token', {'text': chunk})
+                    answer = clean_answer("".join(chunks).strip())
+                except ServiceUnavailable as e:
+                    logger.warning(f"Answering without a generated summary: {e}")
+                    mark_degraded('answer')
+                metrics.observe('crag_stage_duration_seconds', time.perf_counter() - started,
+                                {'stage': 'generate_answer'})
+
+            recent_history = record_history(session_id, query, answer)
+
+            yield sse_event('summary', {
+                "query": query,
+                "answer": answer,
+                "document_count": len(formatted_results),
+                "unscored_documents": unscored,
+                "context": context_stats(packed_context),
+                "degraded": degraded_modes(),
+                "search_history": recent_history
+            })
+        except Exception as e:
+            logger.error(f"Exception occurred while streaming: {str(e)}")
+            yield sse_event('error', {'error': f"An error occurred: {str(e)}"})
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def retrieve_documents(params: dict) -> dict:
+    """Retrieve and filter documents without generating an answer."""
+    unscored = []
+    formatted_results = find_relevant_documents(**params, unscored=unscored)
+    return {
+        "relevant_documents": formatted_results,
+        "unscored_documents": unscored,
+        "degraded": degraded_modes()
+    }
+
+def run_batch_item(index: int, item, generate_answers: bool, use_cache: bool) -> dict:
+    """Run one query of a batch and return its result line; failures are reported, not raised."""
+    timings = start_request()
+    line = {"index": index, "id": item.get('id') if isinstance(item, dict) else None}
+    try:
+        if not isinstance(item, dict) or 'query' not in item:
+            raise ValueError('Query parameter is missing')
+        params = parse_query_request(item)
+        flight_key = query_flight_key(params) + ('' if use_cache else ':bypass')
+        if generate_answers:
+            result = query_flight.do(flight_key, answer_query, params, use_cache)
+            result = dict(result, context=context_stats(result["context"]))
+        else:
+            result = query_flight.do(flight_key + ':documents', retrieve_documents, params)
+        line.update(status='ok', query=params['query'], **result)
+    except ValueError as ve:
+        line.update(status='invalid', error=str(ve))
+    except ServiceUnavailable as su:
+        line.update(status='unavailable', error=str(su))
+    except Exception as e:
+        logger.error(f"Exception occurred in batch query {index}: {str(e)}")
+        line.update(status='error', error=f"An error occurred: {str(e)}")
+    line['duration_ms'] = round((time.perf_counter() - timings.started) * 1000, 1)
+    metrics.inc('crag_batch_queries_total', {'status': line['status']})
+    return line
+
+@app.route('/query/batch', methods=['POST'])
+@requires_passphrase
+def query_batch_endpoint():
+    """
+    Run many queries, each with its own dates and thresholds, and stream one
+    JSON line per query as soon as it completes (so in completion order; each
+    line carries the query's `index` in the request and its optional `id`).
+
+    Request: {"queries": [{"query": ..., "start_date": ..., ...}], "generate_answers": true,
+    "bypass_cache": false}. With "generate_answers": false only documents are returned.
+
+    Up to BATCH_CONCURRENCY queries run at once. Identical queries share one
+    run, and a (query, passage) pair in flight for one query is not scored
+    again for another, so overlapping queries cost no extra NLU calls.
+    A query that fails gets a line with `status` and `error` and does not stop
+    the batch; the last line is {"done": true, ...} with the outcome counts.
+    Batch queries are not added to the search history.
+    """
+    data = request.get_json(silent=True)
+    queries = data.get('queries') if isinstance(data, dict) else None
+    if not isinstance(queries, list) or not queries:
+        return jsonify({'error': 'Queries parameter is missing'}), 400
+    if len(queries) > BATCH_MAX_QUERIES:
+        return jsonify({'error': f"A batch can contain at most {BATCH_MAX_QUERIES} queries"}), 413
+
+    generate_answers = bool(data.get('generate_answers', True))
+    use_cache = not data.get('bypass_cache', False)
+    logger.info(f"Received batch of {len(queries)} queries")
+
+    def generate():
+        started = time.perf_counter()
+        statuses = {}
+        executor = ThreadPoolExecutor(max_workers=max(1, min(BATCH_CONCURRENCY, len(queries))),
+                                      thread_name_prefix='batch')
+        try:
+            futures = [executor.submit(contextvars.copy_context().run, for_request, run_batch_item,
+                                       index, item, generate_answers, use_cache)
+                       for index, item in enumerate(queries)]
+            for future in as_completed(futures):
+                line = future.result()
+                statuses[line['status']] = statuses.get(line['status'], 0) + 1
+                yield json.dumps(line) + "\n"
+            yield json.dumps({
+                "done": True,
+                "total": len(queries),
+                "statuses": statuses,
+                "duration_ms": round((time.perf_counter() - started) * 1000, 1)
+            }) + "\n"
+        finally:
+            # Stops queued queries if the client disconnects part-way through
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/history', methods=['GET'])
+@requires_passphrase
+def history_endpoint():
+    """Return one page of the session's search history, newest first."""
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+        limit = min(100, max(1, int(request.args.get('limit', 20))))
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 422
+
+    entries, total = history_store.page(get_session_id(), offset, limit)
+    return jsonify({
+        "history": entries,
+        "offset": offset,
+        "limit": limit,
+        "total": total,
+        "has_more": offset + len(entries) < total
+    }), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus metrics merged across all gunicorn workers."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/profiles', methods=['GET'])
+@requires_passphrase
+def list_profiles():
+    """
+    List stored request profiles, newest first. Each summary splits wall time into
+    request-thread CPU and waiting (I/O, locks, worker pools) and names the files
+    available from /profiles/<id>.<pstats|collapsed|json>.
+    """
+    return jsonify({"profiles": profile_store.list()}), 200
+
+@app.route('/profiles/<profile_id>.<fmt>', methods=['GET'])
+@requires_passphrase
+def download_profile(profile_id, fmt):
+    """Download one profile as pstats (cProfile), collapsed stacks (flame graphs) or its JSON summary."""
+    if fmt not in PROFILE_FORMATS or not PROFILE_ID.match(profile_id):
+        return jsonify({'error': 'Unknown profile'}), 404
+    path = profile_store.path(profile_id, fmt)
+    if not os.path.exists(path):
+        return jsonify({'error': 'Unknown profile'}), 404
+    return send_file(os.path.abspath(path), mimetype=PROFILE_FORMATS[fmt], as_attachment=True,
+                     download_name=f"{profile_id}.{fmt}")
+
 if __name__ == '__main__':
     logger.info("Starting Flask Application")
     # Get port from environment variable or default to 8080
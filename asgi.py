@@ -0,0 +1,212 @@
+"""
+Asyncio (ASGI) serving mode.
+
+/query and /upload run on the event loop: Discovery, NLU and watsonx.ai are
+called through a shared non-blocking HTTP client, so a worker waiting on IBM
+services keeps serving other requests instead of holding a thread. Every other
+route is served by the Flask app unchanged through a WSGI bridge.
+
+    gunicorn -k uvicorn.workers.UvicornWorker --bind 0.0.0.0:$PORT asgi:app
+"""
+import os
+import time
+import uuid
+from functools import wraps
+from contextlib import asynccontextmanager
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
+from a2wsgi import WSGIMiddleware
+from werkzeug.utils import secure_filename
+from app import app as flask_app, parse_query_request, parse_documents_page, page_documents, record_history
+from services.async_services import (find_relevant_documents, generate_answer, add_document_to_discovery,
+                                     close_async_clients)
+from services.context_packer import pack_context, context_stats
+from services.ingestion import AsyncIngestionQueue, ingestion_queue
+from services.uploads import save_hashed
+from services.query_pipeline import query_flight_key
+from utils.validators import allowed_file
+from utils.compression import choose_encoding, should_compress, compress
+from utils.logger import logger
+from utils.metrics import metrics, start_request, stage, mark_degraded, degraded_modes
+from utils.resilience import ServiceUnavailable
+from utils.singleflight import AsyncSingleFlight
+from config import APP_PASSPHRASE_HASH, INGEST_MAX_WORKERS, INGEST_MAX_RETRIES, INGEST_RETRY_BACKOFF
+
+# Shares the job store with the sync queue so /upload/status/<job_id> works unchanged
+async_ingestion_queue = AsyncIngestionQueue(
+    ingestion_queue.store,
+    add_document_to_discovery,
+    max_workers=INGEST_MAX_WORKERS,
+    max_retries=INGEST_MAX_RETRIES,
+    backoff=INGEST_RETRY_BACKOFF,
+    index=ingestion_queue.index
+)
+query_flight = AsyncSingleFlight('query')
+
+
+def session_id_from(request) -> str:
+    session_id = request.headers.get('X-Session-Id', '').strip()
+    return session_id[:64] or 'default'
+
+
+def compress_response(request, response):
+    """Compress a large JSON response body in place when the client accepts brotli or gzip."""
+    if not should_compress(response.media_type, len(response.body), response.headers.get('content-encoding')):
+        return
+    response.headers.append('Vary', 'Accept-Encoding')
+    encoding = choose_encoding(request.headers.get('accept-encoding'))
+    if encoding is not None:
+        response.body = compress(response.body, encoding)
+        response.headers['Content-Encoding'] = encoding
+        response.headers['Content-Length'] = str(len(response.body))
+
+
+def async_endpoint(path: str):
+    """Check the passphrase and record Server-Timing and request metrics, like the Flask hooks."""
+    def decorator(f):
+        @wraps(f)
+        async def decorated(request):
+            timings = start_request()
+            auth_header = request.headers.get('X-App-Passphrase')
+            if not auth_header or auth_header != APP_PASSPHRASE_HASH:
+                response = JSONResponse({'error': 'Access denied. Valid passphrase required.'}, status_code=401)
+            else:
+                response = await f(request)
+            compress_response(request, response)
+            response.headers['Server-Timing'] = timings.server_timing()
+            metrics.observe('crag_request_duration_seconds', time.perf_counter() - timings.started,
+                            {'endpoint': path, 'method': request.method, 'status': str(response.status_code)})
+            return response
+        return decorated
+    return decorator
+
+
+@async_endpoint('/upload')
+async def upload_file(request):
+    """Async variant of /upload; files are forwarded to Discovery by tasks on the event loop."""
+    form = await request.form()
+    uploads = [f for f in form.getlist('file') if hasattr(f, 'filename')]
+    if not uploads:
+        return JSONResponse({'error': 'No file part'}, status_code=400)
+
+    files = [f for f in uploads if f.filename != '']
+    if not files:
+        return JSONResponse({'error': 'No selected file'}, status_code=400)
+
+    rejected = [f.filename for f in files if not allowed_file(f.filename)]
+    accepted = [f for f in files if allowed_file(f.filename)]
+    if not accepted:
+        return JSONResponse({'error': 'File type not allowed'}, status_code=400)
+
+    queued = []
+    try:
+        for file in accepted:
+            filename = secure_filename(file.filename)
+            filepath = os.path.join(flask_app.config['UPLOAD_FOLDER'], f"{uuid.uuid4().hex}-{filename}")
+            digest = await run_in_threadpool(save_hashed, file.file, filepath)
+            queued.append((filepath, filename, digest))
+        job_id = await async_ingestion_queue.submit(queued)
+    except Exception as e:
+        logger.error(f"Failed to queue documents: {str(e)}")
+        for filepath, _, _ in queued:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+        return JSONResponse({'error': f"Failed to queue documents: {str(e)}"}, status_code=500)
+    finally:
+        await form.close()
+
+    return JSONResponse({
+        'message': f"{len(queued)} file(s) queued for ingestion",
+        'job_id': job_id,
+        'status_url': f"/upload/status/{job_id}",
+        'files': [filename for _, filename, _ in queued],
+        'rejected': rejected
+    }, status_code=202)
+
+
+async def answer_query(params: dict, use_cache: bool = True) -> dict:
+    unscored = []
+    formatted_results = await find_relevant_documents(**params, unscored=unscored)
+
+    answer = ""
+    with stage('context_packing'):
+        packed_context = pack_context(formatted_results)
+    if formatted_results:
+        with stage('generate_answer'):
+            try:
+                answer = await generate_answer(params['query'], formatted_results, packed_context, use_cache)
+            except ServiceUnavailable as e:
+                logger.warning(f"Answering without a generated summary: {e}")
+                mark_degraded('answer')
+    return {
+        "answer": answer,
+        "relevant_documents": formatted_results,
+        "unscored_documents": unscored,
+        "context": packed_context,
+        "degraded": degraded_modes()
+    }
+
+
+@async_endpoint('/query')
+async def query_endpoint(request):
+    """Async variant of /query with the same request and response contract, including request coalescing."""
+    try:
+        try:
+            data = await request.json()
+        except ValueError:
+            data = None
+        if not data or 'query' not in data:
+            return JSONResponse({'error': 'Query parameter is missing'}, status_code=400)
+
+        params = parse_query_request(data)
+        offset, limit = parse_documents_page(data)
+        query = params['query']
+
+        logger.info(f"Received query: {query}")
+
+        use_cache = not data.get('bypass_cache', False)
+        flight_key = query_flight_key(params) + ('' if use_cache else ':bypass')
+        result = await query_flight.do(flight_key, answer_query, params, use_cache)
+        documents, documents_page = page_documents(result["relevant_documents"], offset, limit)
+
+        recent_history = await run_in_threadpool(record_history, session_id_from(request), query, result["answer"],
+                                                 add=offset == 0)
+
+        return JSONResponse({
+            "query": query,
+            "answer": result["answer"],
+            "relevant_documents": documents,
+            "documents_page": documents_page,
+            "unscored_documents": result["unscored_documents"],
+            "context": context_stats(result["context"]),
+            "degraded": result["degraded"],
+            "search_history": recent_history
+        })
+
+    except ValueError as ve:
+        logger.error(str(ve))
+        return JSONResponse({'error': str(ve)}, status_code=422)
+    except ServiceUnavailable as su:
+        logger.error(str(su))
+        return JSONResponse({'error': str(su)}, status_code=503)
+    except Exception as e:
+        logger.error(f"Exception occurred: {str(e)}")
+        return JSONResponse({'error': f"An error occurred: {str(e)}"}, status_code=500)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    await close_async_clients()
+
+
+app = Starlette(
+    routes=[
+        Route('/query', query_endpoint, methods=['POST']),
+        Route('/upload', upload_file, methods=['POST']),
+        Mount('/', WSGIMiddleware(flask_app)),
+    ],
+    lifespan=lifespan
+)
@@ -0,0 +1,349 @@
+"""
+Local stand-ins for IBM IAM, Discovery, NLU and watsonx.ai used by the benchmark harness.
+
+Each service runs its own threaded HTTP server on localhost that speaks just
+enough of the real REST API for the app's SDK clients. Latency, jitter,
+failure rate and payload sizes are configurable, and every handled request is
+recorded so the harness can report server-side time per service.
+"""
+import json
+import time
+import uuid
+import random
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import jwt
+import requests
+
+WORDS = ("cloud platform service data model security network storage compute "
+         "deployment monitoring identity access workload container cluster region "
+         "availability resilience encryption pipeline analytics integration").split()
+
+
+class ServiceProfile:
+    """
+    Latency (ms), uniform jitter (ms) and failure rate injected into one fake
+    service, and an optional rate limit (requests per second, 0 for none)
+    above which it answers 429 like the real per-instance limits.
+    """
+
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, failure_rate: float = 0, rate_limit: float = 0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.rate_limit = rate_limit
+        self._lock = threading.Lock()
+        self._window_start = 0.0
+        self._window_count = 0
+
+    def delay(self) -> float:
+        return max(0.0, self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+
+    def should_fail(self) -> bool:
+        return random.random() < self.failure_rate
+
+    def should_throttle(self) -> bool:
+        """Whether this request exceeds the rate limit, counted in one-second windows."""
+        if not self.rate_limit:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            if now - self._window_start >= 1:
+                self._window_start, self._window_count = now, 0
+            self._window_count += 1
+            return self._window_count > self.rate_limit
+
+
+class RequestLog:
+    """Thread-safe record of handled requests per service."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.entries = {}
+
+    def record(self, service: str, seconds: float, status: int, response_bytes: int):
+        with self._lock:
+            self.entries.setdefault(service, []).append((seconds, status, response_bytes))
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {service: list(entries) for service, entries in self.entries.items()}
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+
+def _seeded(*parts) -> random.Random:
+    return random.Random(hashlib.sha256('\x1f'.join(map(str, parts)).encode()).hexdigest())
+
+
+def _text(rng: random.Random, chars: int) -> str:
+    words = []
+    length = 0
+    while length < chars:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)[:chars]
+
+
+def _project(result: dict, fields: list) -> dict:
+    """Keep the named (possibly dotted) fields; Discovery always returns the id, metadata and passages."""
+    projected = {key: result[key] for key in ('document_id', 'result_metadata', 'document_passages') if key in result}
+    for field in fields:
+        top, _, sub = field.partition('.')
+        if top not in result:
+            continue
+        if not sub:
+            projected[top] = result[top]
+        elif sub in result[top]:
+            projected.setdefault(top, {})[sub] = result[top][sub]
+    return projected
+
+
+class FakeServices:
+    """
+    Start fake IAM, Discovery, NLU and watsonx servers on ephemeral localhost ports.
+
+    Discovery results are generated deterministically from the query text so
+    repeated queries return the same documents, which keeps caches meaningful.
+    """
+
+    def __init__(self, discovery: ServiceProfile = None, nlu: ServiceProfile = None,
+                 watsonx: ServiceProfile = None, iam: ServiceProfile = None,
+                 results: int = 20, passages: int = 3, passage_chars: int = 300,
+                 document_chars: int = 4000, answer_tokens: int = 200):
+        self.profiles = {
+            'discovery': discovery or ServiceProfile(),
+            'nlu': nlu or ServiceProfile(),
+            'watsonx': watsonx or ServiceProfile(),
+            'iam': iam or ServiceProfile(),
+        }
+        self.results = results
+        self.passages = passages
+        self.passage_chars = passage_chars
+        self.document_chars = document_chars
+        self.answer_tokens = answer_tokens
+        self.log = RequestLog()
+        self.urls = {}
+        self._servers = []
+
+    def start(self):
+        for service in ('iam', 'discovery', 'nlu', 'watsonx'):
+            server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_for(service))
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name=f'fake-{service}', daemon=True).start()
+            self._servers.append(server)
+            self.urls[service] = f"http://127.0.0.1:{server.server_address[1]}"
+        return self
+
+    def stop(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers = []
+
+    def environment(self) -> dict:
+        """Environment variables that point config.py at the fake services."""
+        return {
+            'WATSON_DISCOVERY_APIKEY': 'fake-discovery-key',
+            'WATSON_DISCOVERY_URL': self.urls['discovery'],
+            'WATSON_DISCOVERY_PROJECT_ID': 'fake-project',
+            'WATSON_DISCOVERY_COLLECTION_ID': 'fake-collection',
+            'NATURAL_LANGUAGE_UNDERSTANDING_APIKEY': 'fake-nlu-key',
+            'NATURAL_LANGUAGE_UNDERSTANDING_URL': self.urls['nlu'],
+            'WATSONX_API_KEY': 'fake-watsonx-key',
+            'WATSONX_PROJECT_ID': 'fake-project',
+            'WATSONX_URL': self.urls['watsonx'],
+            'IAM_URL': self.urls['iam'],
+        }
+
+    # Payloads
+
+    def iam_token(self) -> dict:
+        now = int(time.time())
+        token = jwt.encode({'iat': now, 'exp': now + 3600, 'sub': 'benchmark'}, 'benchmark', algorithm='HS256')
+        return {'access_token': token, 'refresh_token': 'benchmark', 'token_type': 'Bearer',
+                'expires_in': 3600, 'expiration': now + 3600}
+
+    def discovery_query(self, body: dict) -> dict:
+        """
+        Query results honouring `count`, the `return` field projection and the
+        `passages` characters / max_per_document settings, like Discovery v2.
+        """
+        query = body.get('natural_language_query', '')
+        count = min(int(body.get('count') or self.results), self.results)
+        passage_settings = body.get('passages') or {}
+        passages = int(passage_settings.get('max_per_document') or self.passages)
+        passage_chars = int(passage_settings.get('characters') or self.passage_chars)
+        results = []
+        for i in range(count):
+            rng = _seeded(query, i)
+            document_id = hashlib.sha1(f"{query}-{i}".encode()).hexdigest()[:24]
+            results.append({
+                'document_id': document_id,
+                'result_metadata': {'collection_id': 'fake-collection', 'confidence': round(rng.uniform(0.2, 1), 4)},
+                'metadata': {'parent_document_id': document_id},
+                'extracted_metadata': {
+                    'filename': f"{document_id}.pdf",
+                    'file_type': 'pdf',
+                    'title': f"Document {i} for {query[:40]}",
+                    'author': rng.choice(['IBM', 'Unknown', 'Operations', 'Architecture']),
+                    'publicationdate': '2024-01-01',
+                },
+                'text': [_text(rng, self.document_chars)],
+                'document_passages': [
+                    {'passage_text': _text(rng, passage_chars), 'start_offset': 0,
+                     'end_offset': passage_chars, 'field': 'text'}
+                    for _ in range(passages)
+                ],
+            })
+        if body.get('return'):
+            results = [_project(result, body['return']) for result in results]
+        return {'matching_results': len(results), 'results': results, 'aggregations': []}
+
+    def nlu_analyze(self, body: dict) -> dict:
+        rng = _seeded(body.get('text', ''))
+        return {
+            'usage': {'text_units': 1, 'text_characters': len(body.get('text', '')), 'features': 1},
+            'language': 'en',
+            'categories': [{'score': round(rng.random(), 4), 'label': f"/{rng.choice(WORDS)}"} for _ in range(3)],
+        }
+
+    def answer_tokens_for(self, body: dict) -> list:
+        params = body.get('parameters') or {}
+        count = min(self.answer_tokens, int(params.get('max_new_tokens') or self.answer_tokens))
+        rng = _seeded(body.get('input', ''))
+        tokens = ['OVERVIEW\n\n   '] + [rng.choice(WORDS) + ' ' for _ in range(count)] + ['\n\nCONCLUSION\n\n   Done.']
+        return tokens
+
+    def _handler_for(self, service: str):
+        fakes = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are separate writes; with Nagle on, delayed ACKs add ~40ms per keep-alive call
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _read_body(self) -> bytes:
+                length = int(self.headers.get('Content-Length') or 0)
+                return self.rfile.read(length) if length else b''
+
+            def _send(self, status: int, payload, content_type: str = 'application/json') -> int:
+                data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                return len(data)
+
+            def do_GET(self):
+                # Cheap listing calls the app makes when prewarming a worker
+                started = time.perf_counter()
+                time.sleep(fakes.profiles[service].delay())
+                path = self.path.split('?', 1)[0]
+                status = 200
+                if service == 'discovery' and path.endswith('/collections'):
+                    sent = self._send(200, {'collections': [{'collection_id': 'fake-collection', 'name': 'fake'}]})
+                elif service == 'nlu' and path.endswith('/v1/models'):
+                    sent = self._send(200, {'models': []})
+                else:
+                    status = 404
+                    sent = self._send(404, {'code': 404, 'error': f'Unknown path {path}'})
+                fakes.log.record(service, time.perf_counter() - started, status, sent)
+
+            def do_POST(self):
+                started = time.perf_counter()
+                raw = self._read_body()
+                profile = fakes.profiles[service]
+                if profile.should_throttle():
+                    data = json.dumps({'code': 429, 'error': 'Too Many Requests'}).encode()
+                    self.send_response(429)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(data)))
+                    self.send_header('Retry-After', '1')
+                    self.end_headers()
+                    self.wfile.write(data)
+                    fakes.log.record(service, time.perf_counter() - started, 429, len(data))
+                    return
+                time.sleep(profile.delay())
+                if profile.should_fail():
+                    sent = self._send(500, {'code': 500, 'error': f'Injected {service} failure'})
+                    fakes.log.record(service, time.perf_counter() - started, 500, sent)
+                    return
+
+                path = self.path.split('?', 1)[0]
+                status, sent = 200, 0
+                if service == 'iam':
+                    sent = self._send(200, fakes.iam_token())
+                elif service == 'discovery' and path.endswith('/query'):
+                    sent = self._send(200, fakes.discovery_query(json.loads(raw or b'{}')))
+                elif service == 'discovery' and path.endswith('/documents'):
+                    status = 202
+                    sent = self._send(202, {'document_id': uuid.uuid4().hex, 'status': 'processing'})
+                elif service == 'nlu' and path.endswith('/analyze'):
+                    sent = self._send(200, fakes.nlu_analyze(json.loads(raw or b'{}')))
+                elif service == 'watsonx' and path.endswith('/generation_stream'):
+                    sent = self._stream_generation(json.loads(raw or b'{}'))
+                elif service == 'watsonx' and path.endswith('/generation'):
+                    body = json.loads(raw or b'{}')
+                    tokens = fakes.answer_tokens_for(body)
+                    sent = self._send(200, {'results': [{'generated_text': ''.join(tokens),
+                                                         'generated_token_count': len(tokens),
+                                                         'stop_reason': 'max_tokens'}]})
+                else:
+                    status = 404
+                    sent = self._send(404, {'code': 404, 'error': f'Unknown path {path}'})
+                fakes.log.record(service, time.perf_counter() - started, status, sent)
+
+            def _stream_generation(self, body: dict) -> int:
+                tokens = fakes.answer_tokens_for(body)
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                sent = 0
+                for token in tokens:
+                    event = f"data: {json.dumps({'results': [{'generated_text': token}]})}\n\n".encode()
+                    self.wfile.write(f"{len(event):x}\r\n".encode() + event + b"\r\n")
+                    sent += len(event)
+                self.wfile.write(b"0\r\n\r\n")
+                return sent
+
+        return Handler
+
+
+class WatsonxStandIn:
+    """
+    Minimal client with the generate_text / generate_text_stream interface of the
+    watsonx.ai `Model`, talking to the fake watsonx server over HTTP. The real SDK
+    only accepts IBM Cloud endpoints, so the harness registers this in its place.
+    """
+
+    def __init__(self, url: str, model_id: str = 'ibm/granite-3-8b-instruct'):
+        self.url = url
+        self.model_id = model_id
+        self.session = requests.Session()
+
+    def _body(self, prompt: str, params: dict) -> dict:
+        return {'model_id': self.model_id, 'input': prompt, 'parameters': params or {}}
+
+    def generate_text(self, prompt, params=None, **kwargs):
+        response = self.session.post(f"{self.url}/ml/v1/text/generation", json=self._body(prompt, params), timeout=60)
+        response.raise_for_status()
+        return response.json()['results'][0]['generated_text']
+
+    def generate_text_stream(self, prompt, params=None, **kwargs):
+        response = self.session.post(f"{self.url}/ml/v1/text/generation_stream",
+                                     json=self._body(prompt, params), stream=True, timeout=60)
+        response.raise_for_status()
+        for line in response.iter_lines(decode_unicode=True):
+            if line and line.startswith('data:'):
+                yield json.loads(line[5:])['results'][0]['generated_text']
@@ -0,0 +1,326 @@
+"""
+Offline benchmark for the /query and /upload pipelines.
+
+Starts the fake IBM services from benchmarks/fake_services.py, points config.py
+at them, serves the Flask app (or, with --asgi, the async app) on a local port and drives it under concurrent
+load. Reports throughput and p50/p95/p99 latency per endpoint, per pipeline
+stage (from the app's Server-Timing header) and per outbound service, with
+average payload sizes and JSON parse times, without any network access.
+
+    python -m benchmarks.run_benchmark --requests 200 --concurrency 16 --nlu-latency 40
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_services import FakeServices, ServiceProfile, WatsonxStandIn  # noqa: E402
+
+PASSPHRASE = 'benchmark'
+
+
+def percentile(values: list, pct: float) -> float:
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(name: str, seconds: list, failures: int = 0, wall: float = None, sizes: list = None) -> dict:
+    row = {
+        'stage': name,
+        'count': len(seconds),
+        'failures': failures,
+        'p50_ms': round(percentile(seconds, 50) * 1000, 2),
+        'p95_ms': round(percentile(seconds, 95) * 1000, 2),
+        'p99_ms': round(percentile(seconds, 99) * 1000, 2),
+    }
+    if wall:
+        row['throughput_rps'] = round(len(seconds) / wall, 2)
+    if sizes:
+        row['avg_kb'] = round(sum(sizes) / len(sizes) / 1024, 1)
+    return row
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=100, help='number of /query requests')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--distinct-queries', type=int, default=0,
+                        help='cycle through this many query texts (0 = every request is unique)')
+    parser.add_argument('--confidence-threshold', type=float, default=0)
+    parser.add_argument('--relevance-threshold', type=float, default=0.3)
+    parser.add_argument('--stream', action='store_true', help='drive /query/stream instead of /query')
+    parser.add_argument('--asgi', action='store_true',
+                        help='serve asgi:app under uvicorn (async /query and /upload) instead of the Flask app')
+    parser.add_argument('--uploads', type=int, default=0, help='number of files to push through /upload')
+    parser.add_argument('--upload-bytes', type=int, default=256 * 1024)
+    parser.add_argument('--upload-batch', type=int, default=4, help='files per /upload request')
+    for service, latency in (('discovery', 150), ('nlu', 40), ('watsonx', 800), ('iam', 50)):
+        parser.add_argument(f'--{service}-latency', type=float, default=latency, help='milliseconds')
+        parser.add_argument(f'--{service}-jitter', type=float, default=latency * 0.2, help='milliseconds')
+        parser.add_argument(f'--{service}-failure-rate', type=float, default=0.0)
+        parser.add_argument(f'--{service}-rate-limit', type=float, default=0.0,
+                            help='requests per second before the fake answers 429 (0 = unlimited)')
+    parser.add_argument('--results', type=int, default=20, help='Discovery results per query')
+    parser.add_argument('--passages', type=int, default=3, help='passages per Discovery result')
+    parser.add_argument('--passage-chars', type=int, default=300)
+    parser.add_argument('--document-chars', type=int, default=4000, help='size of each result\'s text field')
+    parser.add_argument('--answer-tokens', type=int, default=200)
+    parser.add_argument('--accept-encoding', default='br, gzip',
+                        help='Accept-Encoding sent with each query (identity for uncompressed responses)')
+    parser.add_argument('--full-results', action='store_true',
+                        help='ask Discovery for every result field (no DISCOVERY_RETURN_FIELDS projection)')
+    parser.add_argument('--prewarm', action='store_true',
+                        help='prewarm the app like a gunicorn worker with PREWARM_WORKERS before the load')
+    parser.add_argument('--json', help='also write the report to this file')
+    parser.add_argument('--verbose', action='store_true', help='keep the app\'s INFO logging')
+    return parser.parse_args(argv)
+
+
+def start_fakes(args) -> FakeServices:
+    def profile(service):
+        return ServiceProfile(getattr(args, f'{service}_latency'), getattr(args, f'{service}_jitter'),
+                              getattr(args, f'{service}_failure_rate'), getattr(args, f'{service}_rate_limit'))
+
+    return FakeServices(
+        discovery=profile('discovery'), nlu=profile('nlu'), watsonx=profile('watsonx'), iam=profile('iam'),
+        results=args.results, passages=args.passages, passage_chars=args.passage_chars,
+        document_chars=args.document_chars, answer_tokens=args.answer_tokens
+    ).start()
+
+
+def start_app(fakes: FakeServices, workdir: str, use_asgi: bool = False, prewarm: bool = False,
+              full_results: bool = False) -> tuple:
+    """
+    Configure the app for the fake services, serve it locally and return its base
+    URL with startup rows: the time to import the app and, with `prewarm`, to prewarm it.
+    """
+    os.environ.update(fakes.environment())
+    os.environ.update({
+        'APP_PASSPHRASE_HASH': PASSPHRASE,
+        'RELEVANCE_CACHE_PATH': os.path.join(workdir, 'relevance.sqlite3'),
+        'DISCOVERY_GENERATION_PATH': os.path.join(workdir, 'discovery.generation'),
+        'HISTORY_DB_PATH': os.path.join(workdir, 'history.sqlite3'),
+        'INGEST_DB_PATH': os.path.join(workdir, 'ingest.sqlite3'),
+        'UPLOAD_INDEX_PATH': os.path.join(workdir, 'uploads.sqlite3'),
+        'UPLOAD_SESSION_DB_PATH': os.path.join(workdir, 'uploads.sqlite3'),
+        'RATE_LIMIT_DIR': os.path.join(workdir, 'ratelimit'),
+        # The app's own outbound rate limits are off unless set explicitly, since the fakes only
+        # limit when given --<service>-rate-limit
+        'NLU_RATE_LIMIT': os.environ.get('NLU_RATE_LIMIT', '0'),
+        'DISCOVERY_RATE_LIMIT': os.environ.get('DISCOVERY_RATE_LIMIT', '0'),
+    })
+    if full_results:
+        os.environ['DISCOVERY_RETURN_FIELDS'] = ''
+    os.chdir(workdir)
+
+    from werkzeug.serving import make_server
+    from services.client_registry import registry
+    from config import ANSWER_ROUTES
+    started = time.perf_counter()
+    import app as app_module
+    startup = [summarize('startup: import app', [time.perf_counter() - started])]
+
+    app_module.app.config['UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+    os.makedirs(app_module.app.config['UPLOAD_FOLDER'], exist_ok=True)
+    for model_id in {route['model_id'] for route in ANSWER_ROUTES}:
+        registry.register(f"watsonx:{model_id}",
+                          lambda model_id=model_id: WatsonxStandIn(fakes.urls['watsonx'], model_id))
+    if prewarm:
+        from services.prewarm import prewarm as prewarm_worker
+        started = time.perf_counter()
+        prewarm_worker()
+        startup.append(summarize('startup: prewarm', [time.perf_counter() - started]))
+        fakes.log.clear()
+
+    if use_asgi:
+        import socket
+        import uvicorn
+        import asgi
+
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        config = uvicorn.Config(asgi.app, log_level='warning', lifespan='on')
+        server = uvicorn.Server(config)
+        threading.Thread(target=server.run, kwargs={'sockets': [sock]}, name='benchmark-app', daemon=True).start()
+        while not server.started:
+            time.sleep(0.01)
+        return f"http://127.0.0.1:{sock.getsockname()[1]}", startup
+
+    server = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='benchmark-app', daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", startup
+
+
+def parse_server_timing(header: str) -> dict:
+    """Return {metric: seconds} for the entries of a Server-Timing header that carry a duration."""
+    stages = {}
+    for entry in (header or '').split(','):
+        name, _, params = entry.strip().partition(';')
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'dur' and name:
+                stages[name] = float(value) / 1000
+    return stages
+
+
+def run_queries(base_url: str, args) -> tuple:
+    local = threading.local()
+    latencies, first_bytes, failures = [], [], [0]
+    wire_bytes, body_bytes, parse_seconds = [], [], []
+    stage_seconds = {}
+    lock = threading.Lock()
+    path = '/query/stream' if args.stream else '/query'
+
+    def one(i: int):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        n = i % args.distinct_queries if args.distinct_queries else i
+        payload = {
+            'query': f"How does benchmark scenario {n} handle cloud workload resilience?",
+            'confidence_threshold': args.confidence_threshold,
+            'relevance_threshold': args.relevance_threshold,
+        }
+        started = time.perf_counter()
+        response = session.post(base_url + path, json=payload, stream=args.stream, timeout=300,
+                                headers={'X-App-Passphrase': PASSPHRASE, 'Accept-Encoding': args.accept_encoding})
+        chunks = response.iter_content(chunk_size=None)
+        body = next(chunks, b'')
+        first_byte = time.perf_counter() - started
+        body += b''.join(chunks)
+        elapsed = time.perf_counter() - started
+        ok = response.status_code == 200 and (not args.stream or b'event: summary' in body)
+        parse = None
+        if ok and not args.stream:
+            parse_started = time.perf_counter()
+            json.loads(body)
+            parse = time.perf_counter() - parse_started
+        with lock:
+            latencies.append(elapsed)
+            first_bytes.append(first_byte)
+            # Bytes on the wire (compressed when the app compressed them) and once decoded
+            wire_bytes.append(int(response.headers.get('Content-Length') or len(body)))
+            body_bytes.append(len(body))
+            if parse is not None:
+                parse_seconds.append(parse)
+            for name, seconds in parse_server_timing(response.headers.get('Server-Timing')).items():
+                if name != 'total':
+                    stage_seconds.setdefault(name, []).append(seconds)
+            if not ok:
+                failures[0] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(one, range(args.requests)))
+    sizes = {'wire': wire_bytes, 'body': body_bytes, 'parse': parse_seconds}
+    return latencies, first_bytes, stage_seconds, failures[0], time.perf_counter() - started, sizes
+
+
+def run_uploads(base_url: str, args) -> list:
+    accept, ingest, failures = [], [], 0
+    headers = {'X-App-Passphrase': PASSPHRASE}
+    started = time.perf_counter()
+    jobs = []
+    for batch_start in range(0, args.uploads, args.upload_batch):
+        count = min(args.upload_batch, args.uploads - batch_start)
+        # Distinct content per file, otherwise deduplication would skip all but the first
+        files = [('file', (f"bench-{batch_start + i}.txt", os.urandom(args.upload_bytes), 'text/plain'))
+                 for i in range(count)]
+        t0 = time.perf_counter()
+        response = requests.post(base_url + '/upload', files=files, headers=headers, timeout=300)
+        accept.append(time.perf_counter() - t0)
+        if response.status_code != 202:
+            failures += count
+            continue
+        jobs.append((t0, response.json()['status_url']))
+
+    for t0, status_url in jobs:
+        while True:
+            job = requests.get(base_url + status_url, headers=headers, timeout=30).json()
+            if job['completed'] + job['duplicates'] + job['failed'] == job['total']:
+                ingest.append(time.perf_counter() - t0)
+                failures += job['failed']
+                break
+            time.sleep(0.05)
+    wall = time.perf_counter() - started
+    return [summarize('POST /upload (accept)', accept, wall=wall),
+            summarize('upload job (ingested)', ingest, failures=failures, wall=wall)]
+
+
+def discovery_parse(fakes: FakeServices, repeats: int = 50) -> dict:
+    """Time decoding one Discovery response as the app requests it (projection and passage settings)."""
+    from config import DISCOVERY_RESULT_COUNT
+    from services.ibm_services import discovery_query_options
+    body = dict(discovery_query_options(), natural_language_query='benchmark parse', count=DISCOVERY_RESULT_COUNT)
+    payload = json.dumps(fakes.discovery_query(body)).encode()
+    seconds = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        json.loads(payload)
+        seconds.append(time.perf_counter() - started)
+    return summarize('discovery response (parse)', seconds, sizes=[len(payload)])
+
+
+def print_report(rows: list):
+    columns = ['stage', 'count', 'failures', 'throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'avg_kb']
+    widths = {c: max(len(c), *(len(str(r.get(c, ''))) for r in rows)) for c in columns}
+    print('  '.join(c.ljust(widths[c]) for c in columns))
+    for row in rows:
+        print('  '.join(str(row.get(c, '')).ljust(widths[c]) for c in columns))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    fakes = start_fakes(args)
+    workdir = tempfile.mkdtemp(prefix='crag-bench-')
+    base_url, startup = start_app(fakes, workdir, args.asgi, args.prewarm, args.full_results)
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger('utils.logger').setLevel(logging.WARNING)
+
+    rows = list(startup)
+    if args.requests:
+        latencies, first_bytes, stage_seconds, failures, wall, sizes = run_queries(base_url, args)
+        path = '/query/stream' if args.stream else '/query'
+        rows.append(summarize(f"POST {path}", latencies, failures, wall, sizes['wire']))
+        rows.append(summarize(f"POST {path} (first byte)", first_bytes))
+        if sizes['parse']:
+            # Client-side JSON parse of the decoded body, whose size is reported alongside
+            rows.append(summarize(f"POST {path} (parse)", sizes['parse'], sizes=sizes['body']))
+        # Stage timings reported by the app itself through the Server-Timing header
+        for name, seconds in sorted(stage_seconds.items()):
+            rows.append(summarize(f"stage: {name}", seconds))
+    if args.uploads:
+        rows.extend(run_uploads(base_url, args))
+
+    rows.append(discovery_parse(fakes))
+    for service, entries in sorted(fakes.log.snapshot().items()):
+        failures = sum(1 for _, status, _ in entries if status >= 400)
+        rows.append(summarize(f"{service} (server-side)", [seconds for seconds, _, _ in entries], failures,
+                              sizes=[sent for _, _, sent in entries]))
+
+    print_report(rows)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'arguments': vars(args), 'stages': rows}, f, indent=2)
+    fakes.stop()
+    shutil.rmtree(workdir, ignore_errors=True)
+    return rows
+
+
+if __name__ == '__main__':
+    main()
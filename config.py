@@ -1,4 +1,5 @@
 import os
+import json
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -18,13 +19,25 @@ DISCOVERY_URL = get_env_var('WATSON_DISCOVERY_URL')
 DISCOVERY_PROJECT_ID = get_env_var('WATSON_DISCOVERY_PROJECT_ID')
 DISCOVERY_COLLECTION_ID = get_env_var('WATSON_DISCOVERY_COLLECTION_ID')
 
-NLU_API_KEY = get_env_var('NATURAL_LANGUAGE_UNDERSTANDING_APIKEY')
-NLU_URL = get_env_var('NATURAL_LANGUAGE_UNDERSTANDING_URL')
+# Optional IAM token endpoint override (defaults to the public IBM Cloud IAM service)
+IAM_URL = os.getenv('IAM_URL') or None
 
-# WatsonX.ai Credentials
-WATSONX_API_KEY = get_env_var('WATSONX_API_KEY')
-WATSONX_PROJECT_ID = get_env_var('WATSONX_PROJECT_ID')
-WATSONX_URL = get_env_var('WATSONX_URL')
+# Credentials of optional backends (NLU, watsonx.ai, OpenAI) are read on first access, so a
+# deployment only needs those of the backends it uses. Read them as `config.NAME` at call time.
+LAZY_CREDENTIALS = {
+    'NLU_API_KEY': 'NATURAL_LANGUAGE_UNDERSTANDING_APIKEY',
+    'NLU_URL': 'NATURAL_LANGUAGE_UNDERSTANDING_URL',
+    'WATSONX_API_KEY': 'WATSONX_API_KEY',
+    'WATSONX_PROJECT_ID': 'WATSONX_PROJECT_ID',
+    'WATSONX_URL': 'WATSONX_URL',
+    'OPENAI_API_KEY': 'OPENAI_API_KEY',
+}
+
+def __getattr__(name: str):
+    if name not in LAZY_CREDENTIALS:
+        raise AttributeError(f"module 'config' has no attribute '{name}'")
+    value = globals()[name] = get_env_var(LAZY_CREDENTIALS[name])
+    return value
 
 # Authorized Use PASS PHRASE
 APP_PASSPHRASE_HASH = get_env_var('APP_PASSPHRASE_HASH')  # Store actual passphrase server-side
@@ -37,3 +50,176 @@ ALLOWED_EXTENSIONS = {'txt', 'pdf', 'docx'}
 DISCOVERY_VERSION = '2021-08-01'
 NLU_VERSION = '2021-08-01'
 
+# Relevance scoring: max concurrent NLU calls per query and per-call timeout (seconds)
+NLU_MAX_WORKERS = int(os.getenv('NLU_MAX_WORKERS', '8'))
+NLU_CALL_TIMEOUT = float(os.getenv('NLU_CALL_TIMEOUT', '10'))
+
+# Outbound call resilience: per-attempt timeout and overall deadline (seconds) per service,
+# retries with jittered exponential backoff limited to RETRY_BUDGET_RATIO of recent calls,
+# and circuit breakers that fail fast for BREAKER_RESET_TIMEOUT seconds after
+# BREAKER_FAILURE_THRESHOLD consecutive failures
+DISCOVERY_TIMEOUT = float(os.getenv('DISCOVERY_TIMEOUT', '15'))
+DISCOVERY_DEADLINE = float(os.getenv('DISCOVERY_DEADLINE', '30'))
+NLU_DEADLINE = float(os.getenv('NLU_DEADLINE', '15'))
+WATSONX_TIMEOUT = float(os.getenv('WATSONX_TIMEOUT', '60'))
+WATSONX_DEADLINE = float(os.getenv('WATSONX_DEADLINE', '90'))
+OUTBOUND_MAX_RETRIES = int(os.getenv('OUTBOUND_MAX_RETRIES', '2'))
+OUTBOUND_RETRY_BACKOFF = float(os.getenv('OUTBOUND_RETRY_BACKOFF', '0.2'))
+RETRY_BUDGET_RATIO = float(os.getenv('RETRY_BUDGET_RATIO', '0.2'))
+RETRY_BUDGET_MIN_PER_SECOND = float(os.getenv('RETRY_BUDGET_MIN_PER_SECOND', '1'))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5'))
+BREAKER_RESET_TIMEOUT = float(os.getenv('BREAKER_RESET_TIMEOUT', '30'))
+
+# Outbound rate limiting for NLU and Discovery: a token bucket per service (calls per second
+# and burst; a rate of 0 disables it) shared by all workers through files in RATE_LIMIT_DIR,
+# and a per-worker concurrency limit that halves on 429s or latency spikes (calls slower than
+# AIMD_LATENCY_FACTOR times the recent average) and grows back by one slot per round of calls
+RATE_LIMIT_DIR = os.getenv('RATE_LIMIT_DIR', './cache/ratelimit')
+NLU_RATE_LIMIT = float(os.getenv('NLU_RATE_LIMIT', '50'))
+NLU_RATE_BURST = float(os.getenv('NLU_RATE_BURST', '50'))
+NLU_MAX_CONCURRENCY = int(os.getenv('NLU_MAX_CONCURRENCY', '16'))
+DISCOVERY_RATE_LIMIT = float(os.getenv('DISCOVERY_RATE_LIMIT', '20'))
+DISCOVERY_RATE_BURST = float(os.getenv('DISCOVERY_RATE_BURST', '20'))
+DISCOVERY_MAX_CONCURRENCY = int(os.getenv('DISCOVERY_MAX_CONCURRENCY', '8'))
+AIMD_MIN_CONCURRENCY = int(os.getenv('AIMD_MIN_CONCURRENCY', '1'))
+AIMD_LATENCY_FACTOR = float(os.getenv('AIMD_LATENCY_FACTOR', '3'))
+THROTTLE_MAX_RETRY_AFTER = float(os.getenv('THROTTLE_MAX_RETRY_AFTER', '5'))
+
+# Relevance engine: 'nlu' (NLU category score per passage), 'lexical' (local TF-IDF cosine,
+# no network calls) or 'hybrid' (RELEVANCE_HYBRID_WEIGHT * lexical + the rest * NLU).
+# Scores differ in scale between engines, so relevance thresholds may need retuning.
+RELEVANCE_ENGINE = os.getenv('RELEVANCE_ENGINE', 'nlu')
+RELEVANCE_HYBRID_WEIGHT = float(os.getenv('RELEVANCE_HYBRID_WEIGHT', '0.5'))
+
+# Relevance scoring mode: 'eager' scores every confidence-filtered document; 'lazy' scores
+# them in confidence order, stops once RELEVANCE_TOP_K documents qualify, and skips NLU
+# entirely (keeping Discovery's ranking) when no relevance threshold is requested
+RELEVANCE_SCORING_MODE = os.getenv('RELEVANCE_SCORING_MODE', 'eager')
+RELEVANCE_TOP_K = int(os.getenv('RELEVANCE_TOP_K', '10'))
+
+# Keep-alive connections per outbound service client (should cover NLU_MAX_CONCURRENCY and
+# DISCOVERY_MAX_CONCURRENCY, or surplus connections are dropped with "Connection pool is full")
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', str(max(10, NLU_MAX_WORKERS, NLU_MAX_CONCURRENCY,
+                                                         DISCOVERY_MAX_CONCURRENCY))))
+
+# Relevance score cache: in-process LRU tier backed by a SQLite file shared by all workers
+# (set RELEVANCE_CACHE_PATH to an empty string to keep the cache in-process only)
+RELEVANCE_CACHE_PATH = os.getenv('RELEVANCE_CACHE_PATH', './cache/relevance.sqlite3')
+RELEVANCE_CACHE_TTL = float(os.getenv('RELEVANCE_CACHE_TTL', str(7 * 24 * 3600)))
+RELEVANCE_CACHE_MAX_ENTRIES = int(os.getenv('RELEVANCE_CACHE_MAX_ENTRIES', '200000'))
+RELEVANCE_CACHE_MEMORY_ENTRIES = int(os.getenv('RELEVANCE_CACHE_MEMORY_ENTRIES', '10000'))
+
+# Discovery query payload: DISCOVERY_RESULT_COUNT results, each with only DISCOVERY_RETURN_FIELDS
+# (comma-separated; empty returns every field) plus its passages. Passages are about
+# DISCOVERY_PASSAGE_CHARACTERS long, DISCOVERY_PASSAGES_PER_DOCUMENT per result (0 keeps
+# Discovery's defaults), and at most DISCOVERY_MAX_PASSAGES per query are scored, taken from
+# the highest-ranked results first (0 for no limit)
+DISCOVERY_RESULT_COUNT = int(os.getenv('DISCOVERY_RESULT_COUNT', '20'))
+DISCOVERY_RETURN_FIELDS = [field.strip() for field in os.getenv(
+    'DISCOVERY_RETURN_FIELDS',
+    'document_id,result_metadata,extracted_metadata.title,extracted_metadata.author,extracted_metadata.filename'
+).split(',') if field.strip()]
+DISCOVERY_PASSAGE_CHARACTERS = int(os.getenv('DISCOVERY_PASSAGE_CHARACTERS', '0'))
+DISCOVERY_PASSAGES_PER_DOCUMENT = int(os.getenv('DISCOVERY_PASSAGES_PER_DOCUMENT', '0'))
+DISCOVERY_MAX_PASSAGES = int(os.getenv('DISCOVERY_MAX_PASSAGES', '0'))
+
+# Discovery query-result cache (in-process, bounded by entries and approximate bytes).
+# Uploads bump the collection generation stored in DISCOVERY_GENERATION_PATH so every
+# worker stops serving results cached before the ingest.
+DISCOVERY_CACHE_TTL = float(os.getenv('DISCOVERY_CACHE_TTL', '300'))
+DISCOVERY_CACHE_MAX_ENTRIES = int(os.getenv('DISCOVERY_CACHE_MAX_ENTRIES', '256'))
+DISCOVERY_CACHE_MAX_BYTES = int(os.getenv('DISCOVERY_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+DISCOVERY_GENERATION_PATH = os.getenv('DISCOVERY_GENERATION_PATH', './cache/discovery.generation')
+
+# Search history: ring buffer of HISTORY_CAPACITY entries per session, persisted to
+# HISTORY_DB_PATH (empty keeps it in-process); /query returns only the newest few entries
+HISTORY_DB_PATH = os.getenv('HISTORY_DB_PATH', './cache/history.sqlite3')
+HISTORY_CAPACITY = int(os.getenv('HISTORY_CAPACITY', '50'))
+HISTORY_MAX_SESSIONS = int(os.getenv('HISTORY_MAX_SESSIONS', '1000'))
+HISTORY_RESPONSE_LIMIT = int(os.getenv('HISTORY_RESPONSE_LIMIT', '5'))
+
+# Background ingestion for /upload: worker pool size, retries with exponential backoff
+# (base seconds), where job status is kept (empty keeps it in-process) and seconds it is kept for
+INGEST_DB_PATH = os.getenv('INGEST_DB_PATH', './cache/ingest.sqlite3')
+INGEST_JOB_TTL = float(os.getenv('INGEST_JOB_TTL', str(7 * 24 * 3600)))
+INGEST_MAX_WORKERS = int(os.getenv('INGEST_MAX_WORKERS', '2'))
+INGEST_MAX_RETRIES = int(os.getenv('INGEST_MAX_RETRIES', '3'))
+INGEST_RETRY_BACKOFF = float(os.getenv('INGEST_RETRY_BACKOFF', '2'))
+
+# Upload deduplication: index of uploaded content hashes to Discovery document IDs, so
+# identical files are not ingested twice (empty keeps it in-process)
+UPLOAD_INDEX_PATH = os.getenv('UPLOAD_INDEX_PATH', './cache/uploads.sqlite3')
+
+# Resumable chunked uploads: where unfinished uploads are tracked (empty keeps them
+# in-process), the largest chunk accepted in bytes, and seconds before an idle upload is dropped
+UPLOAD_SESSION_DB_PATH = os.getenv('UPLOAD_SESSION_DB_PATH', './cache/uploads.sqlite3')
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', str(8 * 1024 * 1024)))
+UPLOAD_SESSION_TTL = float(os.getenv('UPLOAD_SESSION_TTL', '86400'))
+
+# Prompt context packing: token budget for retrieved passages, Jaccard similarity above
+# which passages count as near-duplicates, and characters per token for estimates
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '3000'))
+CONTEXT_DEDUP_SIMILARITY = float(os.getenv('CONTEXT_DEDUP_SIMILARITY', '0.85'))
+CONTEXT_CHARS_PER_TOKEN = int(os.getenv('CONTEXT_CHARS_PER_TOKEN', '4'))
+
+# /query pages relevant_documents by documents_offset / documents_limit in the request body;
+# QUERY_DOCUMENTS_PAGE_SIZE is the limit when none is given (0 returns every document)
+QUERY_DOCUMENTS_PAGE_SIZE = int(os.getenv('QUERY_DOCUMENTS_PAGE_SIZE', '0'))
+QUERY_DOCUMENTS_MAX_PAGE_SIZE = int(os.getenv('QUERY_DOCUMENTS_MAX_PAGE_SIZE', '100'))
+
+# Response compression: JSON and text responses of at least RESPONSE_COMPRESSION_MIN_BYTES are
+# compressed with the first of RESPONSE_COMPRESSION (comma-separated, 'br' needs the brotli
+# package) the client accepts; empty disables compression
+RESPONSE_COMPRESSION = [encoding.strip() for encoding in os.getenv('RESPONSE_COMPRESSION', 'br,gzip').split(',')
+                        if encoding.strip()]
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.getenv('RESPONSE_COMPRESSION_MIN_BYTES', '1024'))
+
+# /query/batch: most queries accepted per request and how many run at once
+BATCH_MAX_QUERIES = int(os.getenv('BATCH_MAX_QUERIES', '200'))
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '4'))
+
+# Generated-answer cache keyed on model, generation params, query and packed context
+# (set ANSWER_CACHE_PATH to an empty string to keep the cache in-process only)
+ANSWER_CACHE_PATH = os.getenv('ANSWER_CACHE_PATH', './cache/answers.sqlite3')
+ANSWER_CACHE_TTL = float(os.getenv('ANSWER_CACHE_TTL', str(24 * 3600)))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', '5000'))
+ANSWER_CACHE_MEMORY_ENTRIES = int(os.getenv('ANSWER_CACHE_MEMORY_ENTRIES', '500'))
+
+# Answer backend: 'watsonx' or 'openai'. Its module, SDK and credentials are loaded when the
+# first answer is generated (or when a worker is prewarmed)
+ANSWER_BACKEND = os.getenv('ANSWER_BACKEND', 'watsonx')
+
+# Answer model routing: each query is answered by the first route whose limits fit its packed
+# context (estimated tokens) and query type (factoid, comparison, explanatory or general);
+# routes without limits match anything, and the last route is the fallback. JSON list of
+# {"name", "model_id", "max_new_tokens", "max_context_tokens" (optional), "query_types" (optional)}
+ANSWER_ROUTES = json.loads(os.getenv('ANSWER_ROUTES', json.dumps([
+    {"name": "brief", "model_id": "ibm/granite-3-2b-instruct", "max_new_tokens": 400,
+     "max_context_tokens": 800, "query_types": ["factoid"]},
+    {"name": "standard", "model_id": "ibm/granite-3-8b-instruct", "max_new_tokens": 900,
+     "max_context_tokens": 2000, "query_types": ["factoid", "general"]},
+    {"name": "comprehensive", "model_id": "ibm/granite-3-8b-instruct", "max_new_tokens": 1500},
+])))
+
+# Line the model is told to write after the CONCLUSION section; it is sent as a stop
+# sequence so generation ends with the answer (empty disables it)
+ANSWER_END_MARKER = os.getenv('ANSWER_END_MARKER', 'END OF ANSWER')
+
+# Metrics: each worker writes its snapshot to METRICS_DIR at most every METRICS_FLUSH_INTERVAL
+# seconds and /metrics merges them (empty METRICS_DIR reports only the serving process)
+METRICS_DIR = os.getenv('METRICS_DIR', './cache/metrics')
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '1'))
+
+# Request profiling (off by default): a request is profiled when it carries a valid passphrase
+# and an X-Profile-Token header equal to PROFILE_TOKEN (empty disables this), or when sampled at
+# PROFILE_SAMPLE_RATE (fraction of requests). PROFILE_DIR keeps the newest PROFILE_MAX_COUNT
+# profiles; stacks are sampled every PROFILE_SAMPLE_INTERVAL seconds
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN', '')
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', './cache/profiles')
+PROFILE_MAX_COUNT = int(os.getenv('PROFILE_MAX_COUNT', '50'))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.005'))
+
+# Worker prewarming (gunicorn.conf.py): after fork, each worker imports its backends, builds
+# its service clients, fetches IAM tokens and opens connections before taking requests
+PREWARM_WORKERS = os.getenv('PREWARM_WORKERS', 'false').lower() in ('1', 'true', 'yes')
@@ -0,0 +1,18 @@
+import os
+import tempfile
+
+# Modules read config at import. Unit tests get placeholder credentials and keep
+# their SQLite files and rate limit buckets out of ./cache.
+_scratch = tempfile.mkdtemp(prefix='crag-tests-')
+for name, value in {
+    'WATSON_DISCOVERY_APIKEY': 'test',
+    'WATSON_DISCOVERY_URL': 'http://127.0.0.1:9',
+    'WATSON_DISCOVERY_PROJECT_ID': 'test',
+    'WATSON_DISCOVERY_COLLECTION_ID': 'test',
+    'APP_PASSPHRASE_HASH': 'test',
+    'METRICS_DIR': '',
+    'RATE_LIMIT_DIR': '',
+    'UPLOAD_SESSION_DB_PATH': os.path.join(_scratch, 'uploads.sqlite3'),
+    'UPLOAD_INDEX_PATH': os.path.join(_scratch, 'uploads.sqlite3'),
+}.items():
+    os.environ.setdefault(name, value)
@@ -0,0 +1,25 @@
+"""
+gunicorn settings, loaded automatically from the working directory by both
+Procfile processes. Command-line flags (--bind, -k) still take precedence.
+
+Each worker records how long it took from fork to a loaded app and to being
+ready for traffic (crag_startup_seconds). With PREWARM_WORKERS enabled it
+also authenticates and connects to its services before its first request.
+"""
+import os
+
+
+def post_fork(server, worker):
+    from utils.startup import mark_forked
+    mark_forked()
+
+
+def post_worker_init(worker):
+    from config import PREWARM_WORKERS
+    from utils.startup import observe_startup, since_fork
+    observe_startup('app_load', 'app', since_fork())
+    if PREWARM_WORKERS:
+        from services.prewarm import prewarm
+        prewarm()
+    observe_startup('ready', 'worker', since_fork())
+    worker.log.info(f"Worker {os.getpid()} ready {since_fork():.2f}s after fork")
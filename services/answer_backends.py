@@ -0,0 +1,33 @@
+from config import ANSWER_BACKEND
+from utils.startup import import_timed
+
+# Answer backends by ANSWER_BACKEND name. Each module provides generate_answer,
+# stream_answer, clean_answer and prewarm, and is imported on first use so only
+# the selected backend's SDK and credentials are loaded.
+ANSWER_BACKENDS = {
+    'watsonx': 'services.watsonxai_service',
+    'openai': 'services.openai_service',
+}
+
+
+def get_backend(name: str = ANSWER_BACKEND):
+    """Return the module implementing the answer backend `name`, importing it on first use."""
+    if name not in ANSWER_BACKENDS:
+        raise ValueError(f"Unknown ANSWER_BACKEND {name!r}; expected one of {', '.join(ANSWER_BACKENDS)}")
+    return import_timed(ANSWER_BACKENDS[name])
+
+
+def generate_answer(query: str, formatted_results: list, packed_context: dict = None, use_cache: bool = True) -> str:
+    return get_backend().generate_answer(query, formatted_results, packed_context, use_cache=use_cache)
+
+
+def stream_answer(query: str, formatted_results: list, packed_context: dict = None, use_cache: bool = True):
+    return get_backend().stream_answer(query, formatted_results, packed_context, use_cache=use_cache)
+
+
+def clean_answer(text: str) -> str:
+    return get_backend().clean_answer(text)
+
+
+def prewarm():
+    get_backend().prewarm()
@@ -0,0 +1,75 @@
+import re
+from config import ANSWER_ROUTES, ANSWER_END_MARKER
+
+# Checked in order; a query matching none of them is 'general'
+QUERY_TYPE_PATTERNS = (
+    ('comparison', re.compile(r'\b(compare|comparison|versus|vs|difference|differences|differ|between)\b')),
+    ('explanatory', re.compile(r'\b(how|why|explain|describe|overview|summarize|summarise)\b')),
+    ('factoid', re.compile(r'^\s*(who|what|when|where|which|is|are|does|do|can)\b')),
+)
+
+# Factoid questions longer than this are treated as general
+FACTOID_MAX_WORDS = 12
+
+
+def classify_query(query: str) -> str:
+    """Classify a query as 'comparison', 'explanatory', 'factoid' or 'general' from its wording."""
+    text = (query or '').lower()
+    for query_type, pattern in QUERY_TYPE_PATTERNS:
+        if pattern.search(text):
+            if query_type == 'factoid' and len(text.split()) > FACTOID_MAX_WORDS:
+                return 'general'
+            return query_type
+    return 'general'
+
+
+def _matches(route: dict, context_tokens: int, query_type: str) -> bool:
+    max_tokens = route.get("max_context_tokens")
+    if max_tokens is not None and context_tokens > max_tokens:
+        return False
+    query_types = route.get("query_types")
+    return not query_types or query_type in query_types
+
+
+def select_route(query: str, packed_context: dict, routes: list = ANSWER_ROUTES) -> dict:
+    """Pick the first route that fits the packed context size and the query type; the last route otherwise."""
+    query_type = classify_query(query)
+    context_tokens = packed_context.get("tokens", 0)
+    for route in routes:
+        if _matches(route, context_tokens, query_type):
+            return route
+    return routes[-1]
+
+
+def strip_end_marker(text: str, marker: str = ANSWER_END_MARKER) -> str:
+    """Drop the end marker and anything generated after it."""
+    if marker:
+        cut = text.find(marker)
+        if cut >= 0:
+            return text[:cut].rstrip()
+    return text
+
+
+def until_end_marker(chunks, marker: str = ANSWER_END_MARKER):
+    """
+    Pass streamed chunks through up to the end marker. Text that could be the
+    start of the marker is held back until the next chunk shows whether it is,
+    so no part of the marker reaches the client. Stops reading at the marker.
+    """
+    if not marker:
+        yield from chunks
+        return
+    pending = ''
+    for chunk in chunks:
+        text = pending + chunk
+        cut = text.find(marker)
+        if cut >= 0:
+            if cut:
+                yield text[:cut]
+            return
+        keep = next((n for n in range(min(len(marker) - 1, len(text)), 0, -1) if marker.startswith(text[-n:])), 0)
+        pending = text[len(text) - keep:]
+        if len(text) > keep:
+            yield text[:len(text) - keep]
+    if pending:
+        yield pending
@@ -0,0 +1,361 @@
+import time
+import asyncio
+import logging
+import httpx
+from starlette.concurrency import run_in_threadpool
+import config
+from config import (DISCOVERY_API_KEY, DISCOVERY_URL, DISCOVERY_PROJECT_ID, DISCOVERY_COLLECTION_ID,
+                    DISCOVERY_VERSION, NLU_VERSION, NLU_MAX_WORKERS, NLU_CALL_TIMEOUT, IAM_URL, HTTP_POOL_SIZE,
+                    RELEVANCE_SCORING_MODE, RELEVANCE_TOP_K, DISCOVERY_TIMEOUT, WATSONX_TIMEOUT, ANSWER_BACKEND,
+                    DISCOVERY_RESULT_COUNT)
+from services import answer_backends
+from services.ibm_services import (relevance_cache, discovery_cache, collection_generation, complete_group_scores,
+                                   discovery_query_options, limit_passages)
+from services.query_pipeline import filter_by_confidence, build_document, note_unscored
+from services.relevance import get_relevance_engine, lexical_scores, split_groups
+from services.watsonxai_service import (generation_params, build_prompt, clean_answer, answer_cache,
+                                       answer_cache_key, observe_generation)
+from services.answer_routing import select_route, strip_end_marker
+from services.context_packer import pack_context
+from utils.cache import cache_key, hash_key, normalize_text
+from utils.logger import logger
+from utils.metrics import stage, count_call, count_filtered
+from utils.resilience import get_policy, ServiceUnavailable
+
+DEFAULT_IAM_URL = 'https://iam.cloud.ibm.com'
+WATSONX_API_VERSION = '2023-05-29'
+
+# httpx logs every request at INFO; keep the app's log readable
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
+
+class AsyncIAMToken:
+    """IAM bearer token for one API key, refreshed at 80% of its lifetime."""
+
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+        self._token = None
+        self._refresh_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def get(self, client: httpx.AsyncClient) -> str:
+        if self._token and time.time() < self._refresh_at:
+            return self._token
+        async with self._lock:
+            if self._token and time.time() < self._refresh_at:
+                return self._token
+            response = await client.post(
+                f"{IAM_URL or DEFAULT_IAM_URL}/identity/token",
+                data={'grant_type': 'urn:ibm:params:oauth:grant-type:apikey', 'apikey': self.api_key},
+                headers={'Accept': 'application/json'}
+            )
+            response.raise_for_status()
+            data = response.json()
+            self._token = data['access_token']
+            self._refresh_at = time.time() + data.get('expires_in', 3600) * 0.8
+            return self._token
+
+
+class AsyncClients:
+    """
+    Shared non-blocking HTTP client and IAM tokens for one event loop.
+    Keys used by more than one service share a single token.
+    """
+
+    def __init__(self):
+        self.http = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=HTTP_POOL_SIZE * 4, max_keepalive_connections=HTTP_POOL_SIZE),
+            timeout=httpx.Timeout(60.0)
+        )
+        self._tokens = {}
+
+    async def auth_headers(self, api_key: str) -> dict:
+        token = self._tokens.get(api_key)
+        if token is None:
+            token = self._tokens[api_key] = AsyncIAMToken(api_key)
+        return {'Authorization': f"Bearer {await token.get(self.http)}", 'Accept': 'application/json'}
+
+    async def close(self):
+        await self.http.aclose()
+
+
+_clients = None
+
+
+def get_async_clients() -> AsyncClients:
+    """Return the clients for the running event loop, creating them on first use."""
+    global _clients
+    if _clients is None:
+        _clients = AsyncClients()
+    return _clients
+
+
+async def close_async_clients():
+    global _clients
+    if _clients is not None:
+        await _clients.close()
+        _clients = None
+
+
+async def query_discovery(query: str, start_date: str = None, end_date: str = None,
+                          count: int = DISCOVERY_RESULT_COUNT):
+    """Query the Discovery collection without blocking; shares the sync path's result cache."""
+    filters = []
+    if start_date:
+        filters.append(f"date>={start_date}")
+    if end_date:
+        filters.append(f"date<={end_date}")
+    filter_query = ' AND '.join(filters) if filters else None
+
+    # The generation lives in a file shared by all workers
+    generation = await run_in_threadpool(collection_generation.current)
+    key = hash_key(generation, normalize_text(query), filter_query, count)
+    cached = discovery_cache.get(key)
+    if cached is not None:
+        return cached
+
+    clients = get_async_clients()
+    body = dict(discovery_query_options(), natural_language_query=query, count=count)
+    if filter_query:
+        body['filter'] = filter_query
+
+    async def run_query():
+        count_call('discovery')
+        response = await clients.http.post(
+            f"{DISCOVERY_URL}/v2/projects/{DISCOVERY_PROJECT_ID}/query",
+            params={'version': DISCOVERY_VERSION},
+            json=body,
+            headers=await clients.auth_headers(DISCOVERY_API_KEY),
+            timeout=DISCOVERY_TIMEOUT
+        )
+        response.raise_for_status()
+        return response.json()
+
+    result = limit_passages(await get_policy('discovery').call_async(run_query))
+    discovery_cache.set(key, result)
+    return result
+
+
+async def add_document_to_discovery(file_path: str, filename: str):
+    """Add a document to the Discovery collection and bump the collection generation."""
+    clients = get_async_clients()
+
+    async def add():
+        count_call('discovery')
+        with open(file_path, 'rb') as file_data:
+            response = await clients.http.post(
+                f"{DISCOVERY_URL}/v2/projects/{DISCOVERY_PROJECT_ID}/collections/{DISCOVERY_COLLECTION_ID}/documents",
+                params={'version': DISCOVERY_VERSION},
+                files={'file': (filename, file_data, 'application/octet-stream')},
+                headers=await clients.auth_headers(DISCOVERY_API_KEY),
+                timeout=DISCOVERY_TIMEOUT
+            )
+        response.raise_for_status()
+        return response.json()
+
+    # The ingestion queue retries uploads with its own backoff
+    result = await get_policy('discovery').call_async(add, retry=False)
+    # bump() takes a file lock other workers may hold
+    await run_in_threadpool(collection_generation.bump)
+    return result
+
+
+async def _nlu_relevance(clients: AsyncClients, query: str, passage: str) -> float:
+    async def analyze():
+        count_call('nlu')
+        response = await clients.http.post(
+            f"{config.NLU_URL}/v1/analyze",
+            params={'version': NLU_VERSION},
+            json={'text': f"{query} {passage}", 'features': {'categories': {'limit': 3}}},
+            headers=await clients.auth_headers(config.NLU_API_KEY),
+            timeout=NLU_CALL_TIMEOUT
+        )
+        response.raise_for_status()
+        return response.json()
+
+    result = await get_policy('nlu').call_async(analyze)
+    if result.get('categories'):
+        return result['categories'][0]['score']
+    return 0.0
+
+
+async def _score_and_cache(clients: AsyncClients, slots: asyncio.Semaphore, query: str, passage: str,
+                           key: str):
+    async with slots:
+        try:
+            score = await _nlu_relevance(clients, query, passage)
+        except ServiceUnavailable as e:
+            logger.warning(f"NLU relevance unavailable: {e}")
+            return None
+        except Exception as e:
+            logger.warning(f"NLU relevance calculation failed: {e}")
+            return 0.0
+    await run_in_threadpool(relevance_cache.set, key, score)
+    return score
+
+
+def _cached_scores(query: str, groups: list) -> tuple:
+    scores = [[None] * len(group) for group in groups]
+    pending = []
+    for g, group in enumerate(groups):
+        for i, passage in enumerate(group):
+            if not passage:
+                scores[g][i] = 0.0
+                continue
+            key = cache_key(query, passage)
+            cached = relevance_cache.get(key)
+            if cached is not None:
+                scores[g][i] = cached
+            else:
+                pending.append((g, i, key))
+    return scores, pending
+
+
+async def score_passage_groups(query: str, groups: list) -> list:
+    """
+    Score groups of passages concurrently, at most NLU_MAX_WORKERS calls in flight per request.
+    Groups that cannot be fully scored while NLU is unavailable come back as None.
+    """
+    # The shared cache may hit the on-disk tier, so resolve it off the event loop
+    scores, pending = await run_in_threadpool(_cached_scores, query, groups)
+    if pending and not get_policy('nlu').available():
+        for g, _, _ in pending:
+            scores[g] = None
+        return [complete_group_scores(group) for group in scores]
+    clients = get_async_clients()
+    slots = asyncio.Semaphore(NLU_MAX_WORKERS)
+    computed = await asyncio.gather(*(
+        _score_and_cache(clients, slots, query, groups[g][i], key) for g, i, key in pending
+    ))
+    for (g, i, _), score in zip(pending, computed):
+        scores[g][i] = score
+    return [complete_group_scores(group) for group in scores]
+
+
+async def score_groups(query: str, groups: list) -> list:
+    """Score groups of passages with the configured relevance engine."""
+    engine = get_relevance_engine()
+    if engine.name == 'nlu':
+        return await score_passage_groups(query, groups)
+    if engine.name not in ('lexical', 'hybrid'):
+        # Custom engines only provide the blocking interface
+        return await run_in_threadpool(lambda: list(engine.score_groups(query, groups)))
+    lexical = split_groups(lexical_scores(query, [p for group in groups for p in group]).tolist(), groups)
+    if engine.name == 'lexical':
+        return lexical
+    nlu = await score_passage_groups(query, groups)
+    return [engine.blend(a, b) for a, b in zip(lexical, nlu)]
+
+
+def _qualify(candidates: list, groups: list, all_scores: list, relevance_threshold: float,
+             unscored: list = None) -> list:
+    documents = []
+    for (result, confidence_value), group, passage_scores in zip(candidates, groups, all_scores):
+        document = build_document(result, confidence_value, passage_scores, relevance_threshold)
+        if passage_scores is None:
+            note_unscored(unscored, result, confidence_value, document is not None)
+        if document is None:
+            count_filtered('documents', 'relevance')
+            count_filtered('passages', 'relevance', len(group))
+            continue
+        count_filtered('passages', 'relevance', len(group) - len(document["passages"]))
+        documents.append(document)
+    return documents
+
+
+async def _lazy_documents(query: str, candidates: list, relevance_threshold: float, top_k: int,
+                          unscored: list = None) -> list:
+    """Async counterpart of query_pipeline.iter_lazy_documents."""
+    candidates = sorted(candidates, key=lambda c: c[1], reverse=True)
+    if relevance_threshold <= 0:
+        documents = []
+        for position, (result, confidence_value) in enumerate(candidates):
+            note_unscored(unscored, result, confidence_value, position < top_k)
+            if position < top_k:
+                document = build_document(result, confidence_value, None, relevance_threshold)
+                if document is not None:
+                    documents.append(document)
+        count_filtered('documents', 'top_k', max(0, len(candidates) - top_k))
+        return documents
+
+    documents = []
+    position = 0
+    with stage('relevance'):
+        while position < len(candidates) and len(documents) < top_k:
+            window = candidates[position:position + top_k - len(documents)]
+            position += len(window)
+            groups = [[p.get("passage_text", "") for p in result.get("document_passages", [])]
+                      for result, _ in window]
+            documents.extend(_qualify(window, groups, await score_groups(query, groups),
+                                      relevance_threshold, unscored))
+    for result, confidence_value in candidates[position:]:
+        note_unscored(unscored, result, confidence_value, False)
+    count_filtered('documents', 'top_k', len(candidates) - position)
+    return documents
+
+
+async def find_relevant_documents(query: str, start_date: str, end_date: str,
+                                  confidence_threshold: float, relevance_threshold: float,
+                                  unscored: list = None) -> list:
+    """Async counterpart of query_pipeline.find_relevant_documents with the same filtering."""
+    with stage('discovery'):
+        discovery_response = await query_discovery(query, start_date, end_date)
+    results = discovery_response.get("results", [])
+
+    candidates = filter_by_confidence(results, confidence_threshold)
+    count_filtered('documents', 'confidence', len(results) - len(candidates))
+    if RELEVANCE_SCORING_MODE == 'lazy':
+        return await _lazy_documents(query, candidates, relevance_threshold, RELEVANCE_TOP_K, unscored)
+
+    groups = [[p.get("passage_text", "") for p in result.get("document_passages", [])] for result, _ in candidates]
+    with stage('relevance'):
+        all_scores = await score_groups(query, groups)
+    return _qualify(candidates, groups, all_scores, relevance_threshold, unscored)
+
+
+async def generate_answer(query: str, formatted_results: list, packed_context: dict = None,
+                          use_cache: bool = True) -> str:
+    """
+    Generate the answer through the watsonx.ai REST API without blocking the event loop.
+    Raises ServiceUnavailable when watsonx.ai is unhealthy. Other answer backends
+    run their blocking client in the thread pool.
+    """
+    if ANSWER_BACKEND != 'watsonx':
+        return await run_in_threadpool(answer_backends.generate_answer, query, formatted_results,
+                                       packed_context, use_cache)
+    try:
+        if packed_context is None:
+            packed_context = pack_context(formatted_results)
+        route = select_route(query, packed_context)
+        key = answer_cache_key(query, packed_context, route)
+        if use_cache:
+            cached = await run_in_threadpool(answer_cache.get, key)
+            if cached is not None:
+                return clean_answer(cached)
+
+        clients = get_async_clients()
+        prompt = build_prompt(query, formatted_results, packed_context)
+
+        async def generate():
+            count_call('watsonx')
+            response = await clients.http.post(
+                f"{config.WATSONX_URL}/ml/v1/text/generation",
+                params={'version': WATSONX_API_VERSION},
+                json={'model_id': route["model_id"], 'input': prompt, 'parameters': generation_params(route),
+                      'project_id': config.WATSONX_PROJECT_ID},
+                headers=await clients.auth_headers(config.WATSONX_API_KEY),
+                timeout=WATSONX_TIMEOUT
+            )
+            response.raise_for_status()
+            return response.json()
+
+        started = time.perf_counter()
+        response = await get_policy('watsonx').call_async(generate)
+        observe_generation(route, 'blocking', time.perf_counter() - started)
+        result = strip_end_marker(response["results"][0]["generated_text"].strip())
+        await run_in_threadpool(answer_cache.set, key, result)
+        return clean_answer(result)
+    except ServiceUnavailable:
+        raise
+    except Exception as e:
+        return f"I apologize, but an error occurred while generating the response: {str(e)}"
@@ -0,0 +1,80 @@
+import os
+import threading
+from utils.logger import logger
+from utils.metrics import metrics
+
+
+class ClientRegistry:
+    """
+    Process-wide registry of long-lived service clients.
+
+    Each client is built once per worker process by its registered factory and
+    then reused by every request and thread. The registry forgets all clients
+    after a fork so gunicorn workers never share sockets with the master.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._factories = {}
+        self._clients = {}
+        self._counters = {}
+        self._pid = os.getpid()
+
+    def register(self, name: str, factory):
+        """Register the factory used to build the client called `name`."""
+        with self._lock:
+            self._factories[name] = factory
+            self._counters.setdefault(name, {'created': 0, 'reused': 0})
+
+    def get(self, name: str, factory=None):
+        """
+        Return the shared client called `name`, creating it on first use.
+        A `factory` may be given to register `name` on the fly.
+        """
+        if self._pid != os.getpid():
+            self._reset_after_fork()
+        if factory is not None and name not in self._factories:
+            self.register(name, factory)
+        client = self._clients.get(name)
+        if client is not None:
+            with self._lock:
+                self._counters[name]['reused'] += 1
+            return client
+        with self._lock:
+            client = self._clients.get(name)
+            if client is None:
+                client = self._factories[name]()
+                self._clients[name] = client
+                self._counters[name]['created'] += 1
+                logger.info(f"Created {name} client in process {self._pid}")
+            else:
+                self._counters[name]['reused'] += 1
+            return client
+
+    def discard(self, name: str):
+        """Drop a client so the next `get` builds a fresh one."""
+        with self._lock:
+            self._clients.pop(name, None)
+
+    def stats(self) -> dict:
+        """Return per-client creation and reuse counters for this process."""
+        with self._lock:
+            return {name: dict(counts) for name, counts in self._counters.items()}
+
+    def _reset_after_fork(self):
+        self._lock = threading.RLock()
+        self._clients = {}
+        self._counters = {name: {'created': 0, 'reused': 0} for name in self._factories}
+        self._pid = os.getpid()
+
+
+registry = ClientRegistry()
+metrics.describe('crag_clients_total', 'Service client lookups by outcome (created or reused)')
+metrics.register_collector(lambda: [
+    ('counter', 'crag_clients_total', {'client': name, 'outcome': outcome}, count)
+    for name, counts in registry.stats().items() if not name.startswith('iam-')
+    for outcome, count in counts.items()
+])
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=registry._reset_after_fork)
@@ -0,0 +1,92 @@
+from config import CONTEXT_TOKEN_BUDGET, CONTEXT_DEDUP_SIMILARITY, CONTEXT_CHARS_PER_TOKEN
+from utils.cache import normalize_text
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate the model token count of a text from its length."""
+    return max(1, len(text) // CONTEXT_CHARS_PER_TOKEN) if text else 0
+
+
+def _shingles(words: list, size: int = 3) -> set:
+    if len(words) < size:
+        return {tuple(words)}
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def _is_near_duplicate(shingles: set, kept: list, threshold: float) -> bool:
+    for other in kept:
+        union = len(shingles | other)
+        if union and len(shingles & other) / union >= threshold:
+            return True
+    return False
+
+
+def pack_context(formatted_results: list, token_budget: int = CONTEXT_TOKEN_BUDGET,
+                 similarity_threshold: float = CONTEXT_DEDUP_SIMILARITY) -> dict:
+    """
+    Build the prompt context from the relevant documents within a token budget.
+
+    Passages are ranked by their relevance score, exact and near-duplicate
+    passages are dropped, and packing stops at the first passage that would
+    exceed the budget. Returns the context text with packing statistics.
+    """
+    ranked = []
+    for doc_index, result in enumerate(formatted_results):
+        passages = result.get("passages", [])
+        scores = result.get("passage_scores") or [0.0] * len(passages)
+        for passage_index, (passage, score) in enumerate(zip(passages, scores)):
+            ranked.append((-score, doc_index, passage_index, passage))
+    ranked.sort()
+
+    header = "Relevant Documents and Passages:\n"
+    used_tokens = estimate_tokens(header)
+    kept = {}
+    kept_shingles = []
+    seen = set()
+    duplicates = 0
+    truncated = False
+    for _, doc_index, passage_index, passage in ranked:
+        normalized = normalize_text(passage)
+        shingles = _shingles(normalized.split())
+        if normalized in seen or _is_near_duplicate(shingles, kept_shingles, similarity_threshold):
+            duplicates += 1
+            continue
+
+        cost = estimate_tokens(f"Content: {passage}\n")
+        if doc_index not in kept:
+            result = formatted_results[doc_index]
+            cost += estimate_tokens(f"Document: {result.get('title', 'No Title')} "
+                                    f"(Author: {result.get('author', 'Unknown')})\n")
+        if used_tokens + cost > token_budget:
+            truncated = True
+            break
+
+        used_tokens += cost
+        seen.add(normalized)
+        kept_shingles.append(shingles)
+        kept.setdefault(doc_index, []).append(passage_index)
+
+    # Documents keep their ranked order; passages keep their order within the document
+    lines = [header]
+    for doc_index, passage_indexes in kept.items():
+        result = formatted_results[doc_index]
+        title = result.get('title', 'No Title')
+        author = result.get('author', 'Unknown')
+        lines.append(f"Document: {title} (Author: {author})\n")
+        for passage_index in sorted(passage_indexes):
+            lines.append(f"Content: {result['passages'][passage_index]}\n")
+
+    return {
+        "text": "".join(lines),
+        "tokens": used_tokens,
+        "token_budget": token_budget,
+        "passages_kept": sum(len(indexes) for indexes in kept.values()),
+        "passages_total": len(ranked),
+        "duplicates_dropped": duplicates,
+        "truncated": truncated
+    }
+
+
+def context_stats(packed: dict) -> dict:
+    """Return the packing statistics without the context text, for API responses."""
+    return {key: value for key, value in packed.items() if key != "text"}
@@ -1,41 +1,173 @@
 import os
-from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
-from ibm_watson import DiscoveryV2, NaturalLanguageUnderstandingV1
-from ibm_watson.natural_language_understanding_v1 import Features, CategoriesOptions
+import hashlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import config
 from config import (DISCOVERY_API_KEY, DISCOVERY_URL, DISCOVERY_PROJECT_ID,
-                    DISCOVERY_COLLECTION_ID, NLU_API_KEY, NLU_URL, DISCOVERY_VERSION, NLU_VERSION)
+                    DISCOVERY_COLLECTION_ID, DISCOVERY_VERSION, NLU_VERSION,
+                    IAM_URL, NLU_MAX_WORKERS, NLU_CALL_TIMEOUT, HTTP_POOL_SIZE,
+                    RELEVANCE_CACHE_PATH, RELEVANCE_CACHE_TTL, RELEVANCE_CACHE_MAX_ENTRIES,
+                    RELEVANCE_CACHE_MEMORY_ENTRIES, DISCOVERY_CACHE_TTL, DISCOVERY_CACHE_MAX_ENTRIES,
+                    DISCOVERY_CACHE_MAX_BYTES, DISCOVERY_GENERATION_PATH, DISCOVERY_TIMEOUT,
+                    DISCOVERY_RESULT_COUNT, DISCOVERY_RETURN_FIELDS, DISCOVERY_PASSAGE_CHARACTERS,
+                    DISCOVERY_PASSAGES_PER_DOCUMENT, DISCOVERY_MAX_PASSAGES)
+from services.client_registry import registry
+from utils.cache import build_tiered_cache, cache_key, hash_key, normalize_text, LRUCache, GenerationCounter
 from utils.logger import logger
+from utils.metrics import metrics, count_call, mark_degraded
+from utils.profiling import for_request
+from utils.resilience import get_policy, ServiceUnavailable
+from utils.singleflight import SingleFlight
+from utils.startup import import_timed
 
+# Relevance scores keyed by the normalized (query, passage) pair, shared across workers
+relevance_cache = build_tiered_cache(
+    RELEVANCE_CACHE_PATH,
+    memory_entries=RELEVANCE_CACHE_MEMORY_ENTRIES,
+    max_entries=RELEVANCE_CACHE_MAX_ENTRIES,
+    ttl=RELEVANCE_CACHE_TTL,
+    table='relevance'
+)
 
-def get_discovery_client():
-    """Initialize and return the IBM Discovery client."""
-    authenticator = IAMAuthenticator(DISCOVERY_API_KEY)
-    discovery = DiscoveryV2(version=DISCOVERY_VERSION, authenticator=authenticator)
+# Discovery query results, versioned by a collection generation bumped on every ingest
+discovery_cache = LRUCache(DISCOVERY_CACHE_MAX_ENTRIES, DISCOVERY_CACHE_TTL, max_bytes=DISCOVERY_CACHE_MAX_BYTES)
+collection_generation = GenerationCounter(DISCOVERY_GENERATION_PATH)
+
+# Concurrent misses for the same (query, passage) pair, e.g. from overlapping queries
+# of a batch, share one NLU call
+relevance_flight = SingleFlight('relevance', wait_stage=None)
+
+
+def _cache_samples():
+    samples = []
+    for name, cache in (('relevance', relevance_cache.memory), ('discovery', discovery_cache)):
+        stats = cache.stats()
+        samples.append(('counter', 'crag_cache_requests_total', {'cache': name, 'result': 'hit'}, stats['hits']))
+        samples.append(('counter', 'crag_cache_requests_total', {'cache': name, 'result': 'miss'}, stats['misses']))
+        samples.append(('gauge', 'crag_cache_entries', {'cache': name}, stats['entries']))
+    if relevance_cache.disk is not None:
+        stats = relevance_cache.disk.stats()
+        samples.append(('counter', 'crag_cache_requests_total', {'cache': 'relevance_disk', 'result': 'hit'}, stats['hits']))
+        samples.append(('counter', 'crag_cache_requests_total', {'cache': 'relevance_disk', 'result': 'miss'}, stats['misses']))
+    return samples
+
+
+metrics.describe('crag_cache_requests_total', 'Cache lookups by cache and result')
+metrics.describe('crag_cache_entries', 'Entries held in each worker\'s in-process caches')
+metrics.register_collector(_cache_samples)
+
+
+def get_authenticator(api_key: str):
+    """
+    Return the shared IAM authenticator for an API key.
+    The authenticator caches its token until it expires, so every client
+    built from the same key reuses one token instead of negotiating its own.
+    """
+    name = 'iam-' + hashlib.sha256(api_key.encode()).hexdigest()[:12]
+    authenticators = import_timed('ibm_cloud_sdk_core.authenticators')
+    return registry.get(name, factory=lambda: authenticators.IAMAuthenticator(api_key, url=IAM_URL))
+
+def _use_keep_alive_pool(client):
+    """Mount a keep-alive connection pool sized by HTTP_POOL_SIZE on an SDK client."""
+    adapter = import_timed('ibm_cloud_sdk_core.http_adapter').SSLHTTPAdapter(
+        pool_connections=HTTP_POOL_SIZE,
+        pool_maxsize=HTTP_POOL_SIZE,
+        max_retries=client.retry_config or 0,
+        _disable_ssl_verification=client.disable_ssl_verification
+    )
+    client.http_adapter = adapter
+    client.http_client.mount('http://', adapter)
+    client.http_client.mount('https://', adapter)
+
+# The ibm_watson SDK is imported when the first client is built, not with this module
+def _create_discovery_client():
+    discovery_v2 = import_timed('ibm_watson.discovery_v2')
+    discovery = discovery_v2.DiscoveryV2(version=DISCOVERY_VERSION, authenticator=get_authenticator(DISCOVERY_API_KEY))
     discovery.set_service_url(DISCOVERY_URL)
+    discovery.set_http_config({'timeout': DISCOVERY_TIMEOUT})
+    _use_keep_alive_pool(discovery)
     return discovery
 
-def get_nlu_client():
-    """Initialize and return the IBM NLU client."""
-    authenticator = IAMAuthenticator(NLU_API_KEY)
-    nlu = NaturalLanguageUnderstandingV1(version=NLU_VERSION, authenticator=authenticator)
-    nlu.set_service_url(NLU_URL)
+def _create_nlu_client():
+    nlu_v1 = import_timed('ibm_watson.natural_language_understanding_v1')
+    nlu = nlu_v1.NaturalLanguageUnderstandingV1(version=NLU_VERSION,
+                                                authenticator=get_authenticator(config.NLU_API_KEY))
+    nlu.set_service_url(config.NLU_URL)
+    nlu.set_http_config({'timeout': NLU_CALL_TIMEOUT})
+    _use_keep_alive_pool(nlu)
     return nlu
 
+registry.register('discovery', _create_discovery_client)
+registry.register('nlu', _create_nlu_client)
+
+def get_discovery_client():
+    """Return the shared IBM Discovery client for this process."""
+    return registry.get('discovery')
+
+def get_nlu_client():
+    """Return the shared IBM NLU client for this process."""
+    return registry.get('nlu')
+
 def add_document_to_discovery(file_path: str, filename: str):
-    """Add a document to the Discovery collection."""
+    """
+    Add a document to the Discovery collection.
+    On success the collection generation is bumped so cached query results are not reused.
+    Not retried here: the ingestion queue retries uploads with its own backoff.
+    """
     discovery = get_discovery_client()
-    with open(file_path, 'rb') as file_data:
-        response = discovery.add_document(
-            project_id=DISCOVERY_PROJECT_ID,
-            collection_id=DISCOVERY_COLLECTION_ID,
-            file=file_data,
-            filename=filename
-        ).get_result()
+
+    def add():
+        count_call('discovery')
+        with open(file_path, 'rb') as file_data:
+            return discovery.add_document(
+                project_id=DISCOVERY_PROJECT_ID,
+                collection_id=DISCOVERY_COLLECTION_ID,
+                file=file_data,
+                filename=filename
+            ).get_result()
+
+    response = get_policy('discovery').call(add, retry=False)
+    collection_generation.bump()
     return response
 
-def query_discovery(query: str, start_date: str = None, end_date: str = None, count: int = 20):
-    """Query the Discovery collection."""
-    discovery = get_discovery_client()
+def discovery_query_options() -> dict:
+    """The `return` projection and `passages` settings sent with every Discovery query."""
+    options = {}
+    if DISCOVERY_RETURN_FIELDS:
+        options['return'] = DISCOVERY_RETURN_FIELDS
+    passages = {}
+    if DISCOVERY_PASSAGE_CHARACTERS:
+        passages['characters'] = DISCOVERY_PASSAGE_CHARACTERS
+    if DISCOVERY_PASSAGES_PER_DOCUMENT:
+        passages['per_document'] = True
+        passages['max_per_document'] = DISCOVERY_PASSAGES_PER_DOCUMENT
+    if passages:
+        options['passages'] = dict(passages, enabled=True)
+    return options
+
+def limit_passages(response: dict, max_passages: int = DISCOVERY_MAX_PASSAGES) -> dict:
+    """
+    Keep at most `max_passages` passages across the results, in ranking order, so
+    every later stage (scoring, packing, the response) handles a bounded amount.
+    Results left without passages are dropped by the relevance filter.
+    """
+    results = response.get('results', [])
+    if not max_passages or sum(len(r.get('document_passages', [])) for r in results) <= max_passages:
+        return response
+    remaining = max_passages
+    limited = []
+    for result in results:
+        passages = result.get('document_passages', [])[:remaining]
+        remaining -= len(passages)
+        limited.append(dict(result, document_passages=passages))
+    return dict(response, results=limited)
+
+def query_discovery(query: str, start_date: str = None, end_date: str = None, count: int = DISCOVERY_RESULT_COUNT):
+    """
+    Query the Discovery collection, asking only for the fields and passages the
+    pipeline uses (see discovery_query_options).
+    Results are cached by normalized query, filter and count for the current collection generation.
+    """
     filters = []
     if start_date:
         filters.append(f"date>={start_date}")
@@ -43,30 +175,143 @@ def query_discovery(query: str, start_date: str = None, end_date: str = None, co
         filters.append(f"date<={end_date}")
     filter_query = ' AND '.join(filters) if filters else None
 
-    response = discovery.query(
-        project_id=DISCOVERY_PROJECT_ID,
-        natural_language_query=query,
-        filter=filter_query,
-        count=count
-    ).get_result()
+    key = hash_key(collection_generation.current(), normalize_text(query), filter_query, count)
+    cached = discovery_cache.get(key)
+    if cached is not None:
+        return cached
+
+    discovery = get_discovery_client()
+    options = discovery_query_options()
+
+    def run_query():
+        count_call('discovery')
+        return discovery.query(
+            project_id=DISCOVERY_PROJECT_ID,
+            natural_language_query=query,
+            filter=filter_query,
+            count=count,
+            return_=options.get('return'),
+            passages=options.get('passages')
+        ).get_result()
+
+    response = limit_passages(get_policy('discovery').call(run_query))
+    discovery_cache.set(key, response)
     return response
 
+def _nlu_relevance(nlu_client, query: str, passage: str) -> float:
+    """Ask NLU for the top category score of the query and passage; raises on failure."""
+    nlu_v1 = import_timed('ibm_watson.natural_language_understanding_v1')
+
+    def analyze():
+        count_call('nlu')
+        return nlu_client.analyze(
+            text=f"{query} {passage}",
+            features=nlu_v1.Features(categories=nlu_v1.CategoriesOptions(limit=3))
+        ).get_result()
+
+    response = get_policy('nlu').call(analyze)
+
+    if 'categories' in response and response['categories']:
+        return response['categories'][0]['score']
+    return 0.0
+
 def calculate_relevance(nlu_client, query: str, passage: str) -> float:
     """
     Calculate relevance of a passage to a query using NLU categories as a heuristic.
-    Returns a score between 0 and 1.
+    Scores are cached by normalized query and passage, so repeats skip NLU.
+    Returns a score between 0 and 1, or None while NLU is unavailable.
     """
     if not passage:
         return 0.0
-    try:
-        response = nlu_client.analyze(
-            text=f"{query} {passage}",
-            features=Features(categories=CategoriesOptions(limit=3))
-        ).get_result()
+    key = cache_key(query, passage)
+    cached = relevance_cache.get(key)
+    if cached is not None:
+        return cached
+    return _score_and_cache(nlu_client, query, passage, key)
 
-        if 'categories' in response and response['categories']:
-            return response['categories'][0]['score']
-        return 0.0
+def _score_and_cache(nlu_client, query: str, passage: str, key: str):
+    """
+    Score one passage with NLU and cache the result. Failures are not cached:
+    they score 0.0, or None when NLU is unavailable so the passage counts as unscored.
+    Concurrent calls for the same key wait for the first one instead of calling NLU again.
+    """
+    return relevance_flight.do(key, _fetch_score, nlu_client, query, passage, key)
+
+def _fetch_score(nlu_client, query: str, passage: str, key: str):
+    try:
+        score = _nlu_relevance(nlu_client, query, passage)
+    except ServiceUnavailable as e:
+        logger.warning(f"NLU relevance unavailable: {e}")
+        return None
     except Exception as e:
         logger.warning(f"NLU relevance calculation failed: {e}")
         return 0.0
+    relevance_cache.set(key, score)
+    return score
+
+def score_passages(nlu_client, query: str, passages: list, max_workers: int = NLU_MAX_WORKERS) -> list:
+    """
+    Score many passages against a query concurrently.
+    Returns the relevance scores in the same order as the given passages,
+    or None if NLU is unavailable.
+    """
+    return next(score_passage_groups(nlu_client, query, [passages], max_workers))
+
+def complete_group_scores(scores):
+    """Return a document's passage scores, or None (and mark the request degraded) if any is missing."""
+    if scores is None or any(score is None for score in scores):
+        mark_degraded('relevance')
+        return None
+    return scores
+
+def score_passage_groups(nlu_client, query: str, groups: list, max_workers: int = NLU_MAX_WORKERS):
+    """
+    Score groups of passages (one group per document) through one bounded pool.
+    Cached scores are resolved first and only the misses are sent to NLU.
+    Yields each group's scores, in group order, as soon as that group is complete.
+
+    While NLU is unavailable (circuit open, or failing on every retry) a group
+    that cannot be fully scored is yielded as None, so callers fall back to
+    confidence-only filtering for that document.
+    """
+    scores = [[None] * len(group) for group in groups]
+    pending = {}
+    for g, group in enumerate(groups):
+        for i, passage in enumerate(group):
+            if not passage:
+                scores[g][i] = 0.0
+                continue
+            key = cache_key(query, passage)
+            cached = relevance_cache.get(key)
+            if cached is not None:
+                scores[g][i] = cached
+            else:
+                pending.setdefault(g, []).append((i, key))
+
+    if pending and not get_policy('nlu').available():
+        for g in range(len(groups)):
+            yield complete_group_scores(None if g in pending else scores[g])
+        return
+
+    workers = max(1, min(max_workers, sum(len(items) for items in pending.values())))
+    if workers == 1:
+        for g, group in enumerate(groups):
+            for i, key in pending.get(g, []):
+                scores[g][i] = _score_and_cache(nlu_client, query, group[i], key)
+            yield complete_group_scores(scores[g])
+        return
+
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='nlu')
+    try:
+        futures = {
+            g: [(i, executor.submit(contextvars.copy_context().run, for_request, _score_and_cache,
+                                    nlu_client, query, groups[g][i], key))
+                for i, key in items]
+            for g, items in pending.items()
+        }
+        for g in range(len(groups)):
+            for i, future in futures.get(g, []):
+                scores[g][i] = future.result()
+            yield complete_group_scores(scores[g])
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
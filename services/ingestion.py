@@ -0,0 +1,307 @@
+import os
+import time
+import asyncio
+import uuid
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from services.ibm_services import add_document_to_discovery
+from utils.logger import logger
+from utils.storage import SQLiteStore
+from config import (INGEST_DB_PATH, INGEST_JOB_TTL, INGEST_MAX_WORKERS, INGEST_MAX_RETRIES, INGEST_RETRY_BACKOFF,
+                    UPLOAD_INDEX_PATH, DISCOVERY_COLLECTION_ID)
+
+
+class MemoryJobStore:
+    """In-process store of ingestion jobs and per-file progress, kept for `ttl` seconds."""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._jobs = {}
+
+    def create(self, job_id: str, filenames: list):
+        now = time.time()
+        with self._lock:
+            for expired in [j for j, job in self._jobs.items() if job["created_at"] < now - self.ttl]:
+                del self._jobs[expired]
+            self._jobs[job_id] = {
+                "created_at": now,
+                "files": [{"filename": name, "status": "queued", "attempts": 0, "error": None,
+                           "document_id": None, "started_at": None, "finished_at": None}
+                          for name in filenames]
+            }
+
+    def update(self, job_id: str, index: int, **fields):
+        with self._lock:
+            self._jobs[job_id]["files"][index].update(fields)
+
+    def get(self, job_id: str):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return {"created_at": job["created_at"], "files": [dict(f) for f in job["files"]]}
+
+
+class SQLiteJobStore(SQLiteStore):
+    """Ingestion jobs persisted in SQLite so any worker can report a job's status, kept for `ttl` seconds."""
+
+    COLUMNS = ("filename", "status", "attempts", "error", "document_id", "started_at", "finished_at")
+
+    def __init__(self, path: str, ttl: float):
+        self.ttl = ttl
+        conn = self._open(path)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS ingest_files ("
+            "job_id TEXT NOT NULL, idx INTEGER NOT NULL, created_at REAL NOT NULL, "
+            "filename TEXT NOT NULL, status TEXT NOT NULL, attempts INTEGER NOT NULL, error TEXT, "
+            "document_id TEXT, started_at REAL, finished_at REAL, PRIMARY KEY (job_id, idx))"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS ingest_files_created ON ingest_files (created_at)")
+
+    def create(self, job_id: str, filenames: list):
+        now = time.time()
+        conn = self._connect()
+        conn.execute("DELETE FROM ingest_files WHERE created_at < ?", (now - self.ttl,))
+        conn.executemany(
+            "INSERT INTO ingest_files (job_id, idx, created_at, filename, status, attempts) "
+            "VALUES (?, ?, ?, ?, 'queued', 0)",
+            [(job_id, i, now, name) for i, name in enumerate(filenames)]
+        )
+
+    def update(self, job_id: str, index: int, **fields):
+        assignments = ', '.join(f"{name} = ?" for name in fields)
+        self._connect().execute(
+            f"UPDATE ingest_files SET {assignments} WHERE job_id = ? AND idx = ?",
+            (*fields.values(), job_id, index)
+        )
+
+    def get(self, job_id: str):
+        rows = self._connect().execute(
+            f"SELECT created_at, {', '.join(self.COLUMNS)} FROM ingest_files WHERE job_id = ? ORDER BY idx",
+            (job_id,)
+        ).fetchall()
+        if not rows:
+            return None
+        return {"created_at": rows[0][0], "files": [dict(zip(self.COLUMNS, row[1:])) for row in rows]}
+
+
+class MemoryDocumentIndex:
+    """In-process index of content hashes to the Discovery documents they were ingested as."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._documents = {}
+
+    def get(self, digest: str):
+        with self._lock:
+            return self._documents.get(digest)
+
+    def add(self, digest: str, document_id: str, filename: str):
+        with self._lock:
+            self._documents[digest] = document_id
+
+
+class SQLiteDocumentIndex(SQLiteStore):
+    """
+    Content hashes of ingested files persisted in SQLite and shared by all workers.
+    Entries are per collection, so pointing the app at another collection starts afresh.
+    """
+
+    def __init__(self, path: str, collection_id: str):
+        self.collection_id = collection_id
+        self._open(path).execute(
+            "CREATE TABLE IF NOT EXISTS document_index ("
+            "collection_id TEXT NOT NULL, digest TEXT NOT NULL, document_id TEXT NOT NULL, "
+            "filename TEXT NOT NULL, created_at REAL NOT NULL, PRIMARY KEY (collection_id, digest))"
+        )
+
+    def get(self, digest: str):
+        row = self._connect().execute(
+            "SELECT document_id FROM document_index WHERE collection_id = ? AND digest = ?",
+            (self.collection_id, digest)
+        ).fetchone()
+        return row[0] if row else None
+
+    def add(self, digest: str, document_id: str, filename: str):
+        self._connect().execute(
+            "INSERT OR REPLACE INTO document_index (collection_id, digest, document_id, filename, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (self.collection_id, digest, document_id, filename, time.time())
+        )
+
+
+class IngestionQueue:
+    """
+    Bounded background pool that forwards uploaded files to Discovery.
+    Each file is retried with exponential backoff and its temporary copy is
+    removed once ingestion finishes, successfully or not.
+
+    Files whose content hash is already in `index` are not sent again: they
+    finish as "duplicate" with the document ID of the earlier upload.
+    """
+
+    def __init__(self, store, max_workers: int, max_retries: int, backoff: float, index=None):
+        self.store = store
+        self.index = index
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # Threads do not survive a fork, so each worker process starts its own pool
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='ingest')
+                self._pid = os.getpid()
+            return self._executor
+
+    def submit(self, files: list) -> str:
+        """Queue (file_path, filename, sha256) triples for ingestion and return the job ID."""
+        job_id = uuid.uuid4().hex
+        self.store.create(job_id, [filename for _, filename, _ in files])
+        executor = self._get_executor()
+        for index, (file_path, filename, digest) in enumerate(files):
+            executor.submit(self._ingest, job_id, index, file_path, filename, digest)
+        return job_id
+
+    def _retry_delay(self, attempt: int) -> float:
+        return self.backoff * (2 ** (attempt - 1)) * (0.5 + random.random())
+
+    def _skip_duplicate(self, job_id: str, index: int, digest: str) -> bool:
+        """Finish the file as a duplicate if identical content was ingested before."""
+        document_id = self.index.get(digest) if self.index is not None and digest else None
+        if document_id is None:
+            return False
+        self.store.update(job_id, index, status="duplicate", document_id=document_id, finished_at=time.time())
+        return True
+
+    def _completed(self, job_id: str, index: int, attempt: int, response: dict, filename: str, digest: str):
+        document_id = response.get("document_id")
+        self.store.update(job_id, index, status="completed", attempts=attempt, error=None,
+                          document_id=document_id, finished_at=time.time())
+        if self.index is not None and digest and document_id:
+            self.index.add(digest, document_id, filename)
+
+    def _ingest(self, job_id: str, index: int, file_path: str, filename: str, digest: str = None):
+        started_at = time.time()
+        self.store.update(job_id, index, status="processing", started_at=started_at)
+        try:
+            if self._skip_duplicate(job_id, index, digest):
+                return
+            for attempt in range(1, self.max_retries + 2):
+                try:
+                    response = add_document_to_discovery(file_path, filename)
+                    self._completed(job_id, index, attempt, response, filename, digest)
+                    return
+                except Exception as e:
+                    logger.warning(f"Ingestion of {filename} failed (attempt {attempt}): {e}")
+                    self.store.update(job_id, index, attempts=attempt, error=str(e))
+                    if attempt > self.max_retries:
+                        break
+                    time.sleep(self._retry_delay(attempt))
+            self.store.update(job_id, index, status="failed", finished_at=time.time())
+        finally:
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+
+    def status(self, job_id: str):
+        """Return the job's overall status with per-file progress and timings, or None if unknown."""
+        job = self.store.get(job_id)
+        if job is None:
+            return None
+        files = job["files"]
+        for f in files:
+            if f["started_at"] is not None:
+                f["queued_seconds"] = round(f["started_at"] - job["created_at"], 3)
+            if f["finished_at"] is not None and f["started_at"] is not None:
+                f["processing_seconds"] = round(f["finished_at"] - f["started_at"], 3)
+        counts = {}
+        for f in files:
+            counts[f["status"]] = counts.get(f["status"], 0) + 1
+        succeeded = counts.get("completed", 0) + counts.get("duplicate", 0)
+        done = succeeded + counts.get("failed", 0)
+        if done < len(files):
+            status = "processing" if counts.get("queued", 0) < len(files) else "queued"
+        else:
+            status = "failed" if succeeded == 0 else (
+                "completed" if counts.get("failed", 0) == 0 else "completed_with_errors")
+        return {
+            "job_id": job_id,
+            "status": status,
+            "total": len(files),
+            "completed": counts.get("completed", 0),
+            "duplicates": counts.get("duplicate", 0),
+            "failed": counts.get("failed", 0),
+            "files": files
+        }
+
+
+class AsyncIngestionQueue(IngestionQueue):
+    """
+    Event-loop variant of IngestionQueue for the ASGI serving mode.
+    Files are forwarded by `add_document`, a coroutine function, with at most
+    `max_workers` in flight; job state goes to the same store as the sync queue.
+    """
+
+    def __init__(self, store, add_document, max_workers: int, max_retries: int, backoff: float, index=None):
+        super().__init__(store, max_workers, max_retries, backoff, index)
+        self.add_document = add_document
+        self._semaphore = None
+        self._tasks = set()
+
+    async def submit(self, files: list) -> str:
+        """
+        Queue (file_path, filename, sha256) triples on the running event loop and
+        return the job ID. The job store and document index are SQLite files other
+        workers write to, so every call to them runs in a thread.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+        job_id = uuid.uuid4().hex
+        await asyncio.to_thread(self.store.create, job_id, [filename for _, filename, _ in files])
+        for index, (file_path, filename, digest) in enumerate(files):
+            task = asyncio.get_running_loop().create_task(
+                self._ingest_async(job_id, index, file_path, filename, digest))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return job_id
+
+    async def _ingest_async(self, job_id: str, index: int, file_path: str, filename: str, digest: str = None):
+        async with self._semaphore:
+            await asyncio.to_thread(self.store.update, job_id, index, status="processing", started_at=time.time())
+            try:
+                if await asyncio.to_thread(self._skip_duplicate, job_id, index, digest):
+                    return
+                for attempt in range(1, self.max_retries + 2):
+                    try:
+                        response = await self.add_document(file_path, filename)
+                        await asyncio.to_thread(self._completed, job_id, index, attempt, response, filename, digest)
+                        return
+                    except Exception as e:
+                        logger.warning(f"Ingestion of {filename} failed (attempt {attempt}): {e}")
+                        await asyncio.to_thread(self.store.update, job_id, index, attempts=attempt, error=str(e))
+                        if attempt > self.max_retries:
+                            break
+                        await asyncio.sleep(self._retry_delay(attempt))
+                await asyncio.to_thread(self.store.update, job_id, index, status="failed", finished_at=time.time())
+            finally:
+                try:
+                    os.remove(file_path)
+                except OSError:
+                    pass
+
+ingestion_queue = IngestionQueue(
+    SQLiteJobStore(INGEST_DB_PATH, INGEST_JOB_TTL) if INGEST_DB_PATH else MemoryJobStore(INGEST_JOB_TTL),
+    max_workers=INGEST_MAX_WORKERS,
+    max_retries=INGEST_MAX_RETRIES,
+    backoff=INGEST_RETRY_BACKOFF,
+    index=(SQLiteDocumentIndex(UPLOAD_INDEX_PATH, DISCOVERY_COLLECTION_ID) if UPLOAD_INDEX_PATH
+           else MemoryDocumentIndex())
+)
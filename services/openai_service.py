@@ -1,27 +1,22 @@
 import openai
-from config import OPENAI_API_KEY
+import config
+from services.context_packer import pack_context
+from utils.logger import logger
+from utils.metrics import count_call
 
-openai.api_key = OPENAI_API_KEY
+openai.api_key = config.OPENAI_API_KEY
 
 
-def generate_answer(query: str, formatted_results: list) -> str:
-    """
-    Generate a comprehensive answer to the user's query with consistent,
-    clean formatting optimized for web display. The response will use
-    proper spacing, indentation, and structure without any markdown or
-    special formatting characters.
-    """
-    # Construct context from relevant documents
-    context = "Relevant Documents and Passages:\n"
-    for result in formatted_results:
-        title = result.get('title', 'No Title')
-        author = result.get('author', 'Unknown')
-        context += f"Document: {title} (Author: {author})\n"
-        for passage in result.get("passages", []):
-            context += f"Content: {passage}\n"
-
-        # Detailed system instructions for consistent formatting
-        system_instructions = """You are an AI assistant that provides clear, human-readable responses with excellent sentence and paragraph punctuation.
+def build_messages(query: str, formatted_results: list, packed_context: dict = None) -> list:
+    """Build the chat messages for the query and the token-budgeted document context."""
+    if packed_context is None:
+        packed_context = pack_context(formatted_results)
+    logger.info(f"Packed {packed_context['passages_kept']}/{packed_context['passages_total']} passages "
+                f"into ~{packed_context['tokens']} context tokens")
+    context = packed_context["text"]
+
+    # Detailed system instructions for consistent formatting
+    system_instructions = """You are an AI assistant that provides clear, human-readable responses with excellent sentence and paragraph punctuation.
 
 	Follow these formatting rules exactly:
 
@@ -77,31 +72,79 @@ def generate_answer(query: str, formatted_results: list) -> str:
     2. DO NOT include "AI Assistant Summary" or similar headers
     3. Follow the formatting rules exactly"""
 
+    return [
+        {"role": "system", "content": system_instructions},
+        {"role": "user", "content": user_content}
+    ]
+
+
+# Completion parameters shared by blocking and streaming calls
+COMPLETION_PARAMS = {
+    "model": "gpt-4",
+    "temperature": 0.7,
+    "max_tokens": 1500,
+    "presence_penalty": 0.1,
+    "frequency_penalty": 0.1
+}
+
+
+def clean_answer(response: str) -> str:
+    """Strip markdown and unwanted headers from a generated answer."""
+    # Remove any remaining markdown or unwanted headers
+    response = response.replace('**AI Assistant Summary**', '')
+    response = response.replace('**', '')
+    response = response.replace('*', '')
+
+    # Clean up spacing
+    response = response.replace('\n\n\n', '\n\n')
+
+    return response
+
+
+def prewarm():
+    """Nothing to connect ahead of time: the OpenAI client is module-level and opens connections per call."""
+
+
+def generate_answer(query: str, formatted_results: list, packed_context: dict = None, use_cache: bool = True) -> str:
+    """
+    Generate a comprehensive answer to the user's query with consistent,
+    clean formatting optimized for web display. The response will use
+    proper spacing, indentation, and structure without any markdown or
+    special formatting characters.
+
+    OpenAI answers are not cached; `use_cache` is accepted so callers can
+    treat every answer backend alike.
+    """
     try:
+        count_call('openai')
         completion = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": system_instructions},
-                {"role": "user", "content": user_content}
-            ],
-            temperature=0.7,
-            max_tokens=1500,
-            presence_penalty=0.1,
-            frequency_penalty=0.1
+            messages=build_messages(query, formatted_results, packed_context),
+            **COMPLETION_PARAMS
         )
 
         # Get the response and clean it
-        response = completion.choices[0].message.content.strip()
+        return clean_answer(completion.choices[0].message.content.strip())
 
-        # Remove any remaining markdown or unwanted headers
-        response = response.replace('**AI Assistant Summary**', '')
-        response = response.replace('**', '')
-        response = response.replace('*', '')
-
-        # Clean up spacing
-        response = response.replace('\n\n\n', '\n\n')
+    except Exception as e:
+        return f"I apologize, but an error occurred while generating the response: {str(e)}"
 
-        return response
 
+def stream_answer(query: str, formatted_results: list, packed_context: dict = None, use_cache: bool = True):
+    """
+    Stream the answer as the completion arrives. Markdown emphasis characters
+    are dropped from each chunk; callers should apply `clean_answer` to the
+    joined text for the final formatted answer.
+    """
+    try:
+        count_call('openai')
+        completion = openai.ChatCompletion.create(
+            messages=build_messages(query, formatted_results, packed_context),
+            stream=True,
+            **COMPLETION_PARAMS
+        )
+        for chunk in completion:
+            text = chunk.choices[0].delta.get("content", "").replace('*', '')
+            if text:
+                yield text
     except Exception as e:
-        return f"I apologize, but an error occurred while generating the response: {str(e)}"
\ No newline at end of file
+        yield f"I apologize, but an error occurred while generating the response: {str(e)}"
\ No newline at end of file
@@ -0,0 +1,39 @@
+from config import DISCOVERY_PROJECT_ID, RELEVANCE_ENGINE
+from services import answer_backends
+from services.ibm_services import get_discovery_client, get_nlu_client
+from utils.logger import logger
+from utils.startup import import_timed, timed
+
+
+def _warm_discovery():
+    discovery = get_discovery_client()
+    discovery.authenticator.token_manager.get_token()
+    # A cheap authenticated call leaves a kept-alive connection in the client's pool
+    discovery.list_collections(project_id=DISCOVERY_PROJECT_ID)
+
+
+def _warm_nlu():
+    nlu = get_nlu_client()
+    nlu.authenticator.token_manager.get_token()
+    nlu.list_models()
+
+
+def prewarm():
+    """
+    Get this worker ready before it takes traffic: import the answer backend and
+    the IBM SDKs, build the shared clients, fetch their IAM tokens and open a
+    connection to each service. A step that fails is logged and skipped; the
+    first request that needs it then does the work instead.
+    """
+    steps = [('discovery', _warm_discovery)]
+    if RELEVANCE_ENGINE in ('nlu', 'hybrid'):
+        steps.append(('nlu', _warm_nlu))
+    if RELEVANCE_ENGINE in ('lexical', 'hybrid'):
+        steps.append(('numpy', lambda: import_timed('numpy')))
+    steps.append(('answer', answer_backends.prewarm))
+    for name, step in steps:
+        try:
+            with timed('prewarm', name):
+                step()
+        except Exception as e:
+            logger.warning(f"Prewarming {name} failed: {e}")
@@ -0,0 +1,191 @@
+import time
+from services.ibm_services import query_discovery
+from services.relevance import get_relevance_engine
+from utils.cache import hash_key, normalize_text
+from utils.metrics import stage, record_stage, count_filtered
+from config import RELEVANCE_SCORING_MODE, RELEVANCE_TOP_K
+
+
+def filter_by_confidence(results: list, confidence_threshold: float) -> list:
+    """Return (result, confidence percentage) pairs that meet the confidence threshold."""
+    candidates = []
+    for result in results:
+        confidence_value = result.get('result_metadata', {}).get('confidence', 0) * 100
+        if confidence_value < confidence_threshold:
+            continue
+        candidates.append((result, confidence_value))
+    return candidates
+
+
+def build_document(result: dict, confidence_value: float, passage_scores: list, relevance_threshold: float):
+    """
+    Apply the relevance filter to one scored Discovery result.
+    Returns the formatted document for display, or None if it does not qualify.
+    With `passage_scores` None the document was not scored and keeps all its passages.
+    """
+    metadata = result.get("extracted_metadata", {})
+    passages = result.get("document_passages", [])
+
+    if passage_scores is None:
+        if not passages:
+            return None
+        return {
+            "document_id": result.get("document_id"),
+            "author": metadata.get("author", "Unknown"),
+            "title": metadata.get("title", metadata.get("filename", "No Title")),
+            "confidence": f"{confidence_value:.2f}%",
+            "relevance": "N/A",
+            "passages": [p.get("passage_text", "No Passage Available") for p in passages],
+            "passage_scores": None
+        }
+
+    scores = [
+        {
+            "passage": p.get("passage_text", "No Passage Available"),
+            "relevance_score": score
+        }
+        for p, score in zip(passages, passage_scores)
+    ]
+
+    # If a relevance threshold is set, skip documents that don't meet it
+    if relevance_threshold > 0 and not any(s['relevance_score'] >= relevance_threshold for s in scores):
+        return None
+
+    # Include all passages that meet or exceed relevance threshold
+    relevant = [s for s in scores if s['relevance_score'] >= relevance_threshold]
+    relevant_passages = [s['passage'] for s in relevant]
+
+    # If no relevant passages after filtering, skip the doc
+    if not relevant_passages:
+        return None
+
+    # Document passes the filters, so add it
+    top_relevance = max(s['relevance_score'] for s in scores if s['relevance_score'] >= relevance_threshold)
+    return {
+        "document_id": result.get("document_id"),
+        "author": metadata.get("author", "Unknown"),
+        "title": metadata.get("title", metadata.get("filename", "No Title")),
+        "confidence": f"{confidence_value:.2f}%",
+        "relevance": f"{top_relevance:.2f}",
+        "passages": relevant_passages,
+        "passage_scores": [round(s['relevance_score'], 4) for s in relevant]
+    }
+
+
+def note_unscored(unscored, result: dict, confidence_value: float, returned: bool):
+    """Record a document whose passages were never relevance-scored."""
+    if unscored is not None:
+        unscored.append({
+            "document_id": result.get("document_id"),
+            "confidence": f"{confidence_value:.2f}%",
+            "returned": returned
+        })
+
+
+def iter_relevant_documents(query: str, results: list, confidence_threshold: float, relevance_threshold: float,
+                            unscored: list = None, mode: str = RELEVANCE_SCORING_MODE, top_k: int = RELEVANCE_TOP_K):
+    """
+    Score the passages of all confidence-filtered results concurrently and
+    yield each formatted document, in Discovery order, as soon as it qualifies.
+    In 'lazy' mode scoring stops early (see `iter_lazy_documents`). Documents
+    left unscored, by lazy mode or because NLU is unavailable, are appended to
+    `unscored`; the latter are kept on confidence alone.
+    """
+    candidates = filter_by_confidence(results, confidence_threshold)
+    count_filtered('documents', 'confidence', len(results) - len(candidates))
+    if mode == 'lazy':
+        yield from iter_lazy_documents(query, candidates, relevance_threshold, top_k, unscored)
+        return
+
+    groups = [[p.get("passage_text", "") for p in result.get("document_passages", [])] for result, _ in candidates]
+    scored = get_relevance_engine().score_groups(query, groups)
+    scoring_seconds = 0.0
+    try:
+        for (result, confidence_value), group in zip(candidates, groups):
+            # Only the time spent waiting for scores counts towards the scoring stage
+            started = time.perf_counter()
+            passage_scores = next(scored)
+            scoring_seconds += time.perf_counter() - started
+
+            document = build_document(result, confidence_value, passage_scores, relevance_threshold)
+            if passage_scores is None:
+                note_unscored(unscored, result, confidence_value, document is not None)
+            if document is None:
+                count_filtered('documents', 'relevance')
+                count_filtered('passages', 'relevance', len(group))
+                continue
+            count_filtered('passages', 'relevance', len(group) - len(document["passages"]))
+            yield document
+    finally:
+        scored.close()
+        record_stage('relevance', scoring_seconds)
+
+
+def iter_lazy_documents(query: str, candidates: list, relevance_threshold: float, top_k: int,
+                        unscored: list = None):
+    """
+    Yield up to `top_k` qualifying documents, scoring candidates in descending
+    confidence order only until enough qualify. Each round scores just as many
+    documents as are still missing. Without a relevance threshold nothing is
+    scored and the top `top_k` candidates are returned in Discovery's ranking.
+    """
+    candidates = sorted(candidates, key=lambda c: c[1], reverse=True)
+    if relevance_threshold <= 0:
+        for position, (result, confidence_value) in enumerate(candidates):
+            returned = position < top_k
+            note_unscored(unscored, result, confidence_value, returned)
+            document = build_document(result, confidence_value, None, relevance_threshold) if returned else None
+            if document is not None:
+                yield document
+        count_filtered('documents', 'top_k', max(0, len(candidates) - top_k))
+        return
+
+    found = 0
+    position = 0
+    scoring_seconds = 0.0
+    engine = get_relevance_engine()
+    try:
+        while position < len(candidates) and found < top_k:
+            window = candidates[position:position + top_k - found]
+            position += len(window)
+            groups = [[p.get("passage_text", "") for p in result.get("document_passages", [])]
+                      for result, _ in window]
+            started = time.perf_counter()
+            all_scores = list(engine.score_groups(query, groups))
+            scoring_seconds += time.perf_counter() - started
+
+            for (result, confidence_value), group, passage_scores in zip(window, groups, all_scores):
+                document = build_document(result, confidence_value, passage_scores, relevance_threshold)
+                if passage_scores is None:
+                    note_unscored(unscored, result, confidence_value, document is not None)
+                if document is None:
+                    count_filtered('documents', 'relevance')
+                    count_filtered('passages', 'relevance', len(group))
+                    continue
+                count_filtered('passages', 'relevance', len(group) - len(document["passages"]))
+                found += 1
+                yield document
+    finally:
+        record_stage('relevance', scoring_seconds)
+
+    for result, confidence_value in candidates[position:]:
+        note_unscored(unscored, result, confidence_value, False)
+    count_filtered('documents', 'top_k', len(candidates) - position)
+
+
+def find_relevant_documents(query: str, start_date: str, end_date: str,
+                            confidence_threshold: float, relevance_threshold: float, unscored: list = None) -> list:
+    """
+    Query Discovery and return every document that passes the confidence and relevance filters.
+    Documents the lazy scoring mode leaves unscored are appended to `unscored`.
+    """
+    with stage('discovery'):
+        discovery_response = query_discovery(query, start_date, end_date)
+    results = discovery_response.get("results", [])
+    return list(iter_relevant_documents(query, results, confidence_threshold, relevance_threshold, unscored))
+
+
+def query_flight_key(params: dict) -> str:
+    """Key identifying queries that produce the same documents and answer, for request coalescing."""
+    return hash_key(normalize_text(params['query']), params['start_date'], params['end_date'],
+                    params['confidence_threshold'], params['relevance_threshold'])
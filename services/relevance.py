@@ -0,0 +1,124 @@
+from config import RELEVANCE_ENGINE, RELEVANCE_HYBRID_WEIGHT
+from services.ibm_services import get_nlu_client, score_passage_groups
+from utils.cache import normalize_text
+from utils.startup import import_timed
+
+# Common English words that carry no topical signal for lexical matching
+STOPWORDS = frozenset((
+    "a an and are as at be but by can do does for from has have how i if in into is it its "
+    "of on or that the their there these this to was were what when where which who why will "
+    "with you your"
+).split())
+
+
+class NLUEngine:
+    """Relevance from the top NLU category of the query and passage, one cached call per passage."""
+
+    name = 'nlu'
+
+    def score_groups(self, query: str, groups: list):
+        """Yield each group's passage scores, in group order, as soon as that group is complete."""
+        yield from score_passage_groups(get_nlu_client(), query, groups)
+
+
+def _tokenize(text: str) -> list:
+    return [token for token in normalize_text(text).split() if token not in STOPWORDS]
+
+
+def lexical_scores(query: str, passages: list) -> "numpy.ndarray":
+    """
+    TF-IDF cosine similarity between the query and each passage, in [0, 1].
+    Term frequencies are sublinear and IDF is computed over the given
+    passages, so all passages of a query are scored in one matrix product.
+    """
+    # Imported on first use: only the lexical and hybrid engines need NumPy
+    np = import_timed('numpy')
+    scores = np.zeros(len(passages))
+    query_tokens = _tokenize(query)
+    if not query_tokens or not passages:
+        return scores
+
+    vocabulary = {}
+    passage_ids = [[vocabulary.setdefault(t, len(vocabulary)) for t in _tokenize(p or '')] for p in passages]
+    query_ids = [vocabulary.setdefault(t, len(vocabulary)) for t in query_tokens]
+
+    counts = np.zeros((len(passages), len(vocabulary)))
+    rows = np.repeat(np.arange(len(passages)), [len(ids) for ids in passage_ids])
+    columns = np.array([i for ids in passage_ids for i in ids], dtype=np.intp)
+    np.add.at(counts, (rows, columns), 1)
+    query_counts = np.bincount(query_ids, minlength=len(vocabulary)).astype(float)
+
+    document_frequency = np.count_nonzero(counts, axis=0)
+    idf = np.log((1 + len(passages)) / (1 + document_frequency)) + 1
+    weights = np.log1p(counts) * idf
+    query_weights = np.log1p(query_counts) * idf
+
+    norms = np.linalg.norm(weights, axis=1) * np.linalg.norm(query_weights)
+    np.divide(weights @ query_weights, norms, out=scores, where=norms > 0)
+    return np.clip(scores, 0.0, 1.0)
+
+
+class LexicalEngine:
+    """Local NumPy TF-IDF scoring: no network calls, all passages of a query in one batch."""
+
+    name = 'lexical'
+
+    def score_groups(self, query: str, groups: list):
+        yield from split_groups(lexical_scores(query, [p for group in groups for p in group]).tolist(), groups)
+
+
+class HybridEngine:
+    """
+    Weighted blend of the lexical score (weight `lexical_weight`) and the NLU
+    score. Groups NLU could not score keep the lexical score alone.
+    """
+
+    name = 'hybrid'
+
+    def __init__(self, lexical_weight: float = RELEVANCE_HYBRID_WEIGHT):
+        self.lexical_weight = lexical_weight
+        self.lexical = LexicalEngine()
+        self.nlu = NLUEngine()
+
+    def blend(self, lexical: list, nlu: list) -> list:
+        if nlu is None:
+            return lexical
+        return [self.lexical_weight * a + (1 - self.lexical_weight) * b for a, b in zip(lexical, nlu)]
+
+    def score_groups(self, query: str, groups: list):
+        lexical = self.lexical.score_groups(query, groups)
+        for nlu_scores in self.nlu.score_groups(query, groups):
+            yield self.blend(next(lexical), nlu_scores)
+
+
+def split_groups(flat_scores: list, groups: list) -> list:
+    """Split a flat list of scores back into the shape of `groups`."""
+    result = []
+    start = 0
+    for group in groups:
+        result.append(flat_scores[start:start + len(group)])
+        start += len(group)
+    return result
+
+
+_engines = {
+    'nlu': NLUEngine,
+    'lexical': LexicalEngine,
+    'hybrid': HybridEngine,
+}
+_instances = {}
+
+
+def register_engine(name: str, factory):
+    """Make a relevance engine available under `name` for the RELEVANCE_ENGINE setting."""
+    _engines[name] = factory
+    _instances.pop(name, None)
+
+
+def get_relevance_engine(name: str = RELEVANCE_ENGINE):
+    """Return the shared instance of the named relevance engine."""
+    if name not in _instances:
+        if name not in _engines:
+            raise ValueError(f"Unknown relevance engine: {name}")
+        _instances[name] = _engines[name]()
+    return _instances[name]
@@ -0,0 +1,250 @@
+import os
+import time
+import uuid
+import hashlib
+import threading
+from config import UPLOAD_FOLDER, UPLOAD_SESSION_DB_PATH, UPLOAD_CHUNK_SIZE, UPLOAD_SESSION_TTL
+from utils.storage import SQLiteStore, fcntl
+
+# Read size when copying request bodies to disk, so no upload is ever held in memory whole
+COPY_BUFFER_SIZE = 64 * 1024
+
+
+def copy_hashed(source, destination, hasher, limit: int = None) -> int:
+    """
+    Copy `source` to `destination` in small pieces, feeding every piece to
+    `hasher`. Stops after `limit` bytes if given; returns the bytes copied.
+    """
+    copied = 0
+    while limit is None or copied < limit:
+        size = COPY_BUFFER_SIZE if limit is None else min(COPY_BUFFER_SIZE, limit - copied)
+        piece = source.read(size)
+        if not piece:
+            break
+        hasher.update(piece)
+        destination.write(piece)
+        copied += len(piece)
+    return copied
+
+
+def save_hashed(stream, file_path: str) -> str:
+    """Save an uploaded stream to `file_path` and return the SHA-256 of its content."""
+    hasher = hashlib.sha256()
+    with open(file_path, 'wb') as f:
+        copy_hashed(stream, f, hasher)
+    return hasher.hexdigest()
+
+
+class UploadOffsetMismatch(Exception):
+    """A chunk did not start where the upload left off; `offset` is where it should resume."""
+
+    def __init__(self, message: str, offset: int):
+        super().__init__(message)
+        self.offset = offset
+
+
+class MemoryUploadSessions:
+    """In-process state of chunked uploads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def create(self, upload_id: str, filename: str, size: int):
+        now = time.time()
+        with self._lock:
+            self._sessions[upload_id] = {"filename": filename, "size": size, "offset": 0,
+                                         "created_at": now, "updated_at": now}
+
+    def get(self, upload_id: str):
+        with self._lock:
+            session = self._sessions.get(upload_id)
+            return dict(session) if session is not None else None
+
+    def set_offset(self, upload_id: str, offset: int):
+        with self._lock:
+            self._sessions[upload_id].update(offset=offset, updated_at=time.time())
+
+    def delete(self, upload_id: str):
+        with self._lock:
+            self._sessions.pop(upload_id, None)
+
+    def expired(self, before: float) -> list:
+        with self._lock:
+            return [upload_id for upload_id, s in self._sessions.items() if s["updated_at"] < before]
+
+
+class SQLiteUploadSessions(SQLiteStore):
+    """Chunked upload state persisted in SQLite, so consecutive chunks may reach different workers."""
+
+    COLUMNS = ("filename", "size", "offset", "created_at", "updated_at")
+
+    def __init__(self, path: str):
+        self._open(path).execute(
+            "CREATE TABLE IF NOT EXISTS upload_sessions ("
+            "upload_id TEXT PRIMARY KEY, filename TEXT NOT NULL, size INTEGER NOT NULL, "
+            "offset INTEGER NOT NULL, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def create(self, upload_id: str, filename: str, size: int):
+        now = time.time()
+        self._connect().execute(
+            "INSERT INTO upload_sessions (upload_id, filename, size, offset, created_at, updated_at) "
+            "VALUES (?, ?, ?, 0, ?, ?)",
+            (upload_id, filename, size, now, now)
+        )
+
+    def get(self, upload_id: str):
+        row = self._connect().execute(
+            f"SELECT {', '.join(self.COLUMNS)} FROM upload_sessions WHERE upload_id = ?", (upload_id,)
+        ).fetchone()
+        return dict(zip(self.COLUMNS, row)) if row else None
+
+    def set_offset(self, upload_id: str, offset: int):
+        self._connect().execute(
+            "UPDATE upload_sessions SET offset = ?, updated_at = ? WHERE upload_id = ?",
+            (offset, time.time(), upload_id)
+        )
+
+    def delete(self, upload_id: str):
+        self._connect().execute("DELETE FROM upload_sessions WHERE upload_id = ?", (upload_id,))
+
+    def expired(self, before: float) -> list:
+        rows = self._connect().execute(
+            "SELECT upload_id FROM upload_sessions WHERE updated_at < ?", (before,)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+
+class ChunkedUploads:
+    """
+    Resumable uploads sent as a series of chunks, each appended to a part file
+    at the offset the client states. After an interruption the client asks for
+    the current offset and continues from there.
+
+    Content is hashed as it arrives. The running hash lives in the worker that
+    received the previous chunk; a worker without it (another process, or a
+    restart) rebuilds it from the part file once and carries on.
+    """
+
+    def __init__(self, sessions, folder: str, chunk_size: int, ttl: float):
+        self.sessions = sessions
+        self.folder = folder
+        self.chunk_size = chunk_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._hashers = {}
+
+    def _part_path(self, upload_id: str) -> str:
+        return os.path.join(self.folder, f"{upload_id}.part")
+
+    def start(self, filename: str, size: int) -> dict:
+        """Begin an upload of `size` bytes and return its ID and the chunk size to use."""
+        self.purge_expired()
+        upload_id = uuid.uuid4().hex
+        open(self._part_path(upload_id), 'wb').close()
+        self.sessions.create(upload_id, filename, size)
+        with self._lock:
+            self._hashers[upload_id] = (0, hashlib.sha256())
+        return {"upload_id": upload_id, "offset": 0, "size": size, "chunk_size": self.chunk_size}
+
+    def status(self, upload_id: str):
+        session = self.sessions.get(upload_id)
+        if session is None:
+            return None
+        return {"upload_id": upload_id, "filename": session["filename"], "size": session["size"],
+                "offset": session["offset"]}
+
+    def _hasher(self, upload_id: str, offset: int):
+        with self._lock:
+            cached = self._hashers.pop(upload_id, None)
+        if cached is not None and cached[0] == offset:
+            return cached[1]
+        hasher = hashlib.sha256()
+        with open(self._part_path(upload_id), 'rb') as f:
+            copy_hashed(f, _Discard(), hasher, limit=offset)
+        return hasher
+
+    def append(self, upload_id: str, offset: int, stream, length: int) -> int:
+        """
+        Append `length` bytes read from `stream` at `offset` and return the new offset.
+        Raises KeyError for an unknown upload, UploadOffsetMismatch if `offset` is not
+        where the upload stands, and ValueError for a chunk that is too large.
+        """
+        if length > self.chunk_size:
+            raise ValueError(f"Chunks can be at most {self.chunk_size} bytes")
+        with open(self._part_path(upload_id), 'r+b') as f:
+            if fcntl:
+                # Serializes chunks of one upload across threads and worker processes
+                fcntl.flock(f, fcntl.LOCK_EX)
+            session = self.sessions.get(upload_id)
+            if session is None:
+                raise KeyError(upload_id)
+            if offset != session["offset"]:
+                raise UploadOffsetMismatch(f"Expected offset {session['offset']}", session["offset"])
+            if offset + length > session["size"]:
+                raise ValueError("Chunk extends past the declared upload size")
+
+            hasher = self._hasher(upload_id, offset)
+            f.seek(offset)
+            f.truncate()
+            received = copy_hashed(stream, f, hasher, limit=length)
+            f.flush()
+            if received != length:
+                # Client went away mid-chunk: drop the partial chunk so the upload can resume cleanly
+                f.truncate(offset)
+                raise UploadOffsetMismatch("Chunk ended early", offset)
+            self.sessions.set_offset(upload_id, offset + received)
+            with self._lock:
+                self._hashers[upload_id] = (offset + received, hasher)
+            return offset + received
+
+    def complete(self, upload_id: str):
+        """
+        Finish an upload and return (file_path, filename, sha256) for ingestion.
+        Raises KeyError for an unknown or already completed upload and
+        UploadOffsetMismatch if bytes are missing.
+        """
+        try:
+            part = open(self._part_path(upload_id), 'rb')
+        except FileNotFoundError:
+            raise KeyError(upload_id)
+        with part:
+            if fcntl:
+                # Held until the session is gone, so a concurrent complete or chunk finds no upload
+                fcntl.flock(part, fcntl.LOCK_EX)
+            session = self.sessions.get(upload_id)
+            if session is None:
+                raise KeyError(upload_id)
+            if session["offset"] != session["size"]:
+                raise UploadOffsetMismatch(
+                    f"Upload incomplete: {session['offset']} of {session['size']} bytes received", session["offset"])
+            digest = self._hasher(upload_id, session["offset"]).hexdigest()
+            file_path = os.path.join(self.folder, f"{upload_id}-{session['filename']}")
+            os.replace(self._part_path(upload_id), file_path)
+            self.sessions.delete(upload_id)
+        return file_path, session["filename"], digest
+
+    def purge_expired(self):
+        """Remove uploads that received nothing for `ttl` seconds."""
+        for upload_id in self.sessions.expired(time.time() - self.ttl):
+            self.sessions.delete(upload_id)
+            with self._lock:
+                self._hashers.pop(upload_id, None)
+            try:
+                os.remove(self._part_path(upload_id))
+            except OSError:
+                pass
+
+
+class _Discard:
+    def write(self, data):
+        pass
+
+
+chunked_uploads = ChunkedUploads(
+    SQLiteUploadSessions(UPLOAD_SESSION_DB_PATH) if UPLOAD_SESSION_DB_PATH else MemoryUploadSessions(),
+    UPLOAD_FOLDER,
+    chunk_size=UPLOAD_CHUNK_SIZE,
+    ttl=UPLOAD_SESSION_TTL
+)
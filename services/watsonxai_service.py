@@ -1,33 +1,57 @@
-from ibm_watson_machine_learning.foundation_models import Model
-from ibm_watson_machine_learning.foundation_models.utils.enums import ModelTypes
-from config import WATSONX_API_KEY, WATSONX_PROJECT_ID, WATSONX_URL
-
-# Initialize credentials
-credentials = {
-    "url": WATSONX_URL,
-    "apikey": WATSONX_API_KEY
+import json
+import time
+import hashlib
+import config
+from config import (ANSWER_CACHE_PATH, ANSWER_CACHE_TTL, ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_MEMORY_ENTRIES,
+                    ANSWER_END_MARKER, ANSWER_ROUTES)
+from services.answer_routing import select_route, strip_end_marker, until_end_marker
+from services.client_registry import registry
+from services.context_packer import pack_context
+from utils.cache import build_tiered_cache, hash_key, normalize_text
+from utils.logger import logger
+from utils.metrics import metrics, count_call
+from utils.resilience import get_policy, ServiceUnavailable
+from utils.startup import import_timed
+
+def _create_watsonx_model(model_id: str):
+    # The watsonx.ai SDK is slow to import, so it is loaded with the first model client
+    foundation_models = import_timed('ibm_watson_machine_learning.foundation_models')
+    return foundation_models.Model(
+        model_id=model_id,
+        credentials={"url": config.WATSONX_URL, "apikey": config.WATSONX_API_KEY},
+        project_id=config.WATSONX_PROJECT_ID
+    )
+
+
+def get_model(model_id: str):
+    """Return the process-wide client for one watsonx.ai model (registered as `watsonx:<model_id>`)."""
+    return registry.get(f"watsonx:{model_id}", lambda: _create_watsonx_model(model_id))
+
+
+def prewarm():
+    """Build the client of every routed model; creating a `Model` authenticates and checks the model."""
+    for model_id in dict.fromkeys(route["model_id"] for route in ANSWER_ROUTES):
+        get_model(model_id)
+
+
+# Generation parameters shared by blocking and streaming calls; each route sets max_new_tokens
+GENERATION_PARAMS = {
+    "decoding_method": "greedy",
+    "max_new_tokens": 1500,
+    "min_new_tokens": 0,
+    "temperature": 0.7,
+    "repetition_penalty": 1.1
 }
+if ANSWER_END_MARKER:
+    GENERATION_PARAMS["stop_sequences"] = [ANSWER_END_MARKER]
+    GENERATION_PARAMS["include_stop_sequence"] = False
 
 
-def generate_answer(query: str, formatted_results: list) -> str:
-    """
-    Generate a comprehensive answer to the user's query with consistent,
-    clean formatting optimized for web display. The response will use
-    proper spacing, indentation, and structure without any markdown or
-    special formatting characters.
-    """
-    try:
-        # Construct context from relevant documents
-        context = "Relevant Documents and Passages:\n"
-        for result in formatted_results:
-            title = result.get('title', 'No Title')
-            author = result.get('author', 'Unknown')
-            context += f"Document: {title} (Author: {author})\n"
-            for passage in result.get("passages", []):
-                context += f"Content: {passage}\n"
-
-        # Detailed system instructions for consistent formatting
-        system_instructions = """You are an AI assistant that MUST format responses EXACTLY as follows:
+def generation_params(route: dict) -> dict:
+    return dict(GENERATION_PARAMS, max_new_tokens=route["max_new_tokens"])
+
+# Detailed system instructions for consistent formatting
+SYSTEM_INSTRUCTIONS = """You are an AI assistant that MUST format responses EXACTLY as follows:
 
 OVERVIEW
 
@@ -48,8 +72,50 @@ KEY POINTS
 CONCLUSION
 
    [Write a clear 1-2 sentence conclusion here, with 4 spaces indentation]"""
+if ANSWER_END_MARKER:
+    SYSTEM_INSTRUCTIONS += f"""
+
+{ANSWER_END_MARKER}
+
+Write the line {ANSWER_END_MARKER} right after the conclusion and nothing after it."""
+
+# Raw generated text of successful answers. Decoding is greedy, so the same model,
+# parameters, query and context produce the same answer.
+answer_cache = build_tiered_cache(
+    ANSWER_CACHE_PATH,
+    memory_entries=ANSWER_CACHE_MEMORY_ENTRIES,
+    max_entries=ANSWER_CACHE_MAX_ENTRIES,
+    ttl=ANSWER_CACHE_TTL,
+    table='answers'
+)
+
+
+def _answer_cache_samples():
+    samples = []
+    tiers = [('answer', answer_cache.memory)]
+    if answer_cache.disk is not None:
+        tiers.append(('answer_disk', answer_cache.disk))
+    for name, cache in tiers:
+        stats = cache.stats()
+        samples.append(('counter', 'crag_cache_requests_total', {'cache': name, 'result': 'hit'}, stats['hits']))
+        samples.append(('counter', 'crag_cache_requests_total', {'cache': name, 'result': 'miss'}, stats['misses']))
+    samples.append(('gauge', 'crag_cache_entries', {'cache': 'answer'}, answer_cache.memory.stats()['entries']))
+    return samples
 
-        prompt = f"""System: {system_instructions}
+
+metrics.register_collector(_answer_cache_samples)
+metrics.describe('crag_answer_duration_seconds', 'watsonx.ai generation latency by answer route and mode')
+
+
+def build_prompt(query: str, formatted_results: list, packed_context: dict = None) -> str:
+    """Build the watsonx.ai prompt from the query and the token-budgeted document context."""
+    if packed_context is None:
+        packed_context = pack_context(formatted_results)
+    logger.info(f"Packed {packed_context['passages_kept']}/{packed_context['passages_total']} passages "
+                f"into ~{packed_context['tokens']} context tokens")
+    context = packed_context["text"]
+
+    return f"""System: {SYSTEM_INSTRUCTIONS}
 
 Provide a response to this query using ONLY the information from the context. Format your response exactly as shown above.
 
@@ -60,42 +126,132 @@ Context:
 
 Begin with "Response:" and maintain consistent formatting throughout. DO NOT include any instruction text in your response."""
 
-        # Initialize model
-        model = Model(
-            model_id="ibm/granite-3-8b-instruct",  # Updated to non-deprecated model
-            credentials=credentials,
-            project_id=WATSONX_PROJECT_ID
-        )
 
-        # Generate response with parameters
-        params = {
-            "decoding_method": "greedy",
-            "max_new_tokens": 1500,
-            "min_new_tokens": 0,
-            "temperature": 0.7,
-            "repetition_penalty": 1.1
-        }
+def answer_cache_key(query: str, packed_context: dict, route: dict) -> str:
+    """Key an answer by the route's model and generation params, normalized query and a fingerprint of the context."""
+    context_fingerprint = hashlib.sha256(packed_context["text"].encode('utf-8')).hexdigest()
+    return hash_key(route["model_id"], json.dumps(generation_params(route), sort_keys=True), normalize_text(query),
+                    context_fingerprint)
+
+
+def observe_generation(route: dict, mode: str, seconds: float):
+    metrics.observe('crag_answer_duration_seconds', seconds,
+                    {'route': route["name"], 'model': route["model_id"], 'mode': mode})
 
-        response = model.generate_text(prompt, params)
+
+def clean_answer(result: str) -> str:
+    """Strip markdown and normalize section spacing in a generated answer."""
+    # Clean up spacing and formatting
+    result = result.replace('**AI Assistant Summary**', '')
+    result = result.replace('**', '')
+    result = result.replace('*', '')
+    result = result.replace('\n\n\n', '\n\n')
+
+    # Ensure proper spacing for sections
+    result = result.replace('OVERVIEW\n', 'OVERVIEW\n\n')
+    result = result.replace('KEY POINTS\n', 'KEY POINTS\n\n')
+    result = result.replace('CONCLUSION\n', 'CONCLUSION\n\n')
+
+    return result
+
+
+def generate_answer(query: str, formatted_results: list, packed_context: dict = None, use_cache: bool = True) -> str:
+    """
+    Generate a comprehensive answer to the user's query with consistent,
+    clean formatting optimized for web display. The response will use
+    proper spacing, indentation, and structure without any markdown or
+    special formatting characters.
+
+    The model and token limit come from the answer route selected for the
+    query type and context size (see ANSWER_ROUTES).
+
+    Successful answers are cached; `use_cache=False` skips the lookup and
+    regenerates (the fresh answer still replaces the cached one).
+    Raises ServiceUnavailable when watsonx.ai is unhealthy so callers can
+    respond without an answer.
+    """
+    try:
+        if packed_context is None:
+            packed_context = pack_context(formatted_results)
+        route = select_route(query, packed_context)
+        key = answer_cache_key(query, packed_context, route)
+        if use_cache:
+            cached = answer_cache.get(key)
+            if cached is not None:
+                return clean_answer(cached)
+
+        prompt = build_prompt(query, formatted_results, packed_context)
+        logger.info(f"Answering with route {route['name']} ({route['model_id']})")
+
+        # Reuse the process-wide model client
+        model = get_model(route["model_id"])
+        params = generation_params(route)
+
+        def generate():
+            count_call('watsonx')
+            return model.generate_text(prompt, params)
+
+        started = time.perf_counter()
+        response = get_policy('watsonx').call(generate)
+        observe_generation(route, 'blocking', time.perf_counter() - started)
 
         # Clean and format the response
         if isinstance(response, dict) and "results" in response:
             result = response["results"][0]["generated_text"].strip()
         else:
             result = str(response).strip()
+        result = strip_end_marker(result)
+
+        answer_cache.set(key, result)
+        return clean_answer(result)
 
-        # Clean up spacing and formatting
-        result = result.replace('**AI Assistant Summary**', '')
-        result = result.replace('**', '')
-        result = result.replace('*', '')
-        result = result.replace('\n\n\n', '\n\n')
+    except ServiceUnavailable:
+        raise
+    except Exception as e:
+        return f"I apologize, but an error occurred while generating the response: {str(e)}"
+
+
+def stream_answer(query: str, formatted_results: list, packed_context: dict = None, use_cache: bool = True):
+    """
+    Stream the answer token by token using the model's streaming generation API.
+    Markdown emphasis characters are dropped from each chunk; callers should
+    apply `clean_answer` to the joined text for the final formatted answer.
+    A cached answer is yielded as a single chunk, and a stream that completes
+    without error is cached for later requests. Streams are not retried, but
+    failures count towards the watsonx.ai circuit breaker, and a chunk slower
+    than WATSONX_TIMEOUT or an answer past WATSONX_DEADLINE raises
+    ServiceUnavailable like an unhealthy service.
+    """
+    try:
+        if packed_context is None:
+            packed_context = pack_context(formatted_results)
+        route = select_route(query, packed_context)
+        key = answer_cache_key(query, packed_context, route)
+        if use_cache:
+            cached = answer_cache.get(key)
+            if cached is not None:
+                yield cached.replace('*', '')
+                return
 
-        # Ensure proper spacing for sections
-        result = result.replace('OVERVIEW\n', 'OVERVIEW\n\n')
-        result = result.replace('KEY POINTS\n', 'KEY POINTS\n\n')
-        result = result.replace('CONCLUSION\n', 'CONCLUSION\n\n')
+        prompt = build_prompt(query, formatted_results, packed_context)
+        logger.info(f"Streaming answer with route {route['name']} ({route['model_id']})")
+        model = get_model(route["model_id"])
+        chunks = []
+        started = time.perf_counter()
+        params = generation_params(route)
 
-        return result
+        def open_stream():
+            count_call('watsonx')
+            return model.generate_text_stream(prompt, params)
 
+        for chunk in until_end_marker(get_policy('watsonx').stream(open_stream)):
+            chunk = chunk.replace('*', '')
+            if chunk:
+                chunks.append(chunk)
+                yield chunk
+        observe_generation(route, 'stream', time.perf_counter() - started)
+        answer_cache.set(key, "".join(chunks).strip())
+    except ServiceUnavailable:
+        raise
     except Exception as e:
-        return f"I apologize, but an error occurred while generating the response: {str(e)}"
\ No newline at end of file
+        yield f"I apologize, but an error occurred while generating the response: {str(e)}"
@@ -21,6 +21,17 @@ document.addEventListener('DOMContentLoaded', () => {
    const passphraseInput = document.getElementById('passphrase');
    const authSubmitButton = document.getElementById('auth-submit');
 
+   // Per-browser session ID so search history is kept separately for each user
+   let sessionId = localStorage.getItem('crag-session-id');
+   if (!sessionId) {
+       sessionId = (crypto.randomUUID ? crypto.randomUUID() : String(Date.now()) + Math.random().toString(16).slice(2));
+       localStorage.setItem('crag-session-id', sessionId);
+   }
+
+   // Files above this size are sent through the resumable chunked upload endpoints
+   const CHUNKED_UPLOAD_THRESHOLD = 8 * 1024 * 1024;
+   const CHUNK_MAX_RETRIES = 5;
+
    // Loading indicator functions
    function showLoading(message = 'Processing...') {
        document.getElementById('loading-text').textContent = message;
@@ -59,10 +70,20 @@ document.addEventListener('DOMContentLoaded', () => {
    });
 
    // Enhanced query history handling
-   function updateQueryHistory(history) {
+   const HISTORY_PAGE_SIZE = 20;
+   const LOAD_MORE_VALUE = '__load_more__';
+   let historyLoaded = false;
+   let historyOffset = 0;
+
+   function clearQueryHistory() {
        while (queryHistoryDropdown.options.length > 1) {
            queryHistoryDropdown.remove(1);
        }
+   }
+
+   function appendQueryHistory(history, hasMore) {
+       const loadMore = queryHistoryDropdown.querySelector(`option[value="${LOAD_MORE_VALUE}"]`);
+       if (loadMore) loadMore.remove();
 
        if (history && history.length > 0) {
            history.forEach(entry => {
@@ -72,6 +93,45 @@ document.addEventListener('DOMContentLoaded', () => {
                queryHistoryDropdown.appendChild(option);
            });
        }
+
+       if (hasMore) {
+           const option = document.createElement('option');
+           option.value = LOAD_MORE_VALUE;
+           option.textContent = 'Load more...';
+           queryHistoryDropdown.appendChild(option);
+       }
+   }
+
+   // Show the recent slice returned with a query; the full list is reloaded on next open
+   function updateQueryHistory(history) {
+       clearQueryHistory();
+       appendQueryHistory(history, true);
+       historyLoaded = false;
+   }
+
+   // Lazily load one page of history from the /history endpoint
+   async function loadHistoryPage(reset) {
+       const passphrase = passphraseInput.value;
+       if (!passphrase) return;
+       if (reset) historyOffset = 0;
+
+       try {
+           const response = await fetch(`/history?offset=${historyOffset}&limit=${HISTORY_PAGE_SIZE}`, {
+               headers: {
+                   'X-App-Passphrase': passphrase,
+                   'X-Session-Id': sessionId
+               }
+           });
+           if (!response.ok) return;
+
+           const data = await response.json();
+           if (reset) clearQueryHistory();
+           appendQueryHistory(data.history, data.has_more);
+           historyOffset += data.history.length;
+           historyLoaded = true;
+       } catch (error) {
+           console.error('Error loading history:', error);
+       }
    }
 
    // Clear form function
@@ -100,8 +160,17 @@ document.addEventListener('DOMContentLoaded', () => {
        dateRangeInputs.style.display = enableDateRange.checked ? 'block' : 'none';
    });
 
+   queryHistoryDropdown.addEventListener('focus', () => {
+       if (!historyLoaded) loadHistoryPage(true);
+   });
+
    queryHistoryDropdown.addEventListener('change', () => {
        const selectedQuery = queryHistoryDropdown.value;
+       if (selectedQuery === LOAD_MORE_VALUE) {
+           queryHistoryDropdown.value = '';
+           loadHistoryPage(!historyLoaded);
+           return;
+       }
        if (selectedQuery) {
            queryInput.value = selectedQuery;
            queryInput.style.height = 'auto';
@@ -133,47 +202,51 @@ document.addEventListener('DOMContentLoaded', () => {
        }
 
        try {
-           const response = await fetch('/query', {
+           const response = await fetch('/query/stream', {
                method: 'POST',
                headers: {
                    'Content-Type': 'application/json',
-                   'X-App-Passphrase': passphrase
+                   'X-App-Passphrase': passphrase,
+                   'X-Session-Id': sessionId
                },
                body: JSON.stringify(payload)
            });
 
-           hideLoading();
-
            if (!response.ok) {
+               hideLoading();
                const errorData = await response.json();
                throw new Error(errorData.error || 'Query failed');
            }
 
-           const data = await response.json();
-
-           if (data.answer) {
-               llmContent.innerHTML = cleanAndFormatText(data.answer);
-               llmResponse.style.display = 'block';
-           }
-
-           if (data.relevant_documents?.length > 0) {
-               docsTableBody.innerHTML = "";
-               data.relevant_documents.forEach(doc => {
-                   const row = document.createElement('tr');
-                   row.innerHTML = `
-                       <td>${doc.title}</td>
-                       <td>${doc.author}</td>
-                       <td>${doc.confidence}</td>
-                       <td>${doc.relevance}</td>
-                   `;
-                   docsTableBody.appendChild(row);
-               });
-               docsTable.style.display = 'table';
-           }
+           let answerText = '';
+           docsTableBody.innerHTML = "";
+
+           await readEventStream(response, (event, data) => {
+               hideLoading();
+
+               if (event === 'document') {
+                   appendDocumentRow(data);
+               } else if (event === 'token') {
+                   answerText += data.text;
+                   llmContent.textContent = answerText;
+                   llmResponse.style.display = 'block';
+               } else if (event === 'summary') {
+                   if (data.answer) {
+                       llmContent.innerHTML = cleanAndFormatText(data.answer);
+                       llmResponse.style.display = 'block';
+                   } else if (data.degraded && data.degraded.includes('answer')) {
+                       llmContent.textContent = 'The summary service is temporarily unavailable; showing matching documents only.';
+                       llmResponse.style.display = 'block';
+                   }
+                   if (data.search_history) {
+                       updateQueryHistory(data.search_history);
+                   }
+               } else if (event === 'error') {
+                   throw new Error(data.error || 'Query failed');
+               }
+           });
 
-           if (data.search_history) {
-               updateQueryHistory(data.search_history);
-           }
+           hideLoading();
            clearForm();
 
        } catch (error) {
@@ -183,6 +256,47 @@ document.addEventListener('DOMContentLoaded', () => {
        }
    });
 
+   // Add one document row to the results table as soon as it arrives
+   function appendDocumentRow(doc) {
+       const row = document.createElement('tr');
+       row.innerHTML = `
+           <td>${doc.title}</td>
+           <td>${doc.author}</td>
+           <td>${doc.confidence}</td>
+           <td>${doc.relevance}</td>
+       `;
+       docsTableBody.appendChild(row);
+       docsTable.style.display = 'table';
+       llmResponse.style.display = 'block';
+   }
+
+   // Read a Server-Sent Events response body and dispatch each event as it arrives
+   async function readEventStream(response, onEvent) {
+       const reader = response.body.getReader();
+       const decoder = new TextDecoder();
+       let buffer = '';
+
+       while (true) {
+           const { value, done } = await reader.read();
+           if (done) break;
+           buffer += decoder.decode(value, { stream: true });
+
+           let boundary;
+           while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+               const rawEvent = buffer.slice(0, boundary);
+               buffer = buffer.slice(boundary + 2);
+
+               let event = 'message';
+               let data = '';
+               rawEvent.split('\n').forEach(line => {
+                   if (line.startsWith('event:')) event = line.slice(6).trim();
+                   else if (line.startsWith('data:')) data += line.slice(5).trim();
+               });
+               if (data) onEvent(event, JSON.parse(data));
+           }
+       }
+   }
+
    // Upload form handler
    const uploadForm = document.getElementById('upload-form');
    const uploadMessage = document.getElementById('upload-message');
@@ -198,35 +312,134 @@ document.addEventListener('DOMContentLoaded', () => {
            return;
        }
 
-       showLoading('Uploading document...');
+       const files = Array.from(fileInput.files);
+       const small = files.filter(file => file.size <= CHUNKED_UPLOAD_THRESHOLD);
+       const large = files.filter(file => file.size > CHUNKED_UPLOAD_THRESHOLD);
+       const statusUrls = [];
+       const rejected = [];
 
-       const formData = new FormData();
-       formData.append('file', fileInput.files[0]);
+       showLoading('Uploading document...');
 
        try {
-           const response = await fetch('/upload', {
-               method: 'POST',
-               headers: {
-                   'X-App-Passphrase': passphrase
-               },
-               body: formData
-           });
+           if (small.length > 0) {
+               const formData = new FormData();
+               small.forEach(file => formData.append('file', file));
+
+               const response = await fetch('/upload', {
+                   method: 'POST',
+                   headers: {
+                       'X-App-Passphrase': passphrase
+                   },
+                   body: formData
+               });
 
-           hideLoading();
+               const data = await response.json();
+               if (!response.ok) throw new Error(data.error);
+               statusUrls.push(data.status_url);
+               rejected.push(...(data.rejected || []));
+           }
 
-           const data = await response.json();
-           if (response.ok) {
-               uploadMessage.textContent = data.message;
-               uploadForm.reset();
-           } else {
-               uploadMessage.textContent = `Error: ${data.error}`;
+           // Large files go in resumable chunks, so a dropped connection only repeats one chunk
+           for (const file of large) {
+               const data = await uploadInChunks(file, passphrase);
+               statusUrls.push(data.status_url);
+           }
+
+           hideLoading();
+           uploadMessage.textContent = `${files.length - rejected.length} file(s) queued for ingestion`;
+           if (rejected.length > 0) {
+               uploadMessage.textContent += ` (skipped: ${rejected.join(', ')})`;
            }
+           uploadForm.reset();
+           pollUploadStatus(statusUrls, passphrase);
        } catch (error) {
            hideLoading();
-           uploadMessage.textContent = `Unexpected error: ${error}`;
+           uploadMessage.textContent = `Error: ${error.message}`;
+           if (statusUrls.length > 0) pollUploadStatus(statusUrls, passphrase);
        }
    });
 
+   // Send one file through /upload/chunked, resuming from the server's offset after a failed chunk
+   async function uploadInChunks(file, passphrase) {
+       const headers = { 'X-App-Passphrase': passphrase };
+       let response = await fetch('/upload/chunked', {
+           method: 'POST',
+           headers: { ...headers, 'Content-Type': 'application/json' },
+           body: JSON.stringify({ filename: file.name, size: file.size })
+       });
+       let data = await response.json();
+       if (!response.ok) throw new Error(`${file.name}: ${data.error}`);
+
+       const uploadUrl = data.upload_url;
+       const chunkSize = data.chunk_size;
+       let offset = data.offset;
+       let failures = 0;
+       while (offset < file.size) {
+           showLoading(`Uploading ${file.name}: ${Math.floor(offset * 100 / file.size)}%`);
+           try {
+               response = await fetch(uploadUrl, {
+                   method: 'PUT',
+                   headers: { ...headers, 'Upload-Offset': String(offset) },
+                   body: file.slice(offset, offset + chunkSize)
+               });
+               data = await response.json();
+               if (!response.ok && response.status !== 409) throw new Error(data.error);
+               // A 409 carries the offset the server expects next
+               offset = data.offset;
+               failures = 0;
+           } catch (error) {
+               if (++failures > CHUNK_MAX_RETRIES) throw new Error(`${file.name}: ${error.message}`);
+               await new Promise(resolve => setTimeout(resolve, 1000 * failures));
+               const status = await fetch(uploadUrl, { headers }).catch(() => null);
+               if (status && status.ok) offset = (await status.json()).offset;
+           }
+       }
+
+       response = await fetch(`${uploadUrl}/complete`, { method: 'POST', headers });
+       data = await response.json();
+       if (!response.ok) throw new Error(`${file.name}: ${data.error}`);
+       return data;
+   }
+
+   // Poll ingestion jobs until every file has completed, been skipped as a duplicate, or failed
+   async function pollUploadStatus(statusUrls, passphrase) {
+       while (true) {
+           await new Promise(resolve => setTimeout(resolve, 2000));
+           try {
+               const jobs = [];
+               for (const statusUrl of statusUrls) {
+                   const response = await fetch(statusUrl, {
+                       headers: { 'X-App-Passphrase': passphrase }
+                   });
+                   if (!response.ok) return;
+                   jobs.push(await response.json());
+               }
+
+               const total = jobs.reduce((sum, job) => sum + job.total, 0);
+               const completed = jobs.reduce((sum, job) => sum + job.completed, 0);
+               const duplicates = jobs.reduce((sum, job) => sum + job.duplicates, 0);
+               const failed = jobs.flatMap(job => job.files.filter(f => f.status === 'failed'));
+               const done = completed + duplicates + failed.length;
+               uploadMessage.textContent = `Ingesting: ${done}/${total} file(s) processed`;
+
+               if (done === total) {
+                   uploadMessage.textContent = `${completed} file(s) uploaded successfully`;
+                   if (duplicates > 0) {
+                       uploadMessage.textContent += `, ${duplicates} already in the collection`;
+                   }
+                   if (failed.length > 0) {
+                       uploadMessage.textContent += `, ${failed.length} failed: ` +
+                           failed.map(f => `${f.filename} (${f.error})`).join(', ');
+                   }
+                   return;
+               }
+           } catch (error) {
+               console.error('Error polling upload status:', error);
+               return;
+           }
+       }
+   }
+
    // Clean and format text function
    function cleanAndFormatText(text) {
        text = text.replace(/\*\*AI Assistant Summary\*\*/g, '');
@@ -0,0 +1,103 @@
+import time
+import multiprocessing
+from utils.cache import LRUCache, SQLiteCache, GenerationCounter
+
+
+def test_lru_cache_evicts_the_least_recently_used_entry():
+    cache = LRUCache(max_entries=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+
+
+def test_lru_cache_expires_entries():
+    cache = LRUCache(max_entries=2, ttl=60)
+    cache.set('a', 1, ttl=0.01)
+    time.sleep(0.02)
+    assert cache.get('a') is None
+
+
+def test_sqlite_cache_round_trip_and_expiry(tmp_path):
+    cache = SQLiteCache(str(tmp_path / 'cache.sqlite3'), max_entries=10, ttl=60)
+    cache.set('a', {'scores': [0.5, 0.25]})
+    assert cache.get('a') == {'scores': [0.5, 0.25]}
+    cache.set('b', 1, ttl=-1)
+    assert cache.get('b') is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_sqlite_cache_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / 'cache.sqlite3')
+    SQLiteCache(path, max_entries=10, ttl=60).set('a', 1)
+    assert SQLiteCache(path, max_entries=10, ttl=60).get('a') == 1
+
+
+def test_sqlite_cache_hits_do_not_write_until_the_touch_interval(tmp_path):
+    cache = SQLiteCache(str(tmp_path / 'cache.sqlite3'), max_entries=10, ttl=60)
+    cache.set('a', 1)
+    conn = cache._connect()
+    writes = conn.total_changes
+    for _ in range(20):
+        assert cache.get('a') == 1
+    assert conn.total_changes == writes
+    cache.TOUCH_INTERVAL = 0
+    cache.get('a')
+    assert conn.total_changes == writes + 1
+
+
+def test_sqlite_cache_purge_keeps_the_most_recent_entries(tmp_path):
+    cache = SQLiteCache(str(tmp_path / 'cache.sqlite3'), max_entries=2, ttl=60)
+    for key in ('a', 'b', 'c'):
+        cache.set(key, key)
+        time.sleep(0.01)
+    cache.purge()
+    assert cache.get('a') is None and cache.get('c') == 'c'
+
+
+def test_generation_counter_in_process():
+    counter = GenerationCounter()
+    assert counter.current() == 0
+    assert counter.bump() == 1 and counter.current() == 1
+
+
+def test_generation_counter_file_is_shared(tmp_path):
+    path = str(tmp_path / 'generation')
+    first, second = GenerationCounter(path), GenerationCounter(path)
+    assert first.current() == 0
+    first.bump()
+    assert second.bump() == 2
+    assert first.current() == 2
+
+
+def test_generation_counter_never_falls_back_to_zero(tmp_path):
+    path = tmp_path / 'generation'
+    counter = GenerationCounter(str(path))
+    counter.bump()
+    counter.bump()
+    path.write_text('')
+    assert counter.current() == 2
+
+
+def _bump(path, times):
+    counter = GenerationCounter(path)
+    for _ in range(times):
+        counter.bump()
+
+
+def test_generation_counter_concurrent_bumps_are_not_lost(tmp_path):
+    path = str(tmp_path / 'generation')
+    processes = [multiprocessing.Process(target=_bump, args=(path, 50)) for _ in range(3)]
+    for process in processes:
+        process.start()
+    reader = GenerationCounter(path)
+    seen = 0
+    while any(process.is_alive() for process in processes):
+        value = reader.current()
+        assert value >= seen
+        seen = value
+    for process in processes:
+        process.join()
+    assert reader.current() == 150
@@ -0,0 +1,113 @@
+import time
+import asyncio
+import threading
+import pytest
+from utils.rate_limit import TokenBucket, AIMDController, OutboundLimiter, LimitExceeded
+
+
+def test_bucket_allows_a_burst_then_refuses_beyond_the_timeout():
+    bucket = TokenBucket(rate=1, burst=3)
+    assert all(bucket.acquire(0) for _ in range(3))
+    assert not bucket.acquire(0.1)
+
+
+def test_bucket_waits_for_a_token_due_within_the_timeout():
+    bucket = TokenBucket(rate=20, burst=1)
+    assert bucket.acquire(0)
+    started = time.monotonic()
+    assert bucket.acquire(1)
+    assert 0.03 <= time.monotonic() - started < 0.5
+
+
+def test_bucket_file_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / 'shared.bucket')
+    first, second = TokenBucket(1, 2, path), TokenBucket(1, 2, path)
+    assert first.acquire(0) and second.acquire(0)
+    assert not first.acquire(0.1) and not second.acquire(0.1)
+
+
+def test_async_bucket_reservation(tmp_path):
+    bucket = TokenBucket(20, 1, str(tmp_path / 'async.bucket'))
+
+    async def main():
+        return [await bucket.acquire_async(1) for _ in range(3)]
+
+    assert asyncio.run(main()) == [True, True, True]
+
+
+def test_concurrency_limit_and_release():
+    limiter = AIMDController(minimum=1, maximum=2)
+    assert limiter.acquire(0) and limiter.acquire(0)
+    assert not limiter.acquire(0.05)
+    threading.Timer(0.05, limiter.release).start()
+    assert limiter.acquire(1)
+
+
+def test_throttled_release_halves_the_limit():
+    limiter = AIMDController(minimum=1, maximum=8)
+    assert limiter.acquire(0)
+    limiter.release(throttled=True)
+    assert limiter.limit == 4 and limiter.decreases == 1
+
+
+def test_successful_calls_grow_the_limit_back():
+    limiter = AIMDController(minimum=1, maximum=8)
+    limiter.limit = 2.0
+    for _ in range(4):
+        assert limiter.acquire(0)
+        limiter.release(latency=0.01)
+    assert 2.0 < limiter.limit <= 8
+
+
+def test_async_waiter_is_woken_by_a_release_from_another_thread():
+    limiter = AIMDController(minimum=1, maximum=1)
+    assert limiter.try_acquire()
+
+    async def main():
+        threading.Timer(0.05, limiter.release, kwargs={'latency': 0.01}).start()
+        started = time.monotonic()
+        acquired = await limiter.acquire_async(2)
+        return acquired, time.monotonic() - started
+
+    acquired, waited = asyncio.run(main())
+    assert acquired and waited < 1
+    assert not limiter._async_waiters
+
+
+def test_async_waiter_gives_up_at_its_timeout():
+    limiter = AIMDController(minimum=1, maximum=1)
+    assert limiter.try_acquire()
+
+    async def main():
+        return await limiter.acquire_async(0.05)
+
+    assert not asyncio.run(main())
+    assert not limiter._async_waiters
+
+
+def test_async_waiters_take_slots_in_turn():
+    limiter = AIMDController(minimum=2, maximum=2)
+    in_flight, peak = [0], [0]
+
+    async def user():
+        assert await limiter.acquire_async(2)
+        in_flight[0] += 1
+        peak[0] = max(peak[0], in_flight[0])
+        await asyncio.sleep(0.01)
+        in_flight[0] -= 1
+        limiter.release(latency=0.01)
+
+    async def main():
+        await asyncio.gather(*[user() for _ in range(10)])
+
+    asyncio.run(main())
+    assert peak[0] == 2 and limiter._in_flight == 0
+
+
+def test_limiter_slot_raises_when_no_slot_frees_up():
+    limiter = OutboundLimiter(None, AIMDController(minimum=1, maximum=1))
+    with limiter.slot(1, lambda e: False):
+        with pytest.raises(LimitExceeded):
+            with limiter.slot(0.05, lambda e: False):
+                pass
+    assert limiter.concurrency._in_flight == 0
@@ -0,0 +1,117 @@
+import time
+import pytest
+from utils.resilience import CircuitBreaker, RetryBudget, ServicePolicy, ServiceUnavailable, CircuitOpenError
+
+
+def _policy(timeout=1.0, deadline=2.0, max_retries=2, failure_threshold=3, isolate=False):
+    return ServicePolicy('test', timeout, deadline, max_retries=max_retries, backoff=0.001,
+                         breaker=CircuitBreaker(failure_threshold, reset_timeout=0.05),
+                         budget=RetryBudget(ratio=1.0, min_per_second=100), isolate=isolate)
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+    assert not breaker.record_failure()
+    breaker.record_success()
+    assert [breaker.record_failure() for _ in range(3)] == [False, False, True]
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+
+def test_breaker_half_open_allows_a_single_probe():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.available()
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+
+
+def test_breaker_probe_outcome_closes_or_reopens():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN and breaker.opened == 2
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.allow()
+
+
+def test_call_retries_transient_failures():
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ConnectionError('reset')
+        return 'ok'
+
+    policy = _policy()
+    assert policy.call(flaky) == 'ok'
+    assert len(attempts) == 3
+    assert policy.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_call_does_not_retry_caller_errors():
+    attempts = []
+
+    def bad_request():
+        attempts.append(1)
+        raise ValueError('bad input')
+
+    with pytest.raises(ValueError):
+        _policy().call(bad_request)
+    assert len(attempts) == 1
+
+
+def test_open_circuit_fails_fast():
+    def down():
+        raise ConnectionError('down')
+
+    policy = _policy(max_retries=0, failure_threshold=2)
+    for _ in range(2):
+        with pytest.raises(ServiceUnavailable):
+            policy.call(down)
+    with pytest.raises(CircuitOpenError):
+        policy.call(lambda: 'never called')
+
+
+def test_isolated_call_stops_waiting_at_the_timeout():
+    policy = _policy(timeout=0.05, max_retries=0, isolate=True)
+    started = time.monotonic()
+    with pytest.raises(ServiceUnavailable):
+        policy.call(time.sleep, 0.5)
+    assert time.monotonic() - started < 0.4
+
+
+def _chunks(delays):
+    for delay in delays:
+        time.sleep(delay)
+        yield delay
+
+
+def test_stream_yields_every_item():
+    policy = _policy(isolate=True)
+    assert list(policy.stream(lambda: _chunks([0, 0, 0]))) == [0, 0, 0]
+    assert policy.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_stream_item_timeout_raises_service_unavailable():
+    policy = _policy(timeout=0.05, deadline=1.0, failure_threshold=1, isolate=True)
+    with pytest.raises(ServiceUnavailable):
+        list(policy.stream(lambda: _chunks([0, 0.3])))
+    assert policy.breaker.state == CircuitBreaker.OPEN
+
+
+def test_stream_deadline_bounds_the_whole_stream():
+    policy = _policy(timeout=0.1, deadline=0.2, isolate=True)
+    started = time.monotonic()
+    with pytest.raises(ServiceUnavailable):
+        list(policy.stream(lambda: _chunks([0.05] * 10)))
+    assert time.monotonic() - started < 0.35
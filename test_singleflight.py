@@ -0,0 +1,100 @@
+import time
+import asyncio
+import threading
+from utils.singleflight import SingleFlight, AsyncSingleFlight
+
+
+def _run_concurrently(flight, key, fn, callers):
+    results, errors = [], []
+
+    def call():
+        try:
+            results.append(flight.do(key, fn))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(callers)]
+    for thread in threads:
+        thread.start()
+    return threads, results, errors
+
+
+def _wait_for_followers(flight, key, release):
+    # Followers are parked on the leader's call once it is registered; give them time to arrive
+    while key not in flight._calls:
+        time.sleep(0.001)
+    time.sleep(0.1)
+    release.set()
+
+
+def test_concurrent_calls_share_one_execution():
+    flight = SingleFlight('test', wait_stage=None)
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        release.wait(5)
+        return 'answer'
+
+    threads, results, errors = _run_concurrently(flight, 'k', compute, 8)
+    _wait_for_followers(flight, 'k', release)
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results == ['answer'] * 8 and not errors
+
+
+def test_followers_receive_the_leaders_exception():
+    flight = SingleFlight('test', wait_stage=None)
+    release = threading.Event()
+
+    def fail():
+        release.wait(5)
+        raise RuntimeError('boom')
+
+    threads, results, errors = _run_concurrently(flight, 'k', fail, 4)
+    _wait_for_followers(flight, 'k', release)
+    for thread in threads:
+        thread.join()
+    assert not results
+    assert len(errors) == 4 and all(str(e) == 'boom' for e in errors)
+
+
+def test_completed_calls_are_not_cached():
+    flight = SingleFlight('test', wait_stage=None)
+    counter = iter(range(10))
+    assert flight.do('k', lambda: next(counter)) == 0
+    assert flight.do('k', lambda: next(counter)) == 1
+    assert not flight._calls
+
+
+def test_async_calls_share_one_execution():
+    flight = AsyncSingleFlight('test')
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 'answer'
+
+    async def main():
+        return await asyncio.gather(*[flight.do('k', compute) for _ in range(5)])
+
+    assert asyncio.run(main()) == ['answer'] * 5
+    assert len(calls) == 1
+
+
+def test_async_failure_reaches_every_caller():
+    flight = AsyncSingleFlight('test')
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise RuntimeError('boom')
+
+    async def main():
+        return await asyncio.gather(*[flight.do('k', fail) for _ in range(3)], return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert not flight._calls
@@ -0,0 +1,118 @@
+import io
+import hashlib
+import threading
+import pytest
+from services.uploads import ChunkedUploads, MemoryUploadSessions, SQLiteUploadSessions, UploadOffsetMismatch
+
+DATA = bytes(range(256)) * 40
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def uploads(request, tmp_path):
+    sessions = MemoryUploadSessions() if request.param == 'memory' \
+        else SQLiteUploadSessions(str(tmp_path / 'sessions.sqlite3'))
+    return ChunkedUploads(sessions, str(tmp_path), chunk_size=4096, ttl=3600)
+
+
+def _send(uploads, upload_id, offset, data):
+    return uploads.append(upload_id, offset, io.BytesIO(data), len(data))
+
+
+def test_chunks_complete_into_the_original_file(uploads):
+    upload_id = uploads.start('data.bin', len(DATA))['upload_id']
+    offset = 0
+    while offset < len(DATA):
+        offset = _send(uploads, upload_id, offset, DATA[offset:offset + 4096])
+    file_path, filename, digest = uploads.complete(upload_id)
+    with open(file_path, 'rb') as f:
+        assert f.read() == DATA
+    assert filename == 'data.bin' and digest == hashlib.sha256(DATA).hexdigest()
+
+
+def test_chunk_at_the_wrong_offset_reports_where_to_resume(uploads):
+    upload_id = uploads.start('data.bin', len(DATA))['upload_id']
+    _send(uploads, upload_id, 0, DATA[:1000])
+    with pytest.raises(UploadOffsetMismatch) as mismatch:
+        _send(uploads, upload_id, 2000, DATA[2000:3000])
+    assert mismatch.value.offset == 1000
+    assert uploads.status(upload_id)['offset'] == 1000
+
+
+def test_interrupted_chunk_is_dropped_and_resumed(uploads):
+    upload_id = uploads.start('data.bin', len(DATA))['upload_id']
+    _send(uploads, upload_id, 0, DATA[:4096])
+    with pytest.raises(UploadOffsetMismatch) as mismatch:
+        # The client disconnects 100 bytes into a 4096-byte chunk
+        uploads.append(upload_id, 4096, io.BytesIO(DATA[4096:4196]), 4096)
+    assert mismatch.value.offset == 4096
+    assert uploads.status(upload_id)['offset'] == 4096
+    offset = 4096
+    while offset < len(DATA):
+        offset = _send(uploads, upload_id, offset, DATA[offset:offset + 4096])
+    _, _, digest = uploads.complete(upload_id)
+    assert digest == hashlib.sha256(DATA).hexdigest()
+
+
+def test_resume_in_another_worker_rebuilds_the_hash(tmp_path):
+    sessions = SQLiteUploadSessions(str(tmp_path / 'sessions.sqlite3'))
+    upload_id = ChunkedUploads(sessions, str(tmp_path), 4096, 3600).start('data.bin', len(DATA))['upload_id']
+    _send(ChunkedUploads(sessions, str(tmp_path), 4096, 3600), upload_id, 0, DATA[:4096])
+    other_worker = ChunkedUploads(sessions, str(tmp_path), 4096, 3600)
+    offset = 4096
+    while offset < len(DATA):
+        offset = _send(other_worker, upload_id, offset, DATA[offset:offset + 4096])
+    assert other_worker.complete(upload_id)[2] == hashlib.sha256(DATA).hexdigest()
+
+
+def test_oversized_chunk_and_overrun_are_rejected(uploads):
+    upload_id = uploads.start('data.bin', 5000)['upload_id']
+    with pytest.raises(ValueError):
+        _send(uploads, upload_id, 0, DATA[:4097])
+    _send(uploads, upload_id, 0, DATA[:4096])
+    with pytest.raises(ValueError):
+        _send(uploads, upload_id, 4096, DATA[:1000])
+
+
+def test_incomplete_upload_cannot_complete(uploads):
+    upload_id = uploads.start('data.bin', len(DATA))['upload_id']
+    _send(uploads, upload_id, 0, DATA[:4096])
+    with pytest.raises(UploadOffsetMismatch) as mismatch:
+        uploads.complete(upload_id)
+    assert mismatch.value.offset == 4096
+
+
+def test_double_complete_is_an_unknown_upload(uploads):
+    upload_id = uploads.start('data.bin', 10)['upload_id']
+    _send(uploads, upload_id, 0, DATA[:10])
+    uploads.complete(upload_id)
+    with pytest.raises(KeyError):
+        uploads.complete(upload_id)
+    with pytest.raises(KeyError):
+        uploads.complete('unknown')
+
+
+def test_concurrent_completes_finish_the_upload_once(uploads):
+    upload_id = uploads.start('data.bin', 10)['upload_id']
+    _send(uploads, upload_id, 0, DATA[:10])
+    outcomes = []
+
+    def complete():
+        try:
+            uploads.complete(upload_id)
+            outcomes.append('completed')
+        except KeyError:
+            outcomes.append('unknown')
+
+    threads = [threading.Thread(target=complete) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(outcomes) == ['completed'] + ['unknown'] * 3
+
+
+def test_idle_uploads_are_purged(uploads):
+    upload_id = uploads.start('data.bin', 10)['upload_id']
+    uploads.ttl = -1
+    uploads.purge_expired()
+    assert uploads.status(upload_id) is None
@@ -0,0 +1,266 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from utils.storage import SQLiteStore, fcntl
+
+
+def normalize_text(text: str) -> str:
+    """Normalize text for cache keys: lowercase, drop punctuation and collapse whitespace."""
+    text = re.sub(r'[^\w\s]', ' ', (text or '').lower())
+    return ' '.join(text.split())
+
+
+def hash_key(*parts) -> str:
+    """Build a stable hash key from parts used verbatim."""
+    joined = '\x1f'.join(str(part) for part in parts)
+    return hashlib.sha256(joined.encode('utf-8')).hexdigest()
+
+
+def cache_key(*parts) -> str:
+    """Build a stable hash key from normalized text parts."""
+    return hash_key(*(normalize_text(str(part)) for part in parts))
+
+
+class LRUCache:
+    """
+    Thread-safe in-process LRU cache with per-entry TTL and hit/miss statistics.
+    When `max_bytes` is set, entries are also evicted to keep the total of
+    `sizeof(value)` under that bound.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, max_bytes: int = None, sizeof=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: len(json.dumps(value)))
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    self._remove(key)
+                    self.evictions += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: str, value, ttl: float = None):
+        if self.max_entries <= 0:
+            return
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        size = self.sizeof(value) if self.max_bytes else 0
+        if self.max_bytes and size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires_at, value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or (self.max_bytes and self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key: str):
+        self._bytes -= self._entries.pop(key)[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+
+class SQLiteCache(SQLiteStore):
+    """
+    On-disk cache shared by every worker process on the host.
+    Values are stored as JSON; expired and least recently used entries are
+    purged periodically so the table stays under `max_entries`. Recency is
+    tracked to within TOUCH_INTERVAL, so most hits are read-only.
+    """
+
+    PRAGMAS = ('synchronous=NORMAL',)
+    PURGE_EVERY = 256
+    # Hits refresh accessed_at at most this often (seconds), so reads rarely need the WAL write lock
+    TOUCH_INTERVAL = 300
+
+    def __init__(self, path: str, max_entries: int, ttl: float, table: str = 'cache'):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.table = table
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self._open(path).execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+
+    def get(self, key: str):
+        now = time.time()
+        try:
+            conn = self._connect()
+            row = conn.execute(
+                f"SELECT value, accessed_at FROM {self.table} WHERE key = ? AND expires_at >= ?", (key, now)
+            ).fetchone()
+            if row is not None and now - row[1] >= self.TOUCH_INTERVAL:
+                conn.execute(f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?", (now, key))
+        except sqlite3.Error:
+            row = None
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key: str, value, ttl: float = None):
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        try:
+            self._connect().execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), expires_at, now)
+            )
+        except sqlite3.Error:
+            return
+        with self._lock:
+            self._writes += 1
+            purge = self._writes % self.PURGE_EVERY == 0
+        if purge:
+            self.purge()
+
+    def purge(self):
+        """Delete expired entries and trim the table to `max_entries`."""
+        try:
+            conn = self._connect()
+            conn.execute(f"DELETE FROM {self.table} WHERE expires_at < ?", (time.time(),))
+            conn.execute(
+                f"DELETE FROM {self.table} WHERE key IN ("
+                f"SELECT key FROM {self.table} ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+        except sqlite3.Error:
+            pass
+
+    def clear(self):
+        self._connect().execute(f"DELETE FROM {self.table}")
+
+    def stats(self) -> dict:
+        try:
+            entries = self._connect().execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        except sqlite3.Error:
+            entries = None
+        with self._lock:
+            return {'entries': entries, 'hits': self.hits, 'misses': self.misses}
+
+
+class TieredCache:
+    """In-process LRU tier in front of an optional shared on-disk tier."""
+
+    def __init__(self, memory: LRUCache, disk: SQLiteCache = None):
+        self.memory = memory
+        self.disk = disk
+
+    def get(self, key: str):
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.set(key, value)
+        return value
+
+    def set(self, key: str, value):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self) -> dict:
+        stats = {'memory': self.memory.stats()}
+        if self.disk is not None:
+            stats['disk'] = self.disk.stats()
+        return stats
+
+
+def build_tiered_cache(path: str, memory_entries: int, max_entries: int, ttl: float,
+                       table: str = 'cache') -> TieredCache:
+    """Create a tiered cache; an empty `path` keeps it in-process only."""
+    disk = SQLiteCache(path, max_entries, ttl, table=table) if path else None
+    return TieredCache(LRUCache(memory_entries, ttl), disk)
+
+
+class GenerationCounter:
+    """
+    Monotonic counter stored in a small file so every worker sees bumps made
+    by the others. Cache keys that include the current generation are
+    invalidated by a bump without touching the cached entries themselves.
+    An empty `path` keeps the counter in-process only.
+
+    Bumps are serialized by a lock on `<path>.lock` and replace the counter
+    file atomically, so a reader sees either the old or the new value.
+    """
+
+    def __init__(self, path: str = ''):
+        self.path = path
+        self._value = 0
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def _read(self) -> int:
+        try:
+            with open(self.path) as f:
+                value = int(f.read().strip())
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError):
+            # Unreadable counter: the last value this process saw is never older than what was cached under it
+            return self._value
+        self._value = max(self._value, value)
+        return value
+
+    def current(self) -> int:
+        if not self.path:
+            return self._value
+        return self._read()
+
+    def bump(self) -> int:
+        with self._lock:
+            if not self.path:
+                self._value += 1
+                return self._value
+            with open(f"{self.path}.lock", 'a') as lock:
+                if fcntl:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                value = self._read() + 1
+                tmp = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp, 'w') as f:
+                    f.write(str(value))
+                os.replace(tmp, self.path)
+            self._value = max(self._value, value)
+            return value
@@ -0,0 +1,60 @@
+import gzip
+from config import RESPONSE_COMPRESSION, RESPONSE_COMPRESSION_MIN_BYTES
+from utils.metrics import metrics
+
+try:
+    import brotli
+except ImportError:  # optional: responses fall back to gzip
+    brotli = None
+
+# Fast settings: responses are compressed on the request path, once each
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/')
+
+ENCODINGS = [encoding for encoding in RESPONSE_COMPRESSION
+             if encoding == 'gzip' or (encoding == 'br' and brotli is not None)]
+
+metrics.describe('crag_response_bytes_total', 'Bytes of compressed responses before and after compression')
+
+
+def accepted_encodings(header: str) -> dict:
+    """Parse an Accept-Encoding header into {encoding: quality}."""
+    accepted = {}
+    for item in (header or '').split(','):
+        name, _, params = item.strip().partition(';')
+        if not name:
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name.strip().lower()] = quality
+    return accepted
+
+
+def choose_encoding(header: str):
+    """The first configured encoding the client accepts (explicitly or through *), or None."""
+    accepted = accepted_encodings(header)
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def should_compress(content_type: str, length: int, content_encoding: str = None) -> bool:
+    return (bool(ENCODINGS) and not content_encoding and length >= RESPONSE_COMPRESSION_MIN_BYTES
+            and (content_type or '').startswith(COMPRESSIBLE_TYPES))
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    compressed = brotli.compress(data, quality=BROTLI_QUALITY) if encoding == 'br' \
+        else gzip.compress(data, compresslevel=GZIP_LEVEL)
+    metrics.inc('crag_response_bytes_total', {'encoding': encoding, 'stage': 'original'}, len(data))
+    metrics.inc('crag_response_bytes_total', {'encoding': encoding, 'stage': 'compressed'}, len(compressed))
+    return compressed
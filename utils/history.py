@@ -0,0 +1,126 @@
+import time
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+from utils.storage import SQLiteStore
+
+
+class MemoryHistoryStore:
+    """
+    Per-session search history kept in fixed-capacity ring buffers.
+    Only the `max_sessions` most recently active sessions are kept.
+    """
+
+    def __init__(self, capacity: int, max_sessions: int):
+        self.capacity = capacity
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+
+    def add(self, session_id: str, query: str, answer: str):
+        entry = {"query": query, "answer": answer, "created_at": time.time()}
+        with self._lock:
+            entries = self._sessions.get(session_id)
+            if entries is None:
+                entries = self._sessions[session_id] = deque(maxlen=self.capacity)
+            self._sessions.move_to_end(session_id)
+            entries.append(entry)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def page(self, session_id: str, offset: int = 0, limit: int = 20):
+        """Return (entries, total) for one session, newest first."""
+        with self._lock:
+            entries = list(self._sessions.get(session_id, ()))
+        entries.reverse()
+        return entries[offset:offset + limit], len(entries)
+
+
+class SQLiteHistoryStore(SQLiteStore):
+    """
+    Per-session search history persisted in a local SQLite file, so every
+    worker serves the same history. Each session is trimmed to `capacity`, and
+    the least recently active sessions beyond `max_sessions` are evicted every
+    TRIM_SESSIONS_EVERY additions, using the small `history_sessions` table.
+    """
+
+    TRIM_SESSIONS_EVERY = 32
+
+    def __init__(self, path: str, capacity: int, max_sessions: int):
+        self.capacity = capacity
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._adds = 0
+        conn = self._open(path)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, "
+            "query TEXT NOT NULL, answer TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS history_session ON history (session_id, id)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS history_sessions (session_id TEXT PRIMARY KEY, last_seen REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS history_sessions_seen ON history_sessions (last_seen)")
+        # Sessions recorded before the sessions table existed
+        conn.execute(
+            "INSERT OR IGNORE INTO history_sessions (session_id, last_seen) "
+            "SELECT session_id, MAX(created_at) FROM history GROUP BY session_id"
+        )
+
+    def add(self, session_id: str, query: str, answer: str):
+        now = time.time()
+        with self._lock:
+            self._adds += 1
+            trim_sessions = self._adds % self.TRIM_SESSIONS_EVERY == 0
+        conn = self._connect()
+        # One write transaction per request instead of one per statement
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO history (session_id, query, answer, created_at) VALUES (?, ?, ?, ?)",
+                (session_id, query, answer, now)
+            )
+            conn.execute(
+                "INSERT INTO history_sessions (session_id, last_seen) VALUES (?, ?) "
+                "ON CONFLICT (session_id) DO UPDATE SET last_seen = excluded.last_seen",
+                (session_id, now)
+            )
+            conn.execute(
+                "DELETE FROM history WHERE session_id = ? AND id NOT IN ("
+                "SELECT id FROM history WHERE session_id = ? ORDER BY id DESC LIMIT ?)",
+                (session_id, session_id, self.capacity)
+            )
+            if trim_sessions:
+                self._evict_sessions(conn)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _evict_sessions(self, conn: sqlite3.Connection):
+        # Session ids come from clients, so evict the least recently active sessions
+        evicted = [row[0] for row in conn.execute(
+            "SELECT session_id FROM history_sessions ORDER BY last_seen DESC LIMIT -1 OFFSET ?",
+            (self.max_sessions,)
+        )]
+        conn.executemany("DELETE FROM history WHERE session_id = ?", [(s,) for s in evicted])
+        conn.executemany("DELETE FROM history_sessions WHERE session_id = ?", [(s,) for s in evicted])
+
+    def page(self, session_id: str, offset: int = 0, limit: int = 20):
+        """Return (entries, total) for one session, newest first."""
+        conn = self._connect()
+        rows = conn.execute(
+            "SELECT query, answer, created_at FROM history WHERE session_id = ? "
+            "ORDER BY id DESC LIMIT ? OFFSET ?",
+            (session_id, limit, offset)
+        ).fetchall()
+        total = conn.execute("SELECT COUNT(*) FROM history WHERE session_id = ?", (session_id,)).fetchone()[0]
+        return [{"query": q, "answer": a, "created_at": c} for q, a, c in rows], total
+
+
+def build_history_store(path: str, capacity: int, max_sessions: int):
+    """Create the history store; an empty `path` keeps history in-process only."""
+    if path:
+        return SQLiteHistoryStore(path, capacity, max_sessions)
+    return MemoryHistoryStore(capacity, max_sessions)
@@ -0,0 +1,330 @@
+import os
+import json
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from config import METRICS_DIR, METRICS_FLUSH_INTERVAL
+
+# Histogram buckets in seconds, from fast cache hits up to slow LLM generations
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_current_request = contextvars.ContextVar('crag_request_timings', default=None)
+
+
+class RequestTimings:
+    """Stage durations and outbound call counts collected for one request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.calls = {}
+        self.degraded = set()
+        self._lock = threading.Lock()
+
+    def add_stage(self, name: str, seconds: float):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def add_call(self, service: str):
+        with self._lock:
+            self.calls[service] = self.calls.get(service, 0) + 1
+
+    def add_degraded(self, mode: str) -> bool:
+        with self._lock:
+            if mode in self.degraded:
+                return False
+            self.degraded.add(mode)
+            return True
+
+    def server_timing(self) -> str:
+        """Format the collected stages as a Server-Timing header value."""
+        with self._lock:
+            parts = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages.items()]
+            parts.extend(f"{service}-calls;desc=\"{count} calls\"" for service, count in self.calls.items())
+        parts.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.1f}")
+        return ', '.join(parts)
+
+
+class MetricsRegistry:
+    """
+    Process-local counters, gauges and histograms with Prometheus text output.
+
+    With a metrics directory configured, each worker periodically writes its
+    snapshot to `<dir>/metrics-<pid>.json` and the /metrics endpoint merges the
+    snapshots of all workers, so the numbers cover the whole gunicorn pool.
+    """
+
+    def __init__(self, directory: str, flush_interval: float):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+        self._collectors = []
+        self._last_flush = 0.0
+        self._flush_lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._remove_dead_worker_files()
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted((labels or {}).items()))
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def inc(self, name: str, labels: dict = None, amount: float = 1):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+        self._maybe_flush()
+
+    def observe(self, name: str, seconds: float, labels: dict = None):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += seconds
+            histogram[2] += 1
+        self._maybe_flush()
+
+    def register_collector(self, collector):
+        """
+        Register a callable returning (kind, name, labels, value) samples, where kind
+        is 'counter' or 'gauge'. Collectors report state owned by other modules.
+        """
+        self._collectors.append(collector)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = [[name, list(labels), value] for (name, labels), value in self._counters.items()]
+            histograms = [[name, list(labels), list(h[0]), h[1], h[2]]
+                          for (name, labels), h in self._histograms.items()]
+        gauges = []
+        for collector in self._collectors:
+            try:
+                samples = collector()
+            except Exception:
+                continue
+            for kind, name, labels, value in samples:
+                entry = [name, sorted((labels or {}).items()), value]
+                (counters if kind == 'counter' else gauges).append(entry)
+        return {'pid': os.getpid(), 'counters': counters, 'gauges': gauges, 'histograms': histograms}
+
+    def _path(self, pid: int) -> str:
+        return os.path.join(self.directory, f"metrics-{pid}.json")
+
+    def _maybe_flush(self):
+        if not self.directory:
+            return
+        # Only the thread that moves _last_flush forward writes this interval's snapshot
+        with self._flush_lock:
+            now = time.monotonic()
+            if now - self._last_flush < self.flush_interval:
+                return
+            self._last_flush = now
+        self._write()
+
+    def flush(self):
+        """Write this worker's snapshot for the other workers to merge."""
+        if not self.directory:
+            return
+        with self._flush_lock:
+            self._last_flush = time.monotonic()
+        self._write()
+
+    def _write(self):
+        path = self._path(os.getpid())
+        # A tmp file per thread, so concurrent writers never interleave before the atomic replace
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp, path)
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    def _remove_dead_worker_files(self):
+        for pid, path in self._worker_files():
+            if not _pid_alive(pid):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _worker_files(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        files = []
+        for name in names:
+            if name.startswith('metrics-') and name.endswith('.json'):
+                try:
+                    files.append((int(name[8:-5]), os.path.join(self.directory, name)))
+                except ValueError:
+                    continue
+        return files
+
+    def _collect_all(self) -> list:
+        if not self.directory:
+            return [self.snapshot()]
+        self.flush()
+        snapshots = []
+        for pid, path in self._worker_files():
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            # Gauges describe live state, so exited workers only contribute their counters
+            if not _pid_alive(pid):
+                snapshot['gauges'] = []
+            snapshots.append(snapshot)
+        return snapshots
+
+    def render(self) -> str:
+        """Render metrics merged across all workers in Prometheus text format."""
+        counters, gauges, histograms = {}, {}, {}
+        for snapshot in self._collect_all():
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(tuple(label) for label in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, value in snapshot['gauges']:
+                key = (name, tuple(tuple(label) for label in labels))
+                gauges[key] = gauges.get(key, 0) + value
+            for name, labels, buckets, total, count in snapshot['histograms']:
+                key = (name, tuple(tuple(label) for label in labels))
+                merged = histograms.setdefault(key, [[0] * len(BUCKETS), 0.0, 0])
+                merged[0] = [a + b for a, b in zip(merged[0], buckets)]
+                merged[1] += total
+                merged[2] += count
+
+        lines = []
+        for kind, samples in (('counter', counters), ('gauge', gauges)):
+            for name in sorted({name for name, _ in samples}):
+                lines.extend(self._header(name, kind))
+                for (sample_name, labels), value in sorted(samples.items()):
+                    if sample_name == name:
+                        lines.append(f"{name}{_labels(labels)} {_number(value)}")
+        for name in sorted({name for name, _ in histograms}):
+            lines.extend(self._header(name, 'histogram'))
+            for (sample_name, labels), (buckets, total, count) in sorted(histograms.items()):
+                if sample_name != name:
+                    continue
+                cumulative = 0
+                for bound, bucket in zip(BUCKETS, buckets):
+                    cumulative += bucket
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', _number(bound)),))} {cumulative}")
+                lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{_labels(labels)} {_number(total)}")
+                lines.append(f"{name}_count{_labels(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, name: str, kind: str) -> list:
+        lines = []
+        if name in self._help:
+            lines.append(f"# HELP {name} {self._help[name]}")
+        lines.append(f"# TYPE {name} {kind}")
+        return lines
+
+
+def _pid_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+def _number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+metrics = MetricsRegistry(METRICS_DIR, METRICS_FLUSH_INTERVAL)
+metrics.describe('crag_request_duration_seconds', 'HTTP request duration by endpoint')
+metrics.describe('crag_stage_duration_seconds', 'Query pipeline stage duration')
+metrics.describe('crag_outbound_calls_total', 'Outbound calls to IBM services')
+metrics.describe('crag_documents_filtered_total', 'Discovery documents dropped by a filter')
+metrics.describe('crag_passages_filtered_total', 'Passages dropped by the relevance filter')
+metrics.describe('crag_degraded_responses_total', 'Responses served in a degraded mode')
+
+
+def start_request() -> RequestTimings:
+    """Begin collecting stage timings for the current request."""
+    timings = RequestTimings()
+    _current_request.set(timings)
+    return timings
+
+
+def current_request():
+    return _current_request.get()
+
+
+def record_stage(name: str, seconds: float):
+    """Record time spent in a pipeline stage for the current request and the stage histogram."""
+    metrics.observe('crag_stage_duration_seconds', seconds, {'stage': name})
+    timings = _current_request.get()
+    if timings is not None:
+        timings.add_stage(name, seconds)
+
+
+@contextmanager
+def stage(name: str):
+    """Time a block as one pipeline stage."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started)
+
+
+def count_call(service: str):
+    """Count one outbound call to an IBM service."""
+    metrics.inc('crag_outbound_calls_total', {'service': service})
+    timings = _current_request.get()
+    if timings is not None:
+        timings.add_call(service)
+
+
+def count_filtered(kind: str, reason: str, amount: int = 1):
+    """Count documents or passages dropped by the confidence or relevance filter."""
+    if amount:
+        metrics.inc(f'crag_{kind}_filtered_total', {'reason': reason}, amount)
+
+
+def mark_degraded(mode: str):
+    """Note that the current request was served in a degraded mode ('answer' or 'relevance')."""
+    timings = _current_request.get()
+    if timings is None or timings.add_degraded(mode):
+        metrics.inc('crag_degraded_responses_total', {'mode': mode})
+
+
+def degraded_modes() -> list:
+    timings = _current_request.get()
+    return sorted(timings.degraded) if timings is not None else []
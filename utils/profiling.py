@@ -0,0 +1,260 @@
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import pstats
+import random
+import cProfile
+import threading
+import contextvars
+from contextlib import contextmanager
+from config import PROFILE_DIR, PROFILE_MAX_COUNT, PROFILE_SAMPLE_INTERVAL
+from utils.logger import logger
+from utils.metrics import metrics
+
+PROFILE_FORMATS = {'pstats': 'application/octet-stream', 'collapsed': 'text/plain', 'json': 'application/json'}
+PROFILE_ID = re.compile(r'^[0-9]+-[0-9]+-[0-9a-f]{8}$')
+
+metrics.describe('crag_profiles_total', 'Requests profiled, by trigger (header or sample)')
+
+# Profile of the request being served; copy_context().run carries it into the pool threads working for it
+_current_profile = contextvars.ContextVar('crag_profile', default=None)
+
+
+def _thread_cpu_clock(ident: int):
+    try:
+        return time.pthread_getcpuclockid(ident)
+    except (AttributeError, OSError):  # not available on every platform
+        return None
+
+
+def _frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _is_idle_worker(frame) -> bool:
+    # An executor thread parked on its work queue is not doing anything for the request
+    code = frame.f_code
+    return code.co_name == '_worker' and code.co_filename.endswith(os.path.join('concurrent', 'futures', 'thread.py'))
+
+
+class StackSampler:
+    """
+    Samples the stacks of the request thread and of the pool threads tagged as
+    working for the request every `interval` seconds and counts them as
+    collapsed stacks. Where per-thread CPU clocks exist, each sample is marked
+    [cpu] if the thread used CPU since the previous sample and [waiting]
+    otherwise (I/O, locks, sleeps).
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.thread_name = threading.current_thread().name
+        self.interval = interval
+        self.stacks = {}
+        self._tagged = {}
+        self._tagged_lock = threading.Lock()
+        self.samples = {'cpu': 0, 'waiting': 0}
+        self._cpu = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    @contextmanager
+    def tagged(self, thread: threading.Thread):
+        """Sample `thread` along with the request thread while the body runs."""
+        with self._tagged_lock:
+            self._tagged[thread.ident] = thread.name
+        try:
+            yield
+        finally:
+            with self._tagged_lock:
+                self._tagged.pop(thread.ident, None)
+
+    def _threads(self) -> dict:
+        with self._tagged_lock:
+            threads = dict(self._tagged)
+        threads[self.thread_id] = self.thread_name
+        return threads
+
+    def _state(self, ident: int) -> str:
+        clock = _thread_cpu_clock(ident)
+        if clock is None:
+            return 'unknown'
+        try:
+            used = time.clock_gettime(clock)
+        except OSError:
+            return 'unknown'
+        previous = self._cpu.get(ident)
+        self._cpu[ident] = used
+        if previous is None:
+            return 'unknown'
+        return 'cpu' if used - previous >= self.interval / 2 else 'waiting'
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            threads = self._threads()
+            for ident, frame in sys._current_frames().items():
+                name = threads.get(ident)
+                if name is None or _is_idle_worker(frame):
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                state = self._state(ident)
+                if state in self.samples:
+                    self.samples[state] += 1
+                key = ';'.join([name.split('_')[0]] + labels[::-1] + [f"[{state}]"])
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def collapsed(self) -> str:
+        return ''.join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+
+class RequestProfile:
+    """
+    Profile of one request: cProfile of the request thread, sampled stacks of the
+    threads working for it, and wall time split into request-thread CPU and waiting.
+    """
+
+    def __init__(self, endpoint: str, method: str, trigger: str):
+        self.id = f"{int(time.time())}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.endpoint = endpoint
+        self.method = method
+        self.trigger = trigger
+        self.profiler = cProfile.Profile()
+        self.sampler = StackSampler(threading.get_ident(), PROFILE_SAMPLE_INTERVAL)
+        self._profiling = False
+
+    def start(self):
+        self.started_at = time.time()
+        self._wall = time.perf_counter()
+        self._thread_cpu = time.thread_time()
+        self._process_cpu = time.process_time()
+        try:
+            self.profiler.enable()
+            self._profiling = True
+        except ValueError:
+            # Another profiler is active in this process (sys.monitoring allows one); keep the samples
+            logger.warning("cProfile unavailable for this request; recording sampled stacks only")
+        self.sampler.start()
+        _current_profile.set(self)
+
+    def finish(self, status: int = None) -> dict:
+        if _current_profile.get() is self:
+            # Server threads are reused, so the next request on this one must not see this profile
+            _current_profile.set(None)
+        if self._profiling:
+            self.profiler.disable()
+        self.sampler.stop()
+        wall = time.perf_counter() - self._wall
+        cpu = time.thread_time() - self._thread_cpu
+        summary = {
+            "id": self.id,
+            "endpoint": self.endpoint,
+            "method": self.method,
+            "status": status,
+            "trigger": self.trigger,
+            "started_at": self.started_at,
+            "wall_seconds": round(wall, 4),
+            "cpu_seconds": round(cpu, 4),
+            "waiting_seconds": round(max(0.0, wall - cpu), 4),
+            "process_cpu_seconds": round(time.process_time() - self._process_cpu, 4),
+            "samples": dict(self.sampler.samples),
+            "top_functions": self._top_functions() if self._profiling else [],
+        }
+        metrics.inc('crag_profiles_total', {'trigger': self.trigger})
+        return summary
+
+    def _top_functions(self, limit: int = 15) -> list:
+        stats = pstats.Stats(self.profiler)
+        rows = []
+        for (filename, line, function), (_, calls, own, cumulative, _) in stats.stats.items():
+            rows.append({"function": f"{function} ({os.path.basename(filename)}:{line})", "calls": calls,
+                         "own_seconds": round(own, 4), "cumulative_seconds": round(cumulative, 4)})
+        rows.sort(key=lambda row: row["cumulative_seconds"], reverse=True)
+        return rows[:limit]
+
+
+class ProfileStore:
+    """Profiles kept as <id>.pstats, <id>.collapsed and <id>.json in a directory holding at most `max_count`."""
+
+    def __init__(self, directory: str, max_count: int):
+        self.directory = directory
+        self.max_count = max_count
+        self._lock = threading.Lock()
+
+    def path(self, profile_id: str, fmt: str) -> str:
+        return os.path.join(self.directory, f"{profile_id}.{fmt}")
+
+    def save(self, profile: RequestProfile, summary: dict):
+        os.makedirs(self.directory, exist_ok=True)
+        if profile._profiling:
+            profile.profiler.dump_stats(self.path(profile.id, 'pstats'))
+        with open(self.path(profile.id, 'collapsed'), 'w') as f:
+            f.write(profile.sampler.collapsed())
+        # The summary is written last: listing only shows profiles whose files are complete
+        with open(self.path(profile.id, 'json'), 'w') as f:
+            json.dump(summary, f)
+        self._prune()
+
+    def _ids(self) -> list:
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return [name[:-5] for name in names if name.endswith('.json') and PROFILE_ID.match(name[:-5])]
+
+    def _prune(self):
+        with self._lock:
+            ids = sorted(self._ids(), key=lambda i: os.path.getmtime(self.path(i, 'json')))
+            for profile_id in ids[:max(0, len(ids) - self.max_count)]:
+                for fmt in PROFILE_FORMATS:
+                    try:
+                        os.remove(self.path(profile_id, fmt))
+                    except OSError:
+                        pass
+
+    def list(self) -> list:
+        """Summaries of the stored profiles, newest first, without their function tables."""
+        summaries = []
+        for profile_id in self._ids():
+            try:
+                with open(self.path(profile_id, 'json')) as f:
+                    summary = json.load(f)
+            except (OSError, ValueError):
+                continue
+            summary.pop("top_functions", None)
+            summary["files"] = [fmt for fmt in PROFILE_FORMATS if os.path.exists(self.path(profile_id, fmt))]
+            summaries.append(summary)
+        summaries.sort(key=lambda s: s["started_at"], reverse=True)
+        return summaries
+
+
+profile_store = ProfileStore(PROFILE_DIR, PROFILE_MAX_COUNT)
+
+
+def for_request(fn, *args, **kwargs):
+    """
+    Run `fn(*args, **kwargs)` on a pool thread working for the current request.
+    Submit it through contextvars.copy_context().run so that, when the request
+    is profiled, this thread is sampled with it for the duration of the call.
+    """
+    profile = _current_profile.get()
+    if profile is None:
+        return fn(*args, **kwargs)
+    with profile.sampler.tagged(threading.current_thread()):
+        return fn(*args, **kwargs)
+
+
+def should_sample(rate: float) -> bool:
+    return rate > 0 and random.random() < rate
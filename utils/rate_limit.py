@@ -0,0 +1,250 @@
+import os
+import time
+import struct
+import asyncio
+import threading
+from contextlib import contextmanager, asynccontextmanager
+from utils.storage import fcntl
+
+
+class LimitExceeded(Exception):
+    """No token or concurrency slot became free within the caller's time limit."""
+
+
+# Bucket state on disk: available tokens and the wall-clock time they were computed at
+_STATE = struct.Struct('<dd')
+
+
+class TokenBucket:
+    """
+    Token bucket of `rate` calls per second with bursts up to `burst`.
+
+    With a `path` the bucket state lives in a small file locked with flock, so
+    every worker process on the host draws from the same bucket; without one
+    (or without fcntl) it is per process. Callers reserve a token and sleep
+    until it is due, so waiting callers are served in order without polling.
+    """
+
+    def __init__(self, rate: float, burst: float, path: str = None):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.path = path if fcntl else None
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._fd = None
+        self._pid = None
+        if self.path:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+
+    def _file(self) -> int:
+        if self._fd is None or self._pid != os.getpid():
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            self._pid = os.getpid()
+        return self._fd
+
+    def _refill(self, tokens: float, updated: float, now: float) -> float:
+        # A clock that went backwards refills nothing rather than going negative
+        return min(self.burst, tokens + max(0.0, now - updated) * self.rate)
+
+    def _reserve(self, max_wait: float):
+        """Take a token; returns seconds until it is due, or None (taking nothing) if that exceeds `max_wait`."""
+        with self._lock:
+            now = time.time()
+            if not self.path:
+                tokens = self._refill(self._tokens, self._updated, now)
+                wait = max(0.0, (1 - tokens) / self.rate)
+                if wait > max_wait:
+                    return None
+                self._tokens, self._updated = tokens - 1, now
+                return wait
+
+            fd = self._file()
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                data = os.pread(fd, _STATE.size, 0)
+                tokens, updated = _STATE.unpack(data) if len(data) == _STATE.size else (self.burst, now)
+                tokens = self._refill(tokens, updated, now)
+                wait = max(0.0, (1 - tokens) / self.rate)
+                if wait > max_wait:
+                    return None
+                os.pwrite(fd, _STATE.pack(tokens - 1, now), 0)
+                return wait
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def acquire(self, timeout: float) -> bool:
+        """Wait for a token for at most `timeout` seconds; False if none would be due in time."""
+        wait = self._reserve(timeout)
+        if wait is None:
+            return False
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+    async def acquire_async(self, timeout: float) -> bool:
+        if self.path:
+            # flock blocks while another worker holds the bucket file, so it must stay off the event loop
+            wait = await asyncio.get_running_loop().run_in_executor(None, self._reserve, timeout)
+        else:
+            wait = self._reserve(timeout)
+        if wait is None:
+            return False
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return True
+
+
+def _wake(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class AIMDController:
+    """
+    Per-process concurrency limit adjusted by additive increase, multiplicative decrease.
+
+    Every successful call within normal latency raises the limit by 1/limit
+    (about one extra slot per round of calls). A throttled call, or one slower
+    than `latency_factor` times the moving average latency, multiplies the limit
+    by `backoff`, at most once per average call duration so one burst of slow
+    responses counts as one congestion signal. Latency spikes are only judged
+    once `warmup` calls have set the average.
+    """
+
+    warmup = 10
+
+    def __init__(self, minimum: int, maximum: int, backoff: float = 0.5, latency_factor: float = 3.0):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.backoff = backoff
+        self.latency_factor = latency_factor
+        self.limit = float(self.maximum)
+        self.decreases = 0
+        self._in_flight = 0
+        self._average = None
+        self._samples = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+        self._async_waiters = []
+
+    def try_acquire(self) -> bool:
+        with self._condition:
+            if self._in_flight < int(self.limit):
+                self._in_flight += 1
+                return True
+            return False
+
+    def acquire(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            self._in_flight += 1
+            return True
+
+    async def acquire_async(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                if self._in_flight < int(self.limit):
+                    self._in_flight += 1
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            try:
+                await asyncio.wait_for(waiter, remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self._condition:
+                    if (loop, waiter) in self._async_waiters:
+                        self._async_waiters.remove((loop, waiter))
+
+    def release(self, latency: float = None, throttled: bool = False):
+        """Free a slot and adjust the limit: `throttled` is a 429, `latency` is given for completed calls."""
+        with self._condition:
+            self._in_flight -= 1
+            if throttled:
+                self._decrease()
+            elif latency is not None:
+                if self._samples >= self.warmup and latency > self.latency_factor * self._average:
+                    self._decrease()
+                else:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                self._average = latency if self._average is None else 0.9 * self._average + 0.1 * latency
+                self._samples += 1
+            self._condition.notify_all()
+            self._wake_async_waiters()
+
+    def _wake_async_waiters(self):
+        # release() may run on any thread, so each waiter is woken on its own event loop
+        waiters, self._async_waiters = self._async_waiters, []
+        for loop, waiter in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, waiter)
+            except RuntimeError:  # its loop has been closed
+                pass
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self._last_decrease < (self._average or 0.0):
+            return
+        self._last_decrease = now
+        self.limit = max(self.minimum, self.limit * self.backoff)
+        self.decreases += 1
+
+
+class OutboundLimiter:
+    """Shared token bucket plus per-process AIMD concurrency limit for one outbound service."""
+
+    def __init__(self, bucket: TokenBucket, concurrency: AIMDController):
+        self.bucket = bucket
+        self.concurrency = concurrency
+
+    @contextmanager
+    def slot(self, timeout: float, is_throttled):
+        """
+        Hold a call slot for the body. Raises LimitExceeded if no token or slot is
+        free within `timeout`; `is_throttled(error)` tells 429s from other failures.
+        """
+        started = time.monotonic()
+        if self.bucket is not None and not self.bucket.acquire(timeout):
+            raise LimitExceeded("rate limit")
+        if not self.concurrency.acquire(max(0.0, timeout - (time.monotonic() - started))):
+            raise LimitExceeded("concurrency limit")
+        called = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            self.concurrency.release(throttled=is_throttled(e))
+            raise
+        except BaseException:
+            self.concurrency.release()
+            raise
+        self.concurrency.release(latency=time.monotonic() - called)
+
+    @asynccontextmanager
+    async def slot_async(self, timeout: float, is_throttled):
+        started = time.monotonic()
+        if self.bucket is not None and not await self.bucket.acquire_async(timeout):
+            raise LimitExceeded("rate limit")
+        if not await self.concurrency.acquire_async(max(0.0, timeout - (time.monotonic() - started))):
+            raise LimitExceeded("concurrency limit")
+        called = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            self.concurrency.release(throttled=is_throttled(e))
+            raise
+        except BaseException:
+            self.concurrency.release()
+            raise
+        self.concurrency.release(latency=time.monotonic() - called)
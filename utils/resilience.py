@@ -0,0 +1,438 @@
+import os
+import time
+import random
+import asyncio
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from config import (DISCOVERY_TIMEOUT, DISCOVERY_DEADLINE, NLU_CALL_TIMEOUT, NLU_DEADLINE, WATSONX_TIMEOUT,
+                    WATSONX_DEADLINE, OUTBOUND_MAX_RETRIES, OUTBOUND_RETRY_BACKOFF, RETRY_BUDGET_RATIO,
+                    RETRY_BUDGET_MIN_PER_SECOND, BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT,
+                    RATE_LIMIT_DIR, NLU_RATE_LIMIT, NLU_RATE_BURST, NLU_MAX_CONCURRENCY, DISCOVERY_RATE_LIMIT,
+                    DISCOVERY_RATE_BURST, DISCOVERY_MAX_CONCURRENCY, AIMD_MIN_CONCURRENCY, AIMD_LATENCY_FACTOR,
+                    THROTTLE_MAX_RETRY_AFTER)
+from utils.logger import logger
+from utils.metrics import metrics
+from utils.profiling import for_request
+from utils.rate_limit import TokenBucket, AIMDController, OutboundLimiter, LimitExceeded
+
+
+class ServiceUnavailable(Exception):
+    """An outbound service failed transiently on every attempt or its circuit is open."""
+
+    def __init__(self, service: str, message: str):
+        super().__init__(message)
+        self.service = service
+
+
+class CircuitOpenError(ServiceUnavailable):
+    """Raised without calling the service while its circuit breaker is open."""
+
+
+class Throttled(ServiceUnavailable):
+    """The service kept answering 429, or the local rate limit left no room before the deadline."""
+
+
+def _status_code(error: Exception):
+    status = getattr(error, 'code', None)
+    if not isinstance(status, int):
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status if isinstance(status, int) else None
+
+
+def is_throttled(error: Exception) -> bool:
+    return _status_code(error) == 429
+
+
+def retry_after(error: Exception) -> float:
+    """Seconds the service asked us to wait in a Retry-After header (IBM SDK or httpx errors), or 0."""
+    response = getattr(error, 'http_response', None) or getattr(error, 'response', None)
+    try:
+        return max(0.0, float(getattr(response, 'headers', {}).get('Retry-After')))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def is_transient(error: Exception) -> bool:
+    """
+    Whether a failure says something about the service's health: timeouts,
+    connection errors, 429 and 5xx responses. Other 4xx responses and
+    programming errors are the caller's problem and are neither retried nor
+    counted by the circuit breaker.
+    """
+    if isinstance(error, (ValueError, TypeError, KeyError, AttributeError)):
+        return False
+    status = _status_code(error)
+    if status is not None:
+        return status == 429 or status >= 500
+    return True
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker. After `failure_threshold` failures in
+    a row the circuit opens and calls fail fast; after `reset_timeout` seconds a
+    single probe call is let through and its outcome closes or reopens it.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.opened = 0
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def available(self) -> bool:
+        """Whether a call would currently be allowed, without claiming the half-open probe."""
+        with self._lock:
+            return self.state == self.CLOSED or (
+                self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout)
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self) -> bool:
+        """Count a failure; returns True if this failure opened the circuit."""
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED
+                                                and self._failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self.opened += 1
+                return True
+            return False
+
+
+class RetryBudget:
+    """
+    Limit retries to `ratio` of the calls made in the last `window` seconds
+    (plus `min_per_second`), so retries cannot multiply load on a struggling service.
+    """
+
+    def __init__(self, ratio: float, min_per_second: float, window: float = 10.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.window = window
+        self._calls = deque()
+        self._retries = deque()
+        self._lock = threading.Lock()
+
+    def _trim(self, now: float):
+        for events in (self._calls, self._retries):
+            while events and events[0] < now - self.window:
+                events.popleft()
+
+    def record_call(self):
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            self._calls.append(now)
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            if len(self._retries) >= self.min_per_second * self.window + self.ratio * len(self._calls):
+                return False
+            self._retries.append(now)
+            return True
+
+
+class ServicePolicy:
+    """
+    Deadline, budgeted retries with jitter and a circuit breaker for one outbound service.
+
+    `timeout` bounds one attempt and `deadline` the whole call including
+    retries. SDKs that cannot time out their own requests are run with
+    `isolate=True`, in a small per-process pool, so the caller stops waiting
+    at the deadline even if the request thread does not.
+    Breakers are per worker process.
+
+    With a `limiter` every attempt first waits for a rate-limit token and a
+    concurrency slot. 429 responses are retried after the backoff or the
+    service's Retry-After, whichever is longer; they shrink the concurrency
+    limit and are counted as throttled, not as failures, so they never open
+    the circuit.
+    """
+
+    def __init__(self, name: str, timeout: float, deadline: float, max_retries: int, backoff: float,
+                 breaker: CircuitBreaker, budget: RetryBudget, isolate: bool = False,
+                 limiter: OutboundLimiter = None):
+        self.name = name
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.breaker = breaker
+        self.budget = budget
+        self.isolate = isolate
+        self.limiter = limiter
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def available(self) -> bool:
+        return self.breaker.available()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                # Sized well above typical per-worker concurrency so calls do not time out while queued
+                self._executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix=f'{self.name}-call')
+                self._pid = os.getpid()
+            return self._executor
+
+    def _delay(self, attempt: int) -> float:
+        # Full jitter spreads out retries from concurrent requests
+        return random.uniform(0, self.backoff * (2 ** attempt))
+
+    def _admit(self):
+        if not self.breaker.allow():
+            metrics.inc('crag_outbound_failures_total', {'service': self.name, 'reason': 'circuit_open'})
+            raise CircuitOpenError(self.name, f"{self.name} is unavailable (circuit open)")
+        self.budget.record_call()
+
+    def _failed(self, error: Exception) -> bool:
+        """Record a failed attempt; returns whether it was transient."""
+        if is_throttled(error):
+            metrics.inc('crag_throttled_total', {'service': self.name, 'source': 'remote'})
+            # A 429 means the service is up, so it must not count towards opening the circuit
+            self.breaker.record_success()
+            return True
+        transient = is_transient(error)
+        metrics.inc('crag_outbound_failures_total',
+                    {'service': self.name, 'reason': 'transient' if transient else 'permanent'})
+        if not transient:
+            # The service answered, so it is healthy even though the request was rejected
+            self.breaker.record_success()
+            return False
+        if self.breaker.record_failure():
+            logger.warning(f"Circuit for {self.name} opened after repeated failures: {error}")
+        return True
+
+    def _retry_delay(self, attempt: int, error: Exception) -> float:
+        if is_throttled(error):
+            return max(self._delay(attempt), min(retry_after(error), THROTTLE_MAX_RETRY_AFTER))
+        return self._delay(attempt)
+
+    def _gave_up(self, error: Exception) -> ServiceUnavailable:
+        if is_throttled(error):
+            return Throttled(self.name, f"{self.name} is throttling requests: {error}")
+        return ServiceUnavailable(self.name, f"{self.name} is unavailable: {error}")
+
+    def _limit_exceeded(self, error: LimitExceeded) -> Throttled:
+        metrics.inc('crag_throttled_total', {'service': self.name, 'source': 'local'})
+        return Throttled(self.name, f"{self.name} call not started within its deadline ({error})")
+
+    def _slot(self, remaining: float):
+        if self.limiter is None:
+            return nullcontext()
+        return self.limiter.slot(max(0.0, remaining), is_throttled)
+
+    def _should_retry(self, attempt: int, started: float, delay: float, throttled: bool = False) -> bool:
+        if attempt >= self.max_retries or time.monotonic() - started + delay >= self.deadline:
+            return False
+        # A 429 retry waits as long as the service asked, so it does not add load the way other retries do
+        if not throttled and not self.budget.try_spend():
+            metrics.inc('crag_retry_budget_exhausted_total', {'service': self.name})
+            return False
+        metrics.inc('crag_retries_total', {'service': self.name})
+        return True
+
+    def _run(self, fn, args, kwargs, remaining: float):
+        if not self.isolate:
+            return fn(*args, **kwargs)
+        future = self._get_executor().submit(contextvars.copy_context().run, for_request, fn, *args, **kwargs)
+        try:
+            return future.result(timeout=max(0.0, min(self.timeout, remaining)))
+        except FutureTimeoutError:
+            future.cancel()
+            raise TimeoutError(f"{self.name} call exceeded {min(self.timeout, remaining):.1f}s")
+
+    def _attempt(self, fn, args, kwargs, started: float):
+        remaining = self.deadline - (time.monotonic() - started)
+        # The slot is taken before the breaker so a half-open probe is never claimed by a call left waiting
+        with self._slot(remaining):
+            self._admit()
+            return self._run(fn, args, kwargs, self.deadline - (time.monotonic() - started))
+
+    def call(self, fn, *args, retry: bool = True, **kwargs):
+        """Call `fn(*args, **kwargs)` under this policy; raises ServiceUnavailable when it gives up."""
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                result = self._attempt(fn, args, kwargs, started)
+            except ServiceUnavailable:
+                raise
+            except LimitExceeded as e:
+                raise self._limit_exceeded(e) from e
+            except Exception as e:
+                if not self._failed(e):
+                    raise
+                delay = self._retry_delay(attempt, e)
+                if not retry or not self._should_retry(attempt, started, delay, is_throttled(e)):
+                    raise self._gave_up(e) from e
+                attempt += 1
+                time.sleep(delay)
+                continue
+            self.breaker.record_success()
+            return result
+
+    async def _attempt_async(self, fn, args, kwargs, started: float):
+        remaining = max(0.0, self.deadline - (time.monotonic() - started))
+        if self.limiter is None:
+            self._admit()
+            return await asyncio.wait_for(fn(*args, **kwargs), timeout=min(self.timeout, remaining))
+        async with self.limiter.slot_async(remaining, is_throttled):
+            self._admit()
+            remaining = max(0.0, self.deadline - (time.monotonic() - started))
+            return await asyncio.wait_for(fn(*args, **kwargs), timeout=min(self.timeout, remaining))
+
+    async def call_async(self, fn, *args, retry: bool = True, **kwargs):
+        """Await `fn(*args, **kwargs)` under this policy, each attempt bounded by the timeout and deadline."""
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                result = await self._attempt_async(fn, args, kwargs, started)
+            except ServiceUnavailable:
+                raise
+            except LimitExceeded as e:
+                raise self._limit_exceeded(e) from e
+            except Exception as e:
+                if not self._failed(e):
+                    raise
+                delay = self._retry_delay(attempt, e)
+                if not retry or not self._should_retry(attempt, started, delay, is_throttled(e)):
+                    raise self._gave_up(e) from e
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            self.breaker.record_success()
+            return result
+
+    @contextmanager
+    def guard(self):
+        """Breaker accounting without retries, for streamed responses that cannot be replayed."""
+        self._admit()
+        try:
+            yield
+        except Exception as e:
+            if not self._failed(e):
+                raise
+            raise self._gave_up(e) from e
+        except BaseException:
+            # The consumer stopped reading (e.g. client disconnect); the service itself was fine
+            self.breaker.record_success()
+            raise
+        self.breaker.record_success()
+
+    def stream(self, open_stream):
+        """
+        Yield the items of the iterator returned by `open_stream()`, with breaker
+        accounting as in guard(). For isolated services every item is read in the
+        policy's pool, so waiting for one is bounded by `timeout` and the whole
+        stream by `deadline`; running out of either raises ServiceUnavailable.
+        """
+        with self.guard():
+            if not self.isolate:
+                yield from open_stream()
+                return
+            started = time.monotonic()
+            items = self._run(open_stream, (), {}, self.deadline)
+            while True:
+                item = self._run(next, (items, _END_OF_STREAM), {}, self.deadline - (time.monotonic() - started))
+                if item is _END_OF_STREAM:
+                    return
+                yield item
+
+
+# Returned by next() in the pool once a streamed response is exhausted
+_END_OF_STREAM = object()
+
+
+def _limiter(name: str, rate: float, burst: float, max_concurrency: int) -> OutboundLimiter:
+    bucket = None
+    if rate > 0:
+        bucket = TokenBucket(rate, burst, os.path.join(RATE_LIMIT_DIR, f"{name}.bucket") if RATE_LIMIT_DIR else None)
+    concurrency = AIMDController(AIMD_MIN_CONCURRENCY, max_concurrency, latency_factor=AIMD_LATENCY_FACTOR)
+    return OutboundLimiter(bucket, concurrency)
+
+
+def _policy(name: str, timeout: float, deadline: float, isolate: bool = False,
+            limiter: OutboundLimiter = None) -> ServicePolicy:
+    return ServicePolicy(
+        name, timeout, deadline,
+        max_retries=OUTBOUND_MAX_RETRIES,
+        backoff=OUTBOUND_RETRY_BACKOFF,
+        breaker=CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT),
+        budget=RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_MIN_PER_SECOND),
+        isolate=isolate,
+        limiter=limiter
+    )
+
+
+policies = {
+    'discovery': _policy('discovery', DISCOVERY_TIMEOUT, DISCOVERY_DEADLINE,
+                         limiter=_limiter('discovery', DISCOVERY_RATE_LIMIT, DISCOVERY_RATE_BURST,
+                                          DISCOVERY_MAX_CONCURRENCY)),
+    'nlu': _policy('nlu', NLU_CALL_TIMEOUT, NLU_DEADLINE,
+                   limiter=_limiter('nlu', NLU_RATE_LIMIT, NLU_RATE_BURST, NLU_MAX_CONCURRENCY)),
+    # The watsonx.ai SDK sends its requests without a timeout, so the deadline is enforced around it
+    'watsonx': _policy('watsonx', WATSONX_TIMEOUT, WATSONX_DEADLINE, isolate=True),
+}
+
+
+def get_policy(service: str) -> ServicePolicy:
+    return policies[service]
+
+
+def _breaker_samples():
+    # Gauges are summed across workers, so breaker state is reported as one 0/1 sample per state
+    samples = []
+    for name, policy in policies.items():
+        for state in (CircuitBreaker.CLOSED, CircuitBreaker.HALF_OPEN, CircuitBreaker.OPEN):
+            samples.append(('gauge', 'crag_circuit_state', {'service': name, 'state': state},
+                            int(policy.breaker.state == state)))
+        samples.append(('counter', 'crag_circuit_opened_total', {'service': name}, policy.breaker.opened))
+        if policy.limiter is not None:
+            concurrency = policy.limiter.concurrency
+            samples.append(('gauge', 'crag_concurrency_limit', {'service': name}, int(concurrency.limit)))
+            samples.append(('counter', 'crag_concurrency_decreases_total', {'service': name}, concurrency.decreases))
+    return samples
+
+
+metrics.describe('crag_circuit_state', 'Workers whose circuit breaker is in each state (closed, half_open, open)')
+metrics.describe('crag_circuit_opened_total', 'Times a circuit breaker opened')
+metrics.describe('crag_outbound_failures_total', 'Failed outbound calls by service and reason')
+metrics.describe('crag_retries_total', 'Retried outbound calls')
+metrics.describe('crag_retry_budget_exhausted_total', 'Retries skipped because the retry budget was spent')
+metrics.describe('crag_throttled_total', 'Calls throttled by the service (remote, 429) or the local rate limit')
+metrics.describe('crag_concurrency_limit', 'Adaptive (AIMD) concurrency limits summed across workers')
+metrics.describe('crag_concurrency_decreases_total', 'Times the adaptive concurrency limit was cut')
+metrics.register_collector(_breaker_samples)
@@ -0,0 +1,86 @@
+import asyncio
+import threading
+from contextlib import nullcontext
+from utils.metrics import metrics, stage
+
+metrics.describe('crag_coalesced_requests_total', 'Calls that waited on an identical in-flight computation')
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls with the same key: the first caller runs the
+    function, later callers block until it finishes and share its result or
+    exception. Nothing is kept once the call completes, so this is not a cache.
+    Time spent waiting is recorded as the `wait_stage` pipeline stage, if set.
+    """
+
+    def __init__(self, name: str, wait_stage: str = 'coalesced_wait'):
+        self.name = name
+        self.wait_stage = wait_stage
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key: str, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            metrics.inc('crag_coalesced_requests_total', {'flight': self.name})
+            with stage(self.wait_stage) if self.wait_stage else nullcontext():
+                call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines running on one event loop."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls = {}
+
+    async def do(self, key: str, fn, *args, **kwargs):
+        future = self._calls.get(key)
+        if future is not None:
+            metrics.inc('crag_coalesced_requests_total', {'flight': self.name})
+            # Shield so a cancelled follower does not cancel the leader's computation
+            with stage('coalesced_wait'):
+                return await asyncio.shield(future)
+
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn(*args, **kwargs)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark retrieved so an uncontested failure is not logged as never retrieved
+            future.exception()
+            raise
+        finally:
+            del self._calls[key]
@@ -0,0 +1,43 @@
+import sys
+import time
+import importlib
+from contextlib import contextmanager
+from utils.metrics import metrics
+
+metrics.describe('crag_startup_seconds', 'Worker startup time by phase (import, app_load, prewarm, ready) and step')
+
+# perf_counter reading taken by gunicorn.conf.py right after the worker was forked
+_forked_at = None
+
+
+def observe_startup(phase: str, step: str, seconds: float):
+    metrics.observe('crag_startup_seconds', seconds, {'phase': phase, 'step': step})
+
+
+@contextmanager
+def timed(phase: str, step: str):
+    """Record how long the body took as one startup observation."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_startup(phase, step, time.perf_counter() - started)
+
+
+def import_timed(name: str):
+    """Import a module, recording the time of its first import in this process."""
+    if name in sys.modules:
+        # import_module waits for a module another thread is still initializing
+        return importlib.import_module(name)
+    with timed('import', name):
+        return importlib.import_module(name)
+
+
+def mark_forked():
+    global _forked_at
+    _forked_at = time.perf_counter()
+
+
+def since_fork():
+    """Seconds since the worker was forked, or None outside gunicorn."""
+    return None if _forked_at is None else time.perf_counter() - _forked_at
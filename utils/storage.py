@@ -0,0 +1,36 @@
+import os
+import sqlite3
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows development machines
+    fcntl = None
+
+
+class SQLiteStore:
+    """
+    Base for stores kept in a local SQLite file shared by every worker process.
+    Each thread gets its own autocommit connection in WAL mode, opened again in
+    a forked child. Subclasses call `_open(path)` first in their constructor and
+    may add PRAGMAS.
+    """
+
+    PRAGMAS = ()
+
+    def _open(self, path: str) -> sqlite3.Connection:
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        return self._connect()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            for pragma in self.PRAGMAS:
+                conn.execute(f'PRAGMA {pragma}')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn